@@ -3,12 +3,19 @@ from oebakery import die, err, warn, info, debug
 from oelite import *
 from recipe import OEliteRecipe
 from runq import OEliteRunQueue
+import oelite.runq
 import oelite.meta
 import oelite.util
 import oelite.arch
 import oelite.parse
 import oelite.task
 import oelite.item
+import oelite.executor
+import oelite.function
+import oelite.buildstats
+import oelite.jobserver
+import oelite.fingerprint
+import oelite.cookbook
 from oelite.parse import *
 from oelite.cookbook import CookBook
 
@@ -68,10 +75,28 @@ def add_bake_parser_options(parser):
                       action="store", type="str", default=None, metavar="DIR",
                       help="dump task metadata used for calculating task signatures to DIR")
 
+    parser.add_option("--verify-datahashes",
+                      action="store_true", default=False,
+                      help="verify task data hashes calculated in parallel or cached against serial calculation")
+
+    parser.add_option("-j", "--jobs",
+                      action="store", type="int", default=None, metavar="N",
+                      help="run up to N tasks in parallel (default: ${BAKE_JOBS}), and parse recipes in up to N processes (default: ${BAKE_CPUS})")
+
+    parser.add_option("--schedule",
+                      action="store", type="choice", default=None,
+                      choices=oelite.runq.SCHEDULES,
+                      help="task scheduling policy: %s (default: ${BAKE_SCHEDULE})"%(
+            "|".join(oelite.runq.SCHEDULES)))
+
     parser.add_option("--fake-build",
                       action="store_true", default=False,
                       help="don't actually run the tasks, but record state as if they were")
 
+    parser.add_option("--mem-report",
+                      action="store_true", default=False,
+                      help="report memory used for recipe metadata")
+
     return
 
 
@@ -89,10 +114,12 @@ def add_show_parser_options(parser):
 
 class OEliteBaker:
 
-    def __init__(self, options, args, config):
+    def __init__(self, options, args, config, fastpath=False):
         self.options = options
         self.debug = self.options.debug
         self.debug_loglines = getattr(self.options, 'debug_loglines', None)
+        # variable name -> cached signature dump, see MetaData.signature()
+        self.signature_cache = {}
 
         # Bakery 3 compatibility, configure the logging module
         if (not hasattr(oebakery, "__version__") or
@@ -115,6 +142,25 @@ class OEliteBaker:
         self.confparser = confparse.ConfParser(self.config)
         self.confparser.parse("conf/oe-lite.conf")
 
+        # Skip everything else when nothing has changed since last
+        # successful bake with the same arguments
+        self.nothing_to_do = False
+        self.fingerprint = None
+        if fastpath and not self.options.rebuild:
+            start = datetime.datetime.now()
+            self.fingerprint = oelite.fingerprint.BuildFingerprint(
+                os.path.join(self.config.get("CACHEDIR", True) or "",
+                             "fingerprint"),
+                (list(args), sorted(vars(self.options).items()),
+                 self.config.env_signature()))
+            if self.fingerprint.check(
+                oelite.cookbook.list_recipefiles(self.config)):
+                self.nothing_to_do = True
+            if self.debug:
+                timing_info("Checking build fingerprint", start)
+            if self.nothing_to_do:
+                return
+
         oelite.pyexec.exechooks(self.config, "post_conf_parse")
 
         # FIXME: refactor oelite.arch.init to a post_conf_parse hook
@@ -135,6 +181,8 @@ class OEliteBaker:
                 self.options.rmwork = True
         except AttributeError:
             pass
+        oeparse.OEParser.fast_lexer = (
+            self.config.get("BAKE_LEXER", True) != "ply")
         self.oeparser = oeparse.OEParser(self.config)
         for inherit in inherits:
             self.oeparser.reset_lexstate()
@@ -142,7 +190,21 @@ class OEliteBaker:
 
         oelite.pyexec.exechooks(self.config, "post_common_inherits")
 
+        start = datetime.datetime.now()
         self.cookbook = CookBook(self)
+        if self.debug:
+            timing_info("Building cookbook", start)
+            debug("Peak memory usage: %d MB"%(oelite.util.maxrss() / 1024))
+            debug("Inline python code cache: %s"%(
+                    oelite.pyexec.inline_code_cache))
+            debug("Inline python imports cache: %s"%(
+                    oelite.pyexec.inline_imports_cache))
+            debug("Python function cache: %s"%(
+                    oelite.function.python_function_cache))
+            for line in oelite.pyexec.hook_timing_report():
+                debug(line)
+        if getattr(self.options, "mem_report", False):
+            self.mem_report()
 
         # things (ritem, item, recipe, or package) to do
         if args:
@@ -258,6 +320,10 @@ class OEliteBaker:
 
     def bake(self):
 
+        if self.nothing_to_do:
+            info("Nothing to do")
+            return 0
+
         self.setup_tmpdir()
 
         # task(s) to do
@@ -284,9 +350,15 @@ class OEliteBaker:
             else:
                 self.options.relax = None
 
+        schedule = (self.options.schedule or
+                    self.config.get("BAKE_SCHEDULE", True) or "depth-first")
+        if not schedule in oelite.runq.SCHEDULES:
+            die("invalid BAKE_SCHEDULE: %s"%(schedule))
+
         # init build quue
         self.runq = OEliteRunQueue(self.config, self.cookbook,
-                                   self.options.rebuild, self.options.relax)
+                                   self.options.rebuild, self.options.relax,
+                                   schedule=schedule)
 
         # first, add complete dependency tree, with complete
         # task-to-task and task-to-package/task dependency information
@@ -352,6 +424,27 @@ class OEliteBaker:
         # determining which tasks needs to be run
         # examing each task, computing it's hash, and checking if the
         # task has already been built, and with the same hash.
+        cpus = self.get_cpus()
+        start = datetime.datetime.now()
+        tasks = [task for task in self.runq.get_tasks() if not task.nostamp]
+        datahashes = {}
+        sigcache = None
+        if not self.options.dump_signature_metadata:
+            sigcache = oelite.meta.SignatureCache(
+                os.path.join(self.cookbook.cachedir, "signatures.p"),
+                self.config.env_signature())
+            for task in tasks:
+                datahash = sigcache.get(task)
+                if datahash is not None:
+                    datahashes[task] = datahash
+            tasks = [task for task in tasks if not task in datahashes]
+        datahashes.update(self.calculate_datahashes(tasks, cpus))
+        if self.debug:
+            timing_info("Calculation task data hashes", start)
+            if sigcache:
+                debug("Data hash cache: %d hits, %d misses"%(
+                        sigcache.hits, sigcache.misses))
+
         task = self.runq.get_metahashable_task()
         total = self.runq.number_of_runq_tasks()
         count = 0
@@ -359,7 +452,6 @@ class OEliteBaker:
         while task:
             oelite.util.progress_info("Calculating task metadata hashes",
                                       total, count)
-            recipe = task.recipe
 
             if task.nostamp:
                 self.runq.set_task_metahash(task, "0")
@@ -371,29 +463,11 @@ class OEliteBaker:
             for depend in self.runq.task_dependencies(task, flatten=True):
                 dephashes[depend] = self.runq.get_task_metahash(depend)
             try:
-                recipe_extra_arch = recipe.meta.get("EXTRA_ARCH")
-            except oelite.meta.ExpansionError as e:
-                e.msg += " in %s"%(task)
-                raise
-            task_meta = task.meta()
-            # FIXME: is this really needed?  How should the task metadata be
-            # changed at this point?  isn't it created from recipe meta by the
-            # task.meta() call above?
-            if (recipe_extra_arch and
-                task_meta.get("EXTRA_ARCH") != recipe_extra_arch):
-                task_meta.set("EXTRA_ARCH", recipe_extra_arch)
-            try:
-                if self.options.dump_signature_metadata:
-                    self.normpath(task.recipe.filename)
-                    dump = os.path.join(self.options.dump_signature_metadata,
-                                        self.normpath(task.recipe.filename),
-                                        str(task))
-                else:
-                    dump = None
-                datahash = task_meta.signature(dump=dump)
-            except oelite.meta.ExpansionError as e:
-                e.msg += " in %s"%(task)
-                raise
+                datahash = datahashes[task]
+            except KeyError:
+                datahash = self.task_datahash(task)
+            if sigcache:
+                sigcache.set(task, datahash)
 
             hasher = hashlib.md5()
             hasher.update(str(sorted(dephashes.values())))
@@ -440,6 +514,13 @@ class OEliteBaker:
                 print "  %s"%(task)
             die("Unable to handle circular task dependencies")
 
+        start = datetime.datetime.now()
+        if sigcache:
+            sigcache.save()
+
+        if self.options.verify_datahashes:
+            self.verify_datahashes(datahashes)
+
         self.runq.set_task_build_on_nostamp_tasks()
         self.runq.set_task_build_on_retired_tasks()
         self.runq.set_task_build_on_hashdiff()
@@ -505,6 +586,8 @@ class OEliteBaker:
         self.runq.prune_runq_depends_nobuild()
         self.runq.prune_runq_depends_with_nobody_depending_on_it()
         self.runq.prune_runq_tasks()
+        if self.debug:
+            timing_info("Pruning runqueue", start)
 
         remaining = self.runq.number_of_tasks_to_build()
         debug("%d tasks remains"%remaining)
@@ -512,6 +595,7 @@ class OEliteBaker:
         recipes = self.runq.get_recipes_with_tasks_to_build()
         if not recipes:
             info("Nothing to do")
+            self.save_fingerprint()
             return 0
 
         if self.options.rmwork:
@@ -530,6 +614,11 @@ class OEliteBaker:
             debug("%d tasks remains after adding rmwork"%remaining)
             recipes = self.runq.get_recipes_with_tasks_to_build()
 
+        self.buildstats = oelite.buildstats.BuildStats(
+            self.config.get("BUILDSTATS_DB", True))
+        if schedule == "critical-path":
+            self.runq.set_task_priorities(self.buildstats.estimate)
+
         print "The following will be build:"
         text = []
         for recipe in recipes:
@@ -562,47 +651,217 @@ class OEliteBaker:
                     info("Maybe next time")
                     return 0
 
+        jobs = self.options.jobs
+        if jobs is None:
+            jobs = int(self.config.get("BAKE_JOBS", True) or "1")
+        if jobs < 1:
+            die("invalid number of jobs: %d"%(jobs))
+
         # FIXME: add some kind of statistics, with total_tasks,
         # prebaked_tasks, running_tasks, failed_tasks, done_tasks
-        task = self.runq.get_runabletask()
+        pools = {}
+        for pool in (self.config.get("BAKE_POOLS", True) or "").split():
+            try:
+                (pool, limit) = pool.split(":")
+                pools[pool] = int(limit)
+            except ValueError:
+                die("invalid BAKE_POOLS entry: %s"%(pool))
+            if pools[pool] < 1:
+                die("invalid BAKE_POOLS limit: %s"%(pool))
+
+        jobserver = None
+        if jobs > 1 and cpus > 1:
+            jobserver = oelite.jobserver.JobServer(cpus - 1)
+
+        max_load = self.config.get("BAKE_MAX_LOAD", True) or None
+        if max_load is not None:
+            try:
+                max_load = float(max_load)
+            except ValueError:
+                die("invalid BAKE_MAX_LOAD: %s"%(max_load))
+        min_memfree = self.config.get("BAKE_MIN_MEMFREE", True) or None
+        if min_memfree is not None:
+            try:
+                min_memfree = int(min_memfree) * 1024
+            except ValueError:
+                die("invalid BAKE_MIN_MEMFREE: %s"%(min_memfree))
+
+        if self.fingerprint:
+            self.fingerprint.remove()
+            if self.runq.has_nostamp_tasks_to_build():
+                self.fingerprint = None
+
+        executor = oelite.executor.OEliteExecutor(
+            self, jobs, pools, jobserver, max_load, min_memfree)
         start = datetime.datetime.now()
-        total = self.runq.number_of_tasks_to_build()
-        count = 0
-        exitcode = 0
-        failed_task_list = []
-        while task:
-            count += 1
-            debug("")
-            debug("Preparing %s"%(task))
-            task.prepare(self.runq)
-            meta = task.meta()
-            info("Running %d / %d %s"%(count, total, task))
-            task.build_started()
-            if self.options.fake_build or task.run():
-                task.build_done(self.runq.get_task_buildhash(task))
-                self.runq.mark_done(task)
-            else:
-                err("%s failed"%(task))
-                exitcode = 1
-                failed_task_list.append(task)
-                task.build_failed()
-                # FIXME: support command-line option to abort on first
-                # failed task
-            task = self.runq.get_runabletask()
+        failed_task_list = executor.run()
         timing_info("Build", start)
+        if jobserver:
+            jobserver.close()
+
+        exitcode = 0
+        if failed_task_list or executor.interrupted:
+            exitcode = 1
 
         if exitcode:
-             for task in failed_task_list:
-                print "\nERROR: %s failed  %s"%(task,task.logfn)
+            for task in failed_task_list:
+                logfn = getattr(task, "logfn", None)
+                print "\nERROR: %s failed  %s"%(task, logfn)
+                if not logfn or not os.path.exists(logfn):
+                    continue
                 if self.debug_loglines:
                     with open(task.logfn, 'r') as fin:
                         if self.debug_loglines < 0:
                             print fin.read()
                         else:
                             print ''.join(fin.readlines()[-self.debug_loglines:])
+            if executor.interrupted:
+                err("Build interrupted")
+        else:
+            self.save_fingerprint()
         return exitcode
 
 
+    def save_fingerprint(self):
+        if not self.fingerprint:
+            return
+        mtimes = set(self.config.get_input_mtimes())
+        for recipe in self.cookbook.recipes.values():
+            mtimes.update(recipe.meta.get_input_mtimes())
+        filenames = self.runq.get_package_filenames()
+        for task in self.runq.get_tasks():
+            if not task.nostamp:
+                filenames.add(task.stampfile_path()[1])
+        self.fingerprint.save(self.cookbook.list_recipefiles(),
+                              mtimes, filenames)
+        return
+
+
+    def get_cpus(self):
+        cpus = self.config.get("BAKE_CPUS", True)
+        if not cpus:
+            return oelite.jobserver.cpu_count()
+        try:
+            cpus = int(cpus)
+        except ValueError:
+            die("invalid BAKE_CPUS: %s"%(cpus))
+        if cpus < 1:
+            die("invalid BAKE_CPUS: %d"%(cpus))
+        return cpus
+
+
+    def mem_report(self):
+        """Report memory used for the metadata of all recipes, both with
+        objects shared between recipes counted once, and as if nothing
+        was shared."""
+        seen = set()
+        shared = 0
+        unshared = 0
+        recipes = self.cookbook.recipes.values()
+        for recipe in recipes:
+            for data in (recipe.meta.dict, recipe.meta.expand_cache):
+                shared += oelite.util.sizeof(data, seen)
+                unshared += oelite.util.sizeof(data)
+        count = max(len(recipes), 1)
+        info("Recipe metadata: %d recipes, %d MB (%d kB per recipe)"%(
+                len(recipes), shared / 1024 / 1024, shared / 1024 / count))
+        info("Recipe metadata without sharing: %d MB (%d kB per recipe)"%(
+                unshared / 1024 / 1024, unshared / 1024 / count))
+        info("Peak memory usage: %d MB"%(oelite.util.maxrss() / 1024))
+        return
+
+
+    def task_datahash(self, task):
+        recipe = task.recipe
+        try:
+            recipe_extra_arch = recipe.meta.get("EXTRA_ARCH")
+        except oelite.meta.ExpansionError as e:
+            e.msg += " in %s"%(task)
+            raise
+        task_meta = task.meta()
+        # FIXME: is this really needed?  How should the task metadata be
+        # changed at this point?  isn't it created from recipe meta by the
+        # task.meta() call above?
+        if (recipe_extra_arch and
+            task_meta.get("EXTRA_ARCH") != recipe_extra_arch):
+            task_meta.set("EXTRA_ARCH", recipe_extra_arch)
+        try:
+            if self.options.dump_signature_metadata:
+                self.normpath(task.recipe.filename)
+                dump = os.path.join(self.options.dump_signature_metadata,
+                                    self.normpath(task.recipe.filename),
+                                    str(task))
+            else:
+                dump = None
+            return task_meta.signature(dump=dump,
+                                       cache=self.signature_cache,
+                                       base=recipe.meta)
+        except oelite.meta.ExpansionError as e:
+            e.msg += " in %s"%(task)
+            raise
+
+
+    def calculate_datahashes(self, tasks, processes):
+        """Calculate data hashes of tasks in up to processes worker
+        processes, as they do not depend on each other.  Returns dict of
+        task -> datahash.  Tasks failing are left out, so that they are
+        retried (and the error reported) in the metadata hash
+        calculation loop."""
+        if processes < 2 or len(tasks) < 2:
+            return {}
+        # Hand out all tasks of a recipe to the same worker process, so
+        # that the variables shared by the tasks are found in the
+        # signature cache of the worker.
+        recipe_tasks = {}
+        recipes = []
+        for task in tasks:
+            if not task.recipe in recipe_tasks:
+                recipe_tasks[task.recipe] = []
+                recipes.append(task.recipe)
+            recipe_tasks[task.recipe].append(task)
+        def recipe_datahashes(recipe):
+            datahashes = []
+            for task in recipe_tasks[recipe]:
+                try:
+                    datahashes.append(self.task_datahash(task))
+                except Exception:
+                    datahashes.append(None)
+            return datahashes
+        msg = "Calculating task data hashes"
+        def progress(count):
+            oelite.util.progress_info(msg, len(recipes), count)
+        progress(0)
+        results = oelite.util.fork_map(recipe_datahashes, recipes, processes,
+                                       progress)
+        datahashes = {}
+        for (recipe, (success, hashes)) in zip(recipes, results):
+            if not success:
+                continue
+            for (task, datahash) in zip(recipe_tasks[recipe], hashes):
+                if datahash is not None:
+                    datahashes[task] = datahash
+        if len(datahashes) != len(tasks):
+            progress(len(recipes))
+        return datahashes
+
+
+    def verify_datahashes(self, datahashes):
+        """Verify that data hashes calculated in worker processes (or
+        found in the signature cache) are identical to the ones
+        calculated in this process."""
+        mismatches = 0
+        for (task, datahash) in datahashes.items():
+            serial_datahash = self.task_datahash(task)
+            if datahash != serial_datahash:
+                err("data hash mismatch for %s: %s != %s"%(
+                        task, datahash, serial_datahash))
+                mismatches += 1
+        if mismatches:
+            die("%d of %d data hashes differ"%(mismatches, len(datahashes)))
+        info("Verified %d data hashes"%(len(datahashes)))
+        return
+
+
     def setup_tmpdir(self):
 
         tmpdir = os.path.realpath(self.config.get("TMPDIR", 1) or "tmp")
@@ -0,0 +1,104 @@
+from oebakery import die, err, warn, info, debug
+import oelite.util
+
+import os
+from pysqlite2 import dbapi2 as sqlite
+
+
+# Duration estimate used for tasks never run before, and of a task
+# type never run before.
+DEFAULT_DURATION = 1.0
+
+
+class BuildStats:
+
+    """Persistent statistics of previously run tasks.
+
+    Tasks are identified by recipe type and name (but not version, so
+    that estimates survive version bumps) and task name.
+    """
+
+    def __init__(self, dbfile):
+        oelite.util.makedirs(os.path.dirname(dbfile))
+        self.db = sqlite.connect(dbfile)
+        self.db.text_factory = str
+        self.dbc = self.db.cursor()
+        self.dbc.execute(
+            "CREATE TABLE IF NOT EXISTS task ( "
+            "recipe      TEXT, "
+            "task        TEXT, "
+            "duration    REAL, "
+            "runs        INTEGER, "
+            "maxrss      INTEGER, "
+            "UNIQUE (recipe, task) ON CONFLICT REPLACE )")
+        columns = [row[1] for row in self.dbc.execute(
+                "PRAGMA table_info(task)")]
+        if not "maxrss" in columns:
+            self.dbc.execute("ALTER TABLE task ADD COLUMN maxrss INTEGER")
+        self.db.commit()
+        self.durations = {}
+        self.maxrss = {}
+        task_durations = {}
+        for (recipe, task, duration, runs, maxrss) in self.dbc.execute(
+            "SELECT recipe, task, duration, runs, maxrss FROM task"):
+            self.durations[(recipe, task)] = (duration, runs)
+            if maxrss is not None:
+                self.maxrss[(recipe, task)] = maxrss
+            try:
+                task_durations[task].append(duration)
+            except KeyError:
+                task_durations[task] = [duration]
+        self.task_durations = {}
+        for (task, durations) in task_durations.items():
+            self.task_durations[task] = sum(durations) / len(durations)
+        return
+
+
+    def key(self, task):
+        return ("%s:%s"%(task.recipe.type, task.recipe.name), task.name)
+
+
+    def estimate(self, task):
+        """Return estimated duration of task in seconds."""
+        try:
+            return self.durations[self.key(task)][0]
+        except KeyError:
+            pass
+        try:
+            return self.task_durations[task.name]
+        except KeyError:
+            return DEFAULT_DURATION
+
+
+    def estimate_maxrss(self, task):
+        """Return estimated peak memory usage (resident set size) of
+        task in kB, or None if not known."""
+        return self.maxrss.get(self.key(task))
+
+
+    def record(self, task, duration, maxrss=None):
+        """Record duration and peak memory usage (in kB) of a succesful
+        run of task.  The duration estimate is the average of the
+        previous estimate and the latest duration, so that it follows
+        changes to the recipe.  The memory estimate is the latest peak
+        memory usage, or the average when it is lower than the previous
+        estimate, so that it does not underestimate."""
+        key = self.key(task)
+        try:
+            (old_duration, runs) = self.durations[key]
+            duration = (old_duration + duration) / 2
+        except KeyError:
+            runs = 0
+        self.durations[key] = (duration, runs + 1)
+        old_maxrss = self.maxrss.get(key)
+        if maxrss is None:
+            maxrss = old_maxrss
+        elif old_maxrss is not None and maxrss < old_maxrss:
+            maxrss = (old_maxrss + maxrss) / 2
+        if maxrss is not None:
+            self.maxrss[key] = maxrss
+        self.dbc.execute(
+            "INSERT INTO task (recipe, task, duration, runs, maxrss) "
+            "VALUES (?, ?, ?, ?, ?)", key + (duration, runs + 1, maxrss))
+        self.db.commit()
+        return
@@ -26,7 +26,7 @@ def parse_args(options, args):
 
 def run(options, args, config):
     try:
-        baker = oelite.baker.OEliteBaker(options, args, config)
+        baker = oelite.baker.OEliteBaker(options, args, config, fastpath=True)
     except oelite.parse.ParseError as e:
         print "\nParse error"
         e.print_details()
@@ -4,6 +4,7 @@ from oelite import *
 from oelite.dbutil import *
 import oelite.parse
 import oelite.util
+import oelite.recipe
 from recipe import OEliteRecipe
 from item import OEliteItem
 import oelite.meta
@@ -16,6 +17,8 @@ import os
 import glob
 import inspect
 import re
+import cPickle
+import cStringIO
 from types import *
 from pysqlite2 import dbapi2 as sqlite
 from collections import Mapping
@@ -39,8 +42,29 @@ class CookBook(Mapping):
         self.tasks = {}
         self.cachedir = self.config.get("CACHEDIR") or ""
         self.debug = self.baker.debug
+        self.meta_cache = oelite.meta.MetaCache(
+            os.path.join(self.cachedir, "cookbook.db"),
+            self.config.env_signature())
         fail = False
         recipefiles = self.list_recipefiles()
+        if self.meta_cache.created:
+            # the old per-recipe file cache stored the pickled recipes
+            # of recipe files outside TOPDIR next to the recipe files
+            for recipefile in recipefiles:
+                if (os.path.isabs(self.shortfilename(recipefile)) and
+                    os.path.exists(recipefile + ".p")):
+                    oelite.meta.cache.remove_old_cachefile(
+                        recipefile + ".p")
+        parsed = {}
+        jobs = getattr(baker.options, "jobs", None) or baker.get_cpus()
+        if jobs > 1:
+            try:
+                parsed = self.parse_recipefiles(recipefiles, jobs)
+            except KeyboardInterrupt:
+                if os.isatty(sys.stdout.fileno()) and not self.debug:
+                    print
+                self.meta_cache.commit()
+                die("Aborted while building cookbook")
         total = len(recipefiles)
         count = 0
         for recipefile in recipefiles:
@@ -52,11 +76,16 @@ class CookBook(Mapping):
                 oelite.util.progress_info("Adding recipes to cookbook",
                                           total, count)
             try:
-                if not self.add_recipefile(recipefile):
+                if recipefile in parsed:
+                    if not self.add_parsed_recipefile(
+                        recipefile, parsed[recipefile]):
+                        fail = True
+                elif not self.add_recipefile(recipefile):
                     fail = True
             except KeyboardInterrupt:
                 if os.isatty(sys.stdout.fileno()) and not self.debug:
                     print
+                self.meta_cache.commit()
                 die("Aborted while building cookbook")
             except oelite.parse.ParseError, e:
                 if os.isatty(sys.stdout.fileno()) and not self.debug:
@@ -72,6 +101,8 @@ class CookBook(Mapping):
                 err("Uncaught Python exception in %s"%(
                         self.shortfilename(recipefile)))
                 fail = True
+        self.meta_cache.commit()
+        oelite.meta.dict.clear_shared()
         if fail:
             die("Errors while adding recipes to cookbook")
 
@@ -509,30 +540,7 @@ class CookBook(Mapping):
 
 
     def list_recipefiles(self, sort=True):
-        OERECIPES = (self.config["OERECIPES"] or "").split(":")
-        if not OERECIPES:
-            die("OERECIPES not defined")
-        files = []
-        for f in OERECIPES:
-            if os.path.isdir(f):
-                dirfiles = find_recipoefiles(f)
-                files.append(dirfiles)
-            elif os.path.isfile(f):
-                files.append(f)
-            else:
-                for file in glob.iglob(f):
-                    files.append(file)
-
-        oerecipes = []
-        for f in files:
-            if f.endswith(".oe"):
-                oerecipes.append(f)
-            else:
-                warn("skipping %s: unknown file extension"%(f))
-
-        if sort:
-            oerecipes.sort()
-        return oerecipes
+        return list_recipefiles(self.config, sort)
 
 
     def shortfilename(self, filename):
@@ -541,48 +549,147 @@ class CookBook(Mapping):
         return filename
 
 
-    def cachefilename(self, recipefile):
-        recipefile = self.shortfilename(recipefile)
-        return os.path.join(self.cachedir, recipefile + ".p")
+    def parse_recipefiles(self, recipefiles, processes):
+        """Parse recipe files without a current metadata cache in up to
+        processes worker processes.
 
+        Returns dict of filename -> (recipes, output, error), where
+        recipes is the pickled recipes of the file (or None if parsing
+        failed), output is the (stdout, stderr) output of parsing it,
+        and error is the error message to report for it (or None).
+        Output and errors are reported, and the metadata cache is
+        written, by add_parsed_recipefile(), so that it is done in the
+        order the recipe files are added to the cookbook, and only by
+        this process.
 
-    def add_recipefile(self, filename):
-        cachefile = self.cachefilename(filename)
+        Hooks run in the worker processes only affect the recipe
+        metadata.  The hook timing and python code cache statistics of
+        parsing each file are passed back and added to the statistics
+        of this process.
+        """
+        recipefiles = [recipefile for recipefile in recipefiles
+                       if not self.meta_cache.is_current(recipefile)]
+        if len(recipefiles) < 2:
+            return {}
+        def parse(filename):
+            oelite.pyexec.reset_stats()
+            (stdout, stderr) = (sys.stdout, sys.stderr)
+            sys.stdout = cStringIO.StringIO()
+            sys.stderr = cStringIO.StringIO()
+            recipes = None
+            error = None
+            try:
+                try:
+                    recipes = self.parse_recipefile(filename)
+                    if recipes is not None:
+                        recipes = pickle_recipes(recipes)
+                except oelite.parse.ParseError, e:
+                    e.print_details()
+                    error = "Parse error in %s"%(
+                        self.shortfilename(filename))
+                except Exception, e:
+                    import traceback
+                    traceback.print_exc()
+                    error = "Uncaught Python exception in %s"%(
+                        self.shortfilename(filename))
+                output = (sys.stdout.getvalue(), sys.stderr.getvalue())
+            finally:
+                (sys.stdout, sys.stderr) = (stdout, stderr)
+            return (recipes, output, error, oelite.pyexec.get_stats())
+        msg = "Parsing recipes"
+        def progress(count):
+            if not self.debug:
+                oelite.util.progress_info(msg, len(recipefiles), count)
+        if self.debug:
+            debug("Parsing %d recipe files in %d processes"%(
+                    len(recipefiles), processes))
+        progress(0)
+        results = oelite.util.fork_map(parse, recipefiles, processes,
+                                       progress)
+        parsed = {}
+        for (recipefile, (success, result)) in zip(recipefiles, results):
+            if success:
+                oelite.pyexec.add_stats(result[3])
+                parsed[recipefile] = result[:3]
+        if len(parsed) != len(recipefiles):
+            progress(len(recipefiles))
+        return parsed
+
+
+    def add_parsed_recipefile(self, filename, parsed):
+        (data, (stdout, stderr), error) = parsed
+        sys.stdout.write(stdout)
+        sys.stderr.write(stderr)
+        if error:
+            err(error)
+            return False
+        if data is None:
+            print "ERROR: parsing %s failed"%(filename)
+            return False
+        recipes = unpickle_recipes(data, filename, self)
+        self.cache_recipes(filename, recipes, data)
+        self.add_recipes(recipes)
+        return True
 
+
+    def add_recipefile(self, filename):
         recipes = None
-        if os.path.exists(cachefile):
+        data = self.meta_cache.load(filename)
+        if data is not None:
             try:
-                meta_cache = oelite.meta.MetaCache(cachefile)
-                if meta_cache.is_current(self.baker):
-                    recipes = meta_cache.load(filename, self)
+                recipes = unpickle_recipes(data, filename, self)
             except:
-                print "Ignoring bad metadata cache:", cachefile
+                print "Ignoring bad metadata cache of", filename
 
         if recipes is None:
-            recipe_meta = self.parse_recipe(filename)
-            if recipe_meta is False:
+            recipes = self.parse_recipefile(filename)
+            if recipes is None:
                 print "ERROR: parsing %s failed"%(filename)
                 return False
-            recipes = {}
-            is_cacheable = True
-            for recipe_type in recipe_meta:
-                recipe = OEliteRecipe(filename, recipe_type,
-                                      recipe_meta[recipe_type], self)
-                recipe.post_parse()
-                recipes[recipe_type] = recipe
-                is_cacheable = is_cacheable and recipe.is_cacheable()
-            if is_cacheable:
-                meta_cache = oelite.meta.MetaCache(cachefile, recipes,
-                                                   self.baker)
-            elif os.path.exists(cachefile):
-                os.remove(cachefile)
-
-        for recipe_type in recipes:
+            self.cache_recipes(filename, recipes)
+
+        self.add_recipes(recipes)
+        return True
+
+
+    def parse_recipefile(self, filename):
+        """Parse recipe file.  Returns dict of recipe type -> recipe, or
+        None if parsing failed."""
+        recipe_meta = self.parse_recipe(filename)
+        if recipe_meta is False:
+            return None
+        recipes = {}
+        for recipe_type in recipe_meta:
+            recipe = OEliteRecipe(filename, recipe_type,
+                                  recipe_meta[recipe_type], self)
+            recipe.post_parse()
+            recipes[recipe_type] = recipe
+        return recipes
+
+
+    def cache_recipes(self, filename, recipes, data=None):
+        """Write the recipes parsed from recipe file to the metadata
+        cache, or remove the recipe file from the cache if any of the
+        recipes are not cacheable.  data is the already pickled recipes,
+        if available."""
+        mtimes = set()
+        for recipe in recipes.itervalues():
+            if not recipe.is_cacheable():
+                self.meta_cache.remove(filename)
+                return
+            mtimes.update(recipe.meta.get_input_mtimes())
+        if data is None:
+            data = pickle_recipes(recipes)
+        self.meta_cache.store(filename, data, mtimes)
+        return
+
+
+    def add_recipes(self, recipes):
+        for recipe_type in sorted(recipes):
             oelite.pyexec.exechooks(recipes[recipe_type].meta,
                                     "pre_cookbook")
             self.add_recipe(recipes[recipe_type])
-
-        return True
+        return
 
 
     def parse_recipe(self, recipe):
@@ -842,3 +949,47 @@ class CookBook(Mapping):
             "SELECT item FROM package_depend "
             "WHERE deptype IN (%s) "%(",".join("?" for i in deptypes)) +
             "AND package=?", (deptypes + [package.id])))
+
+
+def pickle_recipes(recipes):
+    file = cStringIO.StringIO()
+    cPickle.dump(len(recipes), file, 2)
+    for recipe_type in sorted(recipes):
+        recipes[recipe_type].pickle(file)
+    return file.getvalue()
+
+
+def unpickle_recipes(data, filename, cookbook):
+    file = cStringIO.StringIO(data)
+    recipes = {}
+    for i in xrange(cPickle.load(file)):
+        recipe = oelite.recipe.unpickle(file, filename, cookbook)
+        recipes[recipe.type] = recipe
+    return recipes
+
+
+def list_recipefiles(config, sort=True):
+    OERECIPES = (config["OERECIPES"] or "").split(":")
+    if not OERECIPES:
+        die("OERECIPES not defined")
+    files = []
+    for f in OERECIPES:
+        if os.path.isdir(f):
+            dirfiles = find_recipoefiles(f)
+            files.append(dirfiles)
+        elif os.path.isfile(f):
+            files.append(f)
+        else:
+            for file in glob.iglob(f):
+                files.append(file)
+
+    oerecipes = []
+    for f in files:
+        if f.endswith(".oe"):
+            oerecipes.append(f)
+        else:
+            warn("skipping %s: unknown file extension"%(f))
+
+    if sort:
+        oerecipes.sort()
+    return oerecipes
@@ -0,0 +1,374 @@
+from oebakery import die, err, warn, info, debug
+
+import sys
+import os
+import errno
+import signal
+import traceback
+import time
+
+
+def loadavg():
+    """Return the 1 minute load average, or None if not available."""
+    try:
+        return os.getloadavg()[0]
+    except (OSError, AttributeError):
+        return None
+
+
+def memavail():
+    """Return available memory in kB, or None if not available."""
+    meminfo = {}
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                (name, value) = line.split(":", 1)
+                meminfo[name] = int(value.split()[0])
+    except (IOError, ValueError):
+        return None
+    if "MemAvailable" in meminfo:
+        return meminfo["MemAvailable"]
+    try:
+        return meminfo["MemFree"] + meminfo["Buffers"] + meminfo["Cached"]
+    except KeyError:
+        return None
+
+
+def pgrp_rss(pgrps):
+    """Return dictionary with the total memory usage (resident set size)
+    in kB of the processes in each of the process groups pgrps, or an
+    empty dictionary if not available."""
+    rss = dict.fromkeys(pgrps, 0)
+    try:
+        pids = os.listdir("/proc")
+        page_size = os.sysconf("SC_PAGE_SIZE") / 1024
+    except (OSError, ValueError):
+        return {}
+    for pid in pids:
+        if not pid.isdigit():
+            continue
+        try:
+            with open("/proc/%s/stat"%(pid)) as f:
+                stat = f.read()
+        except IOError:
+            continue
+        # skip past the command name, which may contain spaces
+        fields = stat[stat.rfind(")") + 2:].split()
+        try:
+            pgrp = int(fields[2])
+            if pgrp in rss:
+                rss[pgrp] += int(fields[21]) * page_size
+        except (IndexError, ValueError):
+            continue
+    return rss
+
+
+class OEliteExecutor:
+
+    """Run the tasks of a prepared runq, with up to jobs tasks at a time.
+
+    With more than one job, each task is run in a forked worker
+    process, so that the stdin/stdout/stderr redirection done by
+    OEliteTask.run() only affects that worker.  All runq and stamp
+    bookkeeping is done in the main process.
+
+    Tasks are run in resource pools, as specified by the task pool
+    flag.  The default pool (DEFAULT_POOL) is limited to jobs tasks,
+    and other pools can be given their own limits, so that fx. network
+    bound tasks can run alongside CPU bound tasks.  Tasks in a pool
+    without a limit are run in the default pool.
+
+    When given a jobserver, make and scons in the tasks listed in
+    MAKE_JOBSERVER draw their parallel jobs from it, so that the number
+    of running compiler processes does not depend on how many compile
+    tasks happen to be running at the same time.
+
+    New tasks are held back while the load average is above max_load,
+    or while available memory is below min_memfree kB.  As available
+    memory already excludes the memory currently used by the running
+    tasks, only the part of their recorded peak memory usage which
+    they do not use yet is subtracted from it, together with the
+    recorded peak memory usage of the task to start.  A task is always
+    started when no other tasks are running.
+
+    The memory usage of a task is that of all processes in its process
+    group.  While min_memfree is set, it is sampled from /proc about
+    once a second, so that fx. the combined memory usage of the
+    compilers started by make -j is recorded.  Otherwise, only the peak
+    memory usage of the largest single process of the task is known (as
+    reported by wait4()), which is a (possibly large) underestimate for
+    tasks running processes in parallel.
+    """
+
+    DEFAULT_POOL = "cpu"
+
+    def __init__(self, baker, jobs=1, pools={}, jobserver=None,
+                 max_load=None, min_memfree=None):
+        self.baker = baker
+        self.jobserver = jobserver
+        self.max_load = max_load
+        self.min_memfree = min_memfree
+        self.throttled = False
+        self.throttle_reason = None
+        self.runq = baker.runq
+        self.jobs = max(jobs or 1, 1)
+        self.pools = pools.copy()
+        self.pools[self.DEFAULT_POOL] = self.jobs
+        self.inline = sum(self.pools.values()) == 1
+        self.pool_running = dict.fromkeys(self.pools, 0)
+        self.fake_build = baker.options.fake_build
+        self.buildstats = baker.buildstats
+        self.running = {}
+        self.peak_rss = {}
+        self.started = {}
+        self.task_pool = {}
+        # task -> pool, see get_pool()
+        self.pool_of = {}
+        self.failed = []
+        self.interrupted = False
+        self.count = 0
+        self.total = 0
+        return
+
+
+    def run(self):
+        """Run all tasks to build, returning the list of failed tasks."""
+        self.total = self.runq.number_of_tasks_to_build()
+        try:
+            while True:
+                self.dispatch()
+                if not self.running:
+                    break
+                self.wait(poll=(self.throttled or
+                                self.min_memfree is not None))
+        except KeyboardInterrupt:
+            self.interrupted = True
+            if self.running:
+                print ""
+                info("Interrupted, waiting for %d running task(s)"%(
+                        len(self.running)))
+            self.drain()
+        return self.failed
+
+
+    def dispatch(self):
+        """Start as many runable tasks as the pools allow, in schedule
+        order.  Runable tasks in a full pool are skipped over, but left
+        in the runq, so that they keep their place in the schedule."""
+        self.throttled = False
+        while True:
+            free_pools = self.free_pools()
+            if not free_pools:
+                break
+            task = self.runq.get_runabletask(
+                lambda task: self.get_pool(task) in free_pools)
+            if not task:
+                break
+            if not self.try_start(task):
+                break
+        return
+
+
+    def free_pools(self):
+        """Return set of pools with a free slot."""
+        return set([pool for pool in self.pools
+                    if self.pool_running[pool] < self.pools[pool]])
+
+
+    def get_pool(self, task):
+        try:
+            return self.pool_of[task]
+        except KeyError:
+            pass
+        pool = task.get_pool()
+        if not pool in self.pools:
+            pool = self.DEFAULT_POOL
+        self.pool_of[task] = pool
+        return pool
+
+
+    def try_start(self, task):
+        if self.running and not self.admit(task):
+            self.runq.put_runabletask(task)
+            self.throttled = True
+            return False
+        self.throttle_reason = None
+        self.start(task, self.get_pool(task))
+        return True
+
+
+    def admit(self, task):
+        """Return True if load and memory allows starting task now."""
+        reason = None
+        if self.max_load is not None:
+            load = loadavg()
+            if load is not None and load > self.max_load:
+                reason = "load average %.1f"%(load)
+        if reason is None and self.min_memfree is not None:
+            available = memavail()
+            if available is not None:
+                rss = self.sample_rss()
+                for (pid, running) in self.running.items():
+                    estimate = self.buildstats.estimate_maxrss(running) or 0
+                    available -= max(0, estimate - rss.get(pid, 0))
+                available -= self.buildstats.estimate_maxrss(task) or 0
+                if available < self.min_memfree:
+                    reason = "available memory %d MB"%(available / 1024)
+        if reason is None:
+            return True
+        if reason != self.throttle_reason:
+            debug("Holding back %s: %s"%(task, reason))
+            self.throttle_reason = reason
+        return False
+
+
+    def sample_rss(self):
+        """Return dictionary with the current memory usage in kB of each
+        running task (by pid), and update their peak memory usage."""
+        rss = pgrp_rss(self.running.keys())
+        for (pid, kb) in rss.iteritems():
+            if kb > self.peak_rss.get(pid, 0):
+                self.peak_rss[pid] = kb
+        return rss
+
+
+    def start(self, task, pool=DEFAULT_POOL):
+        self.count += 1
+        debug("")
+        debug("Preparing %s"%(task))
+        task.prepare(self.runq)
+        if self.jobserver:
+            self.jobserver.setup(task, task.meta())
+        info("Running %d / %d %s"%(self.count, self.total, task))
+        task.build_started()
+        if self.fake_build:
+            self.done(task, True)
+            return
+        self.started[task] = time.time()
+        if self.inline:
+            try:
+                success = task.run()
+            except KeyboardInterrupt:
+                self.done(task, False)
+                raise
+            self.done(task, success)
+            return
+        self.runq.set_task_running(task)
+        sys.stdout.flush()
+        sys.stderr.flush()
+        pid = os.fork()
+        if pid == 0:
+            self.worker(task)
+        # also done in the worker, whichever runs first
+        try:
+            os.setpgid(pid, pid)
+        except OSError:
+            pass
+        task.logfn = task.logfile_path(pid)[0]
+        self.running[pid] = task
+        self.task_pool[task] = pool
+        self.pool_running[pool] += 1
+        return
+
+
+    def worker(self, task):
+        # Never return from here, and never run any of the cleanup
+        # handlers inherited from the main process.
+        exitcode = 1
+        try:
+            try:
+                # Run the task (and all processes started by it) in its
+                # own process group, so that an interrupt from the
+                # terminal only reaches the main process, which lets
+                # running tasks finish.
+                os.setpgid(0, 0)
+                if task.run():
+                    exitcode = 0
+            except KeyboardInterrupt:
+                pass
+            except Exception:
+                traceback.print_exc()
+        finally:
+            try:
+                sys.stdout.flush()
+                sys.stderr.flush()
+            finally:
+                os._exit(exitcode)
+
+
+    def wait(self, poll=False):
+        """Wait for a running task to finish.  With poll, only wait up
+        to a second, so that throttled tasks can be started when load
+        or memory allows it, returning None if no task has finished."""
+        if self.min_memfree is not None:
+            self.sample_rss()
+        if poll:
+            options = os.WNOHANG
+            deadline = time.time() + 1
+        else:
+            options = 0
+        while True:
+            try:
+                (pid, status, rusage) = os.wait4(-1, options)
+            except OSError, e:
+                if e.errno == errno.EINTR:
+                    continue
+                if e.errno == errno.ECHILD:
+                    die("lost track of %d running task(s)"%(
+                            len(self.running)))
+                raise
+            if pid == 0:
+                if time.time() >= deadline:
+                    return None
+                time.sleep(0.1)
+                continue
+            try:
+                task = self.running.pop(pid)
+            except KeyError:
+                continue
+            break
+        success = os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0
+        maxrss = max(rusage.ru_maxrss, self.peak_rss.pop(pid, 0))
+        self.done(task, success, maxrss)
+        return task
+
+
+    def drain(self):
+        """Wait for all running tasks to finish, without starting new
+        ones.  A second interrupt terminates the running tasks, and
+        all processes started by them."""
+        terminated = False
+        while self.running:
+            try:
+                self.wait()
+            except KeyboardInterrupt:
+                if terminated:
+                    continue
+                warn("Terminating %d running task(s)"%(len(self.running)))
+                for pid in self.running:
+                    try:
+                        os.killpg(pid, signal.SIGTERM)
+                    except OSError:
+                        pass
+                terminated = True
+        return
+
+
+    def done(self, task, success, maxrss=None):
+        started = self.started.pop(task, None)
+        pool = self.task_pool.pop(task, None)
+        self.pool_of.pop(task, None)
+        if pool is not None:
+            self.pool_running[pool] -= 1
+        if self.jobserver and not self.running:
+            self.jobserver.refill()
+        if success:
+            task.build_done(self.runq.get_task_buildhash(task))
+            self.runq.mark_done(task)
+            if started is not None:
+                self.buildstats.record(task, time.time() - started, maxrss)
+        else:
+            err("%s failed"%(task))
+            self.failed.append(task)
+            task.build_failed()
+        return
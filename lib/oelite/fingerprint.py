@@ -0,0 +1,86 @@
+from oebakery import die, err, warn, info, debug
+import oelite.util
+import oelite.path
+from oelite.meta.cache import pickle_abi
+
+import os
+import cPickle
+import hashlib
+
+
+def getmtime(filename):
+    try:
+        return os.stat(filename).st_mtime
+    except OSError:
+        return None
+
+
+class BuildFingerprint:
+
+    """Fingerprint of the state left behind by a successful bake.
+
+    The fingerprint holds the bake arguments and options, the
+    environment signature, the list of recipe files, the mtimes of all
+    recipe input files (conf files, classes, includes, recipes and
+    local source files), and the mtimes of all stamp and package files
+    of the runqueue.  When a later bake with the same arguments finds
+    all of these unchanged, it would have nothing to do, so parsing of
+    recipes and building of the runqueue can be skipped altogether.
+
+    A fingerprint file is kept for each set of arguments, so that
+    alternating between fx. building different images does not
+    invalidate the fingerprints of each other.
+    """
+
+    def __init__(self, cachedir, key):
+        self.key = key
+        self.filename = os.path.join(
+            cachedir, hashlib.md5(repr(key)).hexdigest())
+        return
+
+
+    def check(self, recipefiles):
+        """Return True if the fingerprint is unchanged."""
+        try:
+            with open(self.filename) as file:
+                if cPickle.load(file) != pickle_abi():
+                    return False
+                if cPickle.load(file) != self.key:
+                    return False
+                (old_recipefiles, mtimes, files) = cPickle.load(file)
+        except Exception:
+            return False
+        if recipefiles != old_recipefiles:
+            debug("fingerprint: recipe files changed")
+            return False
+        for (fn, oepath, old_mtime) in mtimes:
+            if oepath is not None:
+                filepath = oelite.path.which(oepath, fn)
+            else:
+                filepath = fn
+            if getmtime(filepath) != old_mtime:
+                debug("fingerprint: %s changed"%(filepath or fn))
+                return False
+        for (filename, old_mtime) in files:
+            if getmtime(filename) != old_mtime:
+                debug("fingerprint: %s changed"%(filename))
+                return False
+        return True
+
+
+    def save(self, recipefiles, mtimes, filenames):
+        files = [(filename, getmtime(filename)) for filename in filenames]
+        oelite.util.makedirs(os.path.dirname(self.filename))
+        tmpfile = "%s.%d"%(self.filename, os.getpid())
+        with open(tmpfile, "w") as file:
+            cPickle.dump(pickle_abi(), file, 2)
+            cPickle.dump(self.key, file, 2)
+            cPickle.dump((recipefiles, mtimes, files), file, 2)
+        os.rename(tmpfile, self.filename)
+        return
+
+
+    def remove(self):
+        if os.path.exists(self.filename):
+            os.unlink(self.filename)
+        return
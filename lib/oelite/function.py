@@ -1,4 +1,5 @@
 import oelite.meta
+import oelite.util
 import oebakery
 import bb
 
@@ -8,6 +9,71 @@ import shutil
 import warnings
 import re
 
+# (OE_IMPORTS, function key) -> python function template
+python_function_cache = oelite.util.CodeCache(1000)
+
+
+def function_key(meta, function, recursion_path):
+    """Return key identifying the code of python function, and the code
+    of the functions it imports."""
+    if function in recursion_path:
+        return (function,)
+    recursion_path = recursion_path + [function]
+    imports = (meta.get_flag(function, "import", oelite.meta.FULL_EXPANSION)
+               or "").split()
+    return (function, meta.get(function, expand=False),
+            meta.get_flag(function, "args"),
+            meta.get_flag(function, "filename"),
+            meta.get_flag(function, "lineno"),
+            tuple([function_key(meta, func, recursion_path)
+                   for func in imports]))
+
+
+def function_template(meta, function, recursion_path=None):
+    """Return (function, code, imports) template of python function,
+    where code is the code object defining the function, and imports is
+    a tuple of (name, template) of the functions it imports.  Templates
+    only hold code objects, so they are cached and shared by all
+    recipes."""
+    key = (meta.pythonfunc_imports, function_key(meta, function, []))
+    template = python_function_cache.get(key)
+    if template is not None:
+        return template
+    # Don't put the empty list directly in the function definition
+    # as default arguments, as modifications of this "empty" list
+    # will be done in-place so that it will not be truly empty
+    # next time
+    if recursion_path is None:
+        recursion_path = []
+    recursion_path.append(function)
+    imports = []
+    for func in (meta.get_flag(function, "import",
+                               oelite.meta.FULL_EXPANSION)
+                 or "").split():
+        if func in [name for (name, imported) in imports]:
+            continue
+        if func in recursion_path:
+            raise Exception("circular import %s -> %s"%(recursion_path, func))
+        imports.append((func, function_template(meta, func, recursion_path)))
+    template = (function, meta.get_pythonfunc_code(function), tuple(imports))
+    python_function_cache.set(key, template)
+    return template
+
+
+def make_function(meta, template):
+    """Return a new python function from template.  The function, and
+    each function it imports, gets its own copy of the python globals
+    of meta, so that no state is shared with other functions or
+    recipes."""
+    (function, code, imports) = template
+    g = meta.get_pythonfunc_globals()
+    for (func, imported) in imports:
+        g[func] = make_function(meta, imported)
+    l = {}
+    eval(code, g, l)
+    return l[function]
+
+
 class OEliteFunction(object):
 
     def __init__(self, meta, var, name=None, tmpdir=None):
@@ -61,32 +127,13 @@ class NoopFunction(OEliteFunction):
 class PythonFunction(OEliteFunction):
 
     def __init__(self, meta, var, name=None, tmpdir=None, recursion_path=None,
-                 set_os_environ=True):
-        # Don't put the empty list directly in the function definition
-        # as default arguments, as modifications of this "empty" list
-        # will be done in-place so that it will not be truly empty
-        # next time
-        if recursion_path is None:
-            recursion_path = []
-        recursion_path.append(var)
-        funcimports = {}
-        for func in (meta.get_flag(var, "import",
-                                   oelite.meta.FULL_EXPANSION)
-                     or "").split():
-            #print "importing func", func
-            if func in funcimports:
-                continue
-            if func in recursion_path:
-                raise Exception("circular import %s -> %s"%(recursion_path, func))
-            python_function = PythonFunction(meta, func, tmpdir=tmpdir,
-                                             recursion_path=recursion_path)
-            funcimports[func] = python_function.function
-        g = meta.get_pythonfunc_globals()
-        g.update(funcimports)
-        l = {}
-        self.code = meta.get_pythonfunc_code(var)
-        eval(self.code, g, l)
-        self.function = l[var]
+                 set_os_environ=True, function=None):
+        # An already compiled function (with the same code and imports)
+        # can be given in function
+        if function is None:
+            function = make_function(
+                meta, function_template(meta, var, recursion_path))
+        self.function = function
         self.set_os_environ = set_os_environ
         super(PythonFunction, self).__init__(meta, var, name, tmpdir)
         return
@@ -0,0 +1,83 @@
+from oebakery import die, err, warn, info, debug
+
+import os
+import select
+
+
+def cpu_count():
+    try:
+        return max(os.sysconf("SC_NPROCESSORS_ONLN"), 1)
+    except (ValueError, OSError, AttributeError):
+        return 1
+
+
+class JobServer:
+
+    """GNU make jobserver shared by all tasks of a build.
+
+    The jobserver is a pipe holding one byte (token) per job that may
+    be run in addition to the one job each make process is always
+    allowed to run.  The pipe file descriptors are inherited by all
+    tasks, and make (and other tools knowing the protocol) finds them
+    in MAKEFLAGS, so that all parallel builds share the same CPU
+    budget, no matter how many tasks are running at the same time.
+    """
+
+    TOKEN = "+"
+
+    def __init__(self, tokens):
+        self.tokens = tokens
+        (self.rfd, self.wfd) = os.pipe()
+        self.fill(self.tokens)
+        return
+
+
+    def fill(self, tokens):
+        while tokens > 0:
+            tokens -= os.write(self.wfd, self.TOKEN * tokens)
+        return
+
+
+    def makeflags(self):
+        # --jobserver-fds is understood by make < 4.2, --jobserver-auth
+        # by make >= 4.2, and options not understood in MAKEFLAGS are
+        # ignored.
+        return "-j --jobserver-fds=%d,%d --jobserver-auth=%d,%d"%(
+            self.rfd, self.wfd, self.rfd, self.wfd)
+
+
+    def setup(self, task, meta):
+        """Setup task meta data for using the jobserver, if task is one
+        of the tasks listed in MAKE_JOBSERVER, and the recipe builds in
+        parallel (has a non-empty PARALLEL_MAKE)."""
+        if not task.name in (meta.get("MAKE_JOBSERVER") or "").split():
+            return False
+        if not (meta.get("PARALLEL_MAKE") or "").strip():
+            return False
+        makeflags = self.makeflags()
+        if meta.get("MAKEFLAGS"):
+            makeflags += " " + meta.get("MAKEFLAGS")
+        meta.set("MAKEFLAGS", makeflags)
+        meta.set_flag("MAKEFLAGS", "export", True)
+        meta.set("JOBSERVER_FDS", "%d,%d"%(self.rfd, self.wfd))
+        return True
+
+
+    def refill(self):
+        """Restore the number of tokens in the pipe.  Must only be
+        called when no tasks are running, and is used for recovering
+        tokens not given back by make processes that were killed."""
+        available = 0
+        while select.select([self.rfd], [], [], 0)[0]:
+            available += len(os.read(self.rfd, self.tokens))
+        if available < self.tokens:
+            debug("jobserver recovered %d token(s)"%(
+                    self.tokens - available))
+        self.fill(self.tokens)
+        return
+
+
+    def close(self):
+        os.close(self.rfd)
+        os.close(self.wfd)
+        return
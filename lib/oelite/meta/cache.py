@@ -1,3 +1,4 @@
+from oebakery import die, err, warn, info, debug
 #from oelite.meta import *
 import oelite.meta
 import oelite.recipe
@@ -6,51 +7,157 @@ import oelite.path
 
 import os
 import cPickle
+from pysqlite2 import dbapi2 as sqlite
 
 class MetaCache:
 
-    def __init__(self, cachefile, recipes=None, baker=None):
-        if recipes is None:
+    """Persistent cache of the parsed metadata of all recipe files.
+
+    The cache is a single SQLite database, holding the pickled recipes
+    of each recipe file, together with the input files (conf files,
+    classes, includes, and the recipe file itself) of the recipe file
+    and their mtimes when parsed.  Input files are stored only once,
+    even though most of them are shared by all recipe files, so that
+    the mtime of each input file is only checked once per run, and the
+    pickled recipes of a recipe file are only loaded when all its input
+    files are unchanged.
+
+    The whole cache is invalid when the pickle ABI or the environment
+    signature changes.  The database is in WAL mode, and each change is
+    committed right away, so that other processes using the same cache
+    only have to wait for the database while a single recipe file is
+    written, and so that no parsed recipes are lost when interrupted.
+    If the database cannot be read or written (fx. because it is locked
+    by another process for too long), recipes are parsed without
+    using (or updating) the cache.
+
+    When the database is created, the pickled recipe files of the
+    per-recipe file cache used before it (fx.
+    ${CACHEDIR}/meta/core/recipes/foo/foo_1.0.oe.p) are removed.
+    """
+
+    def __init__(self, cachefile, env_signature):
+        self.cachefile = cachefile
+        self.signature = cPickle.dumps((pickle_abi(), env_signature), 2)
+        # (filename, oepath, mtime) -> input id
+        self.inputs = {}
+        # recipe file -> list of input ids
+        self.recipe_inputs = None
+        # set of recipe files with current cached recipes
+        self.current = None
+        self.changed = False
+        # True when the database was created by this instance
+        self.created = False
+        self.db = None
+        try:
+            self.open()
+        except sqlite.OperationalError, e:
+            self.disable(e)
+        except sqlite.Error, e:
+            print "Ignoring bad metadata cache: %s: %s"%(cachefile, e)
+            self.db = None
+            for filename in (cachefile, cachefile + "-wal",
+                             cachefile + "-shm"):
+                if os.path.exists(filename):
+                    os.unlink(filename)
             try:
-                self.file = open(cachefile)
-                self.abi = cPickle.load(self.file)
-                self.env_signature = cPickle.load(self.file)
-                self.mtimes = cPickle.load(self.file)
-            finally:
-                return
-
-        if os.path.exists(cachefile):
-            os.unlink(cachefile)
-        oelite.util.makedirs(os.path.dirname(cachefile))
-        self.abi = pickle_abi()
-        self.env_signature = baker.config.env_signature()
-        self.mtimes = set()
-        self.meta = {}
-        self.expand_cache = {}
-        for type in recipes:
-            for mtime in recipes[type].meta.get_input_mtimes():
-                self.mtimes.add(mtime)
-        self.file = open(cachefile, "w")
-        cPickle.dump(self.abi, self.file, 2)
-        cPickle.dump(self.env_signature, self.file, 2)
-        cPickle.dump(self.mtimes, self.file, 2)
-        cPickle.dump(len(recipes), self.file, 2)
-        for type in recipes:
-            recipes[type].pickle(self.file)
+                self.open()
+            except sqlite.Error, e:
+                self.disable(e)
         return
 
 
-    def is_current(self, baker):
-        try:
-            if pickle_abi() != self.abi:
-                return False
-            if baker.config.env_signature() != self.env_signature:
-                return False
-            if not isinstance(self.mtimes, set):
-                return False
-        except AttributeError:
-            return False
-        for (fn, oepath, old_mtime) in list(self.mtimes):
+    def open(self):
+        oelite.util.makedirs(os.path.dirname(self.cachefile))
+        if not os.path.exists(self.cachefile):
+            self.created = True
+            self.remove_old_cache()
+        self.db = sqlite.connect(self.cachefile, timeout=10,
+                                 isolation_level=None)
+        self.db.text_factory = str
+        # journal mode can only be changed outside of transactions
+        self.db.execute("PRAGMA journal_mode = WAL")
+        self.db.isolation_level = ""
+        # it is only a cache, so don't wait for it to hit the disk
+        self.db.execute("PRAGMA synchronous = OFF")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS signature ( signature BLOB )")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS input ( "
+            "id         INTEGER PRIMARY KEY, "
+            "filename   TEXT, "
+            "oepath     TEXT, "
+            "mtime      REAL )")
+        # inputs is the pickled list of input ids, and goes before the
+        # pickled recipes, so that reading it does not read the recipes
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS recipe ( "
+            "filename   TEXT PRIMARY KEY, "
+            "inputs     BLOB, "
+            "recipes    BLOB )")
+        self.db.commit()
+        signature = self.db.execute(
+            "SELECT signature FROM signature").fetchone()
+        if signature is None or str(signature[0]) != self.signature:
+            self.db.execute("DELETE FROM signature")
+            self.db.execute("DELETE FROM input")
+            self.db.execute("DELETE FROM recipe")
+            self.db.execute("INSERT INTO signature VALUES (?)",
+                            (sqlite.Binary(self.signature),))
+            self.db.commit()
+        for (id, filename, oepath, mtime) in self.db.execute(
+            "SELECT id, filename, oepath, mtime FROM input"):
+            self.inputs[(filename, oepath, mtime)] = id
+        return
+
+
+    def remove_old_cache(self):
+        """Remove the pickled recipe files of the old per-recipe file
+        cache below the directory of the database, and the directories
+        left empty by that.  Files already removed by another process
+        are ignored."""
+        cachedir = os.path.dirname(self.cachefile)
+        removed = set()
+        for (dirpath, dirnames, filenames) in os.walk(cachedir,
+                                                      topdown=False):
+            for filename in filenames:
+                if filename.endswith(".oe.p"):
+                    remove_old_cachefile(os.path.join(dirpath, filename))
+                    removed.add(dirpath)
+            if dirpath in removed and dirpath != cachedir:
+                try:
+                    if not os.listdir(dirpath):
+                        os.rmdir(dirpath)
+                except OSError:
+                    pass
+                removed.add(os.path.dirname(dirpath))
+        return
+
+
+    def disable(self, e):
+        """Stop using the database after error e."""
+        warn("Not using metadata cache: %s: %s"%(self.cachefile, e))
+        if self.db is not None:
+            try:
+                self.db.rollback()
+                self.db.close()
+            except sqlite.Error:
+                pass
+            self.db = None
+        self.recipe_inputs = {}
+        self.current = set()
+        self.changed = False
+        return
+
+
+    def check(self):
+        """Find the recipe files with all inputs unchanged."""
+        self.recipe_inputs = {}
+        self.current = set()
+        if self.db is None:
+            return
+        changed = set()
+        for ((fn, oepath, old_mtime), id) in self.inputs.iteritems():
             if oepath is not None:
                 filepath = oelite.path.which(oepath, fn)
             else:
@@ -60,25 +167,216 @@ class MetaCache:
             else:
                 cur_mtime = None
             if cur_mtime != old_mtime:
-                return False
-        return True
+                changed.add(id)
+        try:
+            for (filename, inputs) in self.db.execute(
+                "SELECT filename, inputs FROM recipe"):
+                inputs = cPickle.loads(str(inputs))
+                self.recipe_inputs[filename] = inputs
+                if changed.isdisjoint(inputs):
+                    self.current.add(filename)
+        except sqlite.OperationalError, e:
+            self.disable(e)
+        return
+
+
+    def is_current(self, filename):
+        """Return True if the cached recipes of filename are current."""
+        if self.current is None:
+            self.check()
+        return filename in self.current
 
 
-    def load(self, filename, cookbook):
-        recipes = {}
-        for i in xrange(cPickle.load(self.file)):
-            recipe = oelite.recipe.unpickle(
-                self.file, filename, cookbook)
-            recipes[recipe.type] = recipe
-        return recipes
+    def load(self, filename):
+        """Return the pickled recipes of filename, or None if not
+        cached or not current."""
+        if not self.is_current(filename):
+            return None
+        try:
+            row = self.db.execute(
+                "SELECT recipes FROM recipe WHERE filename=?",
+                (filename,)).fetchone()
+        except sqlite.OperationalError, e:
+            self.disable(e)
+            return None
+        if row is None:
+            return None
+        return str(row[0])
+
+
+    def store(self, filename, recipes, mtimes):
+        """Store the pickled recipes of filename, parsed from input
+        files with the given (filename, oepath, mtime) mtimes."""
+        if self.current is None:
+            self.check()
+        if self.db is None:
+            return
+        inputs = set()
+        new_inputs = []
+        try:
+            for mtime in mtimes:
+                try:
+                    inputs.add(self.inputs[mtime])
+                except KeyError:
+                    id = self.db.execute(
+                        "INSERT INTO input (filename, oepath, mtime) "
+                        "VALUES (?, ?, ?)", mtime).lastrowid
+                    new_inputs.append((mtime, id))
+                    inputs.add(id)
+            inputs = sorted(inputs)
+            self.db.execute(
+                "INSERT OR REPLACE INTO recipe (filename, inputs, recipes) "
+                "VALUES (?, ?, ?)",
+                (filename, sqlite.Binary(cPickle.dumps(inputs, 2)),
+                 sqlite.Binary(recipes)))
+            self.db.commit()
+        except sqlite.OperationalError, e:
+            self.disable(e)
+            return
+        self.inputs.update(new_inputs)
+        self.recipe_inputs[filename] = inputs
+        self.current.add(filename)
+        self.changed = True
+        return
+
+
+    def remove(self, filename):
+        if self.current is None:
+            self.check()
+        if not filename in self.recipe_inputs:
+            return
+        try:
+            self.db.execute("DELETE FROM recipe WHERE filename=?",
+                            (filename,))
+            self.db.commit()
+        except sqlite.OperationalError, e:
+            self.disable(e)
+            return
+        del self.recipe_inputs[filename]
+        self.current.discard(filename)
+        self.changed = True
+        return
+
+
+    def commit(self):
+        """Remove recipe files which no longer exist, and input files
+        not used by any recipe file."""
+        if self.recipe_inputs is not None:
+            for filename in self.recipe_inputs.keys():
+                if not os.path.exists(filename):
+                    self.remove(filename)
+        if not self.changed or self.db is None:
+            return
+        used = set()
+        for inputs in self.recipe_inputs.itervalues():
+            used.update(inputs)
+        unused = [(mtime, id) for (mtime, id) in self.inputs.iteritems()
+                  if not id in used]
+        try:
+            self.db.executemany("DELETE FROM input WHERE id=?",
+                                [(id,) for (mtime, id) in unused])
+            self.db.commit()
+        except sqlite.OperationalError, e:
+            self.disable(e)
+            return
+        for (mtime, id) in unused:
+            del self.inputs[mtime]
+        self.changed = False
+        return
 
 
     def __repr__(self):
         return '%s()'%(self.__class__.__name__)
 
 
-    def __iter__(self):
-        return self.meta.keys().__iter__()
+class SignatureCache:
+
+    """Persistent cache of task data hashes (metadata signatures).
+
+    Data hashes are cached per recipe file and recipe type, and are
+    only used when the pickle ABI and environment signature (as checked
+    by MetaCache) and the set of recipe input mtimes are unchanged.
+    The recipe EXTRA_ARCH is also checked, as it is set from the recipe
+    dependencies after parsing.
+    """
+
+    def __init__(self, cachefile, env_signature):
+        self.cachefile = cachefile
+        self.abi = pickle_abi()
+        self.env_signature = env_signature
+        self.signatures = {}
+        self.recipe_keys = {}
+        self.changed = False
+        self.hits = 0
+        self.misses = 0
+        if not os.path.exists(cachefile):
+            return
+        try:
+            with open(cachefile) as file:
+                abi = cPickle.load(file)
+                env_signature = cPickle.load(file)
+                if abi == self.abi and env_signature == self.env_signature:
+                    self.signatures = cPickle.load(file)
+        except Exception:
+            print "Ignoring bad signature cache:", cachefile
+        return
+
+
+    def recipe_key(self, recipe):
+        """Return (key, state) of recipe, where state must be unchanged
+        for cached data hashes to be used."""
+        try:
+            return self.recipe_keys[recipe]
+        except KeyError:
+            pass
+        try:
+            extra_arch = recipe.meta.get("EXTRA_ARCH")
+        except oelite.meta.ExpansionError:
+            extra_arch = None
+        state = (frozenset(recipe.meta.get_input_mtimes()), extra_arch)
+        self.recipe_keys[recipe] = ((recipe.filename, recipe.type), state)
+        return self.recipe_keys[recipe]
+
+
+    def get(self, task):
+        (key, state) = self.recipe_key(task.recipe)
+        try:
+            (cached_state, datahashes) = self.signatures[key]
+            if cached_state == state:
+                datahash = datahashes[task.name]
+                self.hits += 1
+                return datahash
+        except KeyError:
+            pass
+        self.misses += 1
+        return None
+
+
+    def set(self, task, datahash):
+        (key, state) = self.recipe_key(task.recipe)
+        if not key in self.signatures or self.signatures[key][0] != state:
+            self.signatures[key] = (state, {})
+        if self.signatures[key][1].get(task.name) != datahash:
+            self.signatures[key][1][task.name] = datahash
+            self.changed = True
+        return
+
+
+    def save(self):
+        if not self.changed:
+            return
+        for key in self.signatures.keys():
+            if not os.path.exists(key[0]):
+                del self.signatures[key]
+        oelite.util.makedirs(os.path.dirname(self.cachefile))
+        tmpfile = "%s.%d"%(self.cachefile, os.getpid())
+        with open(tmpfile, "w") as file:
+            cPickle.dump(self.abi, file, 2)
+            cPickle.dump(self.env_signature, file, 2)
+            cPickle.dump(self.signatures, file, 2)
+        os.rename(tmpfile, self.cachefile)
+        self.changed = False
+        return
 
 
 PICKLE_ABI = None
@@ -119,6 +417,16 @@ PICKLE_ABI_MODULES = [
     "oelite.meta.cache",
     ]
 
+def remove_old_cachefile(filename):
+    """Remove pickled recipe file of the old per-recipe file cache, if
+    not already removed."""
+    try:
+        os.unlink(filename)
+    except OSError:
+        pass
+    return
+
+
 def pickle_abi():
     global PICKLE_ABI
     if not PICKLE_ABI:
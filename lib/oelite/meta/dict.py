@@ -2,20 +2,54 @@ from oelite.meta import *
 import oelite.path
 
 import sys
+import collections
 import copy
 import warnings
 import cPickle
-import operator
+import cStringIO
 import types
 import os
 
 
+# (function, sequence, after) of hooks, in the order added -> ordered
+# list of hook functions
+hooks_cache = {}
+
+# (flag, type, value) items -> flag dictionary shared by all DictMeta
+# objects having a variable with these flags, see DictMeta.compact()
+shared_flags = {}
+
+# expand_cache dependencies -> frozenset shared by all DictMeta objects
+shared_deps = {}
+
+
 def unpickle(file):
     return DictMeta(meta=file)
 
 
+def clear_shared():
+    """Forget the flag dictionaries and dependency sets shared by
+    DictMeta.compact(), fx. when done building the cookbook, so that
+    they are not kept for the rest of the process.  Already compacted
+    DictMeta objects keep sharing them."""
+    shared_flags.clear()
+    shared_deps.clear()
+    return
+
+
 class DictMeta(MetaData):
 
+    """Metadata stored in a dictionary of per-variable flag dictionaries.
+
+    Copies are copy-on-write.  A copy shares the flag dictionaries with
+    the original, and a flag dictionary is only copied when a variable
+    is modified, in either the copy or the original, so that the many
+    layer, recipe and task copies of the same metadata only use memory
+    for the variables that differ.  Values (fx. lists or dictionaries)
+    returned by get() and get_flag() may therefore be shared with other
+    copies, and must not be modified in place, but only by setting a
+    new value.
+    """
 
     def pickle(self, file):
         cPickle.dump(self.dict, file, 2)
@@ -27,25 +61,51 @@ class DictMeta(MetaData):
 
 
     def __init__(self, meta=None):
-        if isinstance(meta, file):
+        if isinstance(meta, (file, cStringIO.InputType)):
             self.dict = cPickle.load(meta)
             self.expand_cache = cPickle.load(meta)
+            self.owned = set(self.dict)
+            self.expand_rdeps = {}
+            self.overrides_cache = None
+            self.compact()
+            for (var, (val, deps)) in self.expand_cache.iteritems():
+                self.add_expand_rdeps(var, deps)
+            self.name_index = {}
+            self.name_index_owned = set()
+            for var in self.dict:
+                self.add_name_index(var)
+            self.flag_index_owned = set(self.dict["__flag_index"])
+            self.object_memo = {}
             meta = None
         elif isinstance(meta, DictMeta):
-            self.dict = {}
-            #self.dict = meta.dict.copy()
-            self.dict = copy.deepcopy(meta.dict)
-            #for var in meta.dict:
-            #    self.dict[var] = meta.dict[var].copy()
+            self.dict = meta.dict.copy()
+            # all flag dictionaries are now shared
+            self.owned = set()
+            meta.owned = set()
             self.expand_cache = meta.expand_cache.copy()
-            #self.expand_cache = copy.deepcopy(meta.expand_cache)
+            self.expand_rdeps = meta.expand_rdeps
+            self.overrides_cache = meta.overrides_cache
+            self.name_index = meta.name_index.copy()
+            self.name_index_owned = set()
+            meta.name_index_owned = set()
+            self.flag_index_owned = set()
+            meta.flag_index_owned = set()
+            self.object_memo = {}
+            meta.object_memo = {}
             meta = None
         else:
             self.dict = {}
+            self.owned = set(["__flag_index"])
             self.expand_cache = {}
+            self.expand_rdeps = {}
+            self.overrides_cache = None
+            self.name_index = {}
+            self.name_index_owned = set()
             self.dict["__flag_index"] = {}
             for flag in self.INDEXED_FLAGS:
                 self.dict["__flag_index"][flag] = set([])
+            self.flag_index_owned = set(self.INDEXED_FLAGS)
+            self.object_memo = {}
         super(DictMeta, self).__init__(meta=meta)
         return
 
@@ -70,58 +130,233 @@ class DictMeta(MetaData):
         return self.dict.keys()
 
 
-    def set(self, var, val):
-        assert not " " in var
+    def writable(self, var):
+        """Return the flag dictionary of var for modification, copying
+        it first if it might be shared with other copies."""
+        if var in self.owned:
+            return self.dict[var]
         try:
-            self.dict[var][""] = val
+            flags = copy.deepcopy(self.dict[var])
         except KeyError:
-            self.dict[var] = {"": val}
+            flags = {}
+            self.add_name_index(var)
+        self.dict[var] = flags
+        self.owned.add(var)
+        return flags
+
+
+    PLAIN_TYPES = (basestring, types.NoneType, bool, int, long, float)
+
+    def writable_object(self, var):
+        """Return the value of var, which is a (possibly mutable) object,
+        such as the fetcher objects in __fetch, copying it first if it
+        might be shared with other copies.  Such values are modified in
+        place, fx. by tasks run inline in the main process, without
+        going through writable(), so they are copied on first access
+        instead.  All objects of a copy are copied with the same memo,
+        so that references between them (fx. from the __fetch fetchers
+        to __fetch_signatures) are kept."""
+        if var in self.owned:
+            return self.dict[var][""]
+        flags = copy.deepcopy(self.dict[var], self.object_memo)
+        self.dict[var] = flags
+        self.owned.add(var)
+        return flags[""]
+
+
+    def writable_flag_index(self, flag):
+        """Return the set of variables with flag in the flag index for
+        modification.  Only the index dictionary itself and the set of
+        flag are copied if they might be shared with other copies, not
+        the sets of the other indexed flags."""
+        if "__flag_index" in self.owned:
+            flag_index = self.dict["__flag_index"]
+        else:
+            flag_index = self.dict["__flag_index"].copy()
+            self.dict["__flag_index"] = flag_index
+            self.owned.add("__flag_index")
+            self.flag_index_owned = set()
+        if not flag in self.flag_index_owned:
+            flag_index[flag] = set(flag_index.get(flag, ()))
+            self.flag_index_owned.add(flag)
+        return flag_index[flag]
+
+
+    # The name_index maps the leading word of variable names (up to and
+    # including the first "_") to the set of variable names starting
+    # with it, and "${" to the set of variable names containing it, so
+    # that fx. all variables with a given prefix can be found without
+    # looking through all variables.  The sets are copy-on-write, like
+    # the flag dictionaries.
+
+    @staticmethod
+    def name_index_keys(var):
+        keys = []
+        i = var.find("_")
+        if i > 0:
+            keys.append(var[:i+1])
+        if "${" in var:
+            keys.append("${")
+        return keys
+
+
+    def writable_name_index(self, key):
+        if key in self.name_index_owned:
+            return self.name_index[key]
+        names = set(self.name_index.get(key, ()))
+        self.name_index[key] = names
+        self.name_index_owned.add(key)
+        return names
+
+
+    def add_name_index(self, var):
+        for key in self.name_index_keys(var):
+            self.writable_name_index(key).add(var)
+        return
+
+
+    def del_name_index(self, var):
+        for key in self.name_index_keys(var):
+            if var in self.name_index.get(key, ()):
+                self.writable_name_index(key).discard(var)
+        return
+
+
+    def get_vars_prefix(self, prefix):
+        """Return set of names of variables starting with prefix."""
+        i = prefix.find("_")
+        if i > 0:
+            names = self.name_index.get(prefix[:i+1], ())
+        else:
+            names = self.dict
+        return set([var for var in names if var.startswith(prefix)])
+
+
+    def get_vars_containing(self, string):
+        """Return set of names of variables containing string."""
+        if string == "${":
+            return set(self.name_index.get(string, ()))
+        return set([var for var in self.dict if string in var])
+
+
+    def set(self, var, val):
+        assert not " " in var
+        self.writable(var)[""] = val
         self.trim_expand_cache(var)
         return
 
 
+    # The expand_rdeps index maps variable names to the names of cached
+    # expansions (possibly) depending on it.  It is shared by all copies,
+    # and never trimmed, so it is a superset of the dependencies of the
+    # expand_cache of each copy, and must be checked against that.
+
+    def add_expand_rdeps(self, var, deps):
+        for dep in deps:
+            try:
+                self.expand_rdeps[dep].add(var)
+            except KeyError:
+                self.expand_rdeps[dep] = set([var])
+        return
+
+
     def trim_expand_cache(self, var):
-        for (cached_var, (cached_val, deps)) in self.expand_cache.items():
-            if cached_var == var or var in deps:
-                # FIXME: is it safe to delete from the dict we are iterating ?
-                del self.expand_cache[cached_var]
+        try:
+            del self.expand_cache[var]
+        except KeyError:
+            pass
+        for cached_var in self.expand_rdeps.get(var, ()):
+            try:
+                if var in self.expand_cache[cached_var][1]:
+                    del self.expand_cache[cached_var]
+            except KeyError:
+                pass
         return
 
 
+    def share_expansion(self, base, var):
+        """Share the cached expansion of var with base, which this is a
+        copy of.  If var and all variables its expansion depends on
+        are unchanged in both since the copy (they still share the flag
+        dictionaries), the expansion is the same in both, so take it
+        from base if cached there, or else give it to base, so that
+        other copies of base do not have to expand it again.
+        Expansions using inline python are not shared, as the python
+        code may depend on any variable, and neither are expansions of
+        variables using MACHINE_ overrides (or depending on such), as
+        expanding these sets EXTRA_ARCH (see _get()), which must then
+        happen in each copy."""
+        cached = self.expand_cache.get(var)
+        if cached is None:
+            cached = base.expand_cache.get(var)
+            if cached is None:
+                return
+            target = self
+        elif var in base.expand_cache:
+            return
+        else:
+            target = base
+        if cached[1] is None or "python" in cached[1]:
+            return
+        flags = self.dict.get(var)
+        if flags is not base.dict.get(var) or self.machine_override(flags):
+            return
+        for dep in cached[1]:
+            flags = self.dict.get(dep)
+            if (flags is not base.dict.get(dep) or
+                self.machine_override(flags)):
+                return
+        target.expand_cache[var] = cached
+        return
+
+
+    def machine_override(self, flags):
+        """Return True if flags has MACHINE_ overrides which are in the
+        current OVERRIDES, ie. if expanding the variable may set
+        EXTRA_ARCH."""
+        if not flags or not "__overrides" in flags:
+            return False
+        current_overrides = None
+        for overrides in flags["__overrides"].itervalues():
+            for override in overrides:
+                if not override.startswith("MACHINE_"):
+                    continue
+                if current_overrides is None:
+                    current_overrides = self._get_overrides()[0]
+                if override in current_overrides:
+                    return True
+        return False
+
+
     def set_flag(self, var, flag, val):
         #print "set_flag %s[%s]=%s"%(var, flag, val)
         assert not " " in var
-        try:
-            self.dict[var][flag] = val
-        except KeyError:
-            self.dict[var] = {flag: val}
-        if flag in self.dict["__flag_index"]:
+        self.writable(var)[flag] = val
+        flag_index = self.dict["__flag_index"]
+        if flag in flag_index and bool(val) != (var in flag_index[flag]):
             if val:
-                self.dict["__flag_index"][flag].add(var)
+                self.writable_flag_index(flag).add(var)
             else:
-                self.dict["__flag_index"][flag].discard(var)
+                self.writable_flag_index(flag).discard(var)
         if flag == "":
             self.trim_expand_cache(var)
         return
 
 
     def weak_set_flag(self, var, flag, val):
-        if not var in self.dict.keys() or not flag in self.dict[var].keys():
+        if not var in self.dict or not flag in self.dict[var]:
             self.set_flag(var, flag, val)
 
 
     def set_override(self, var, override, val):
         assert var not in ("OVERRIDES", "__overrides", "", ">", "<")
         assert override[0] in ("", ">", "<")
+        flags = self.writable(var)
         try:
-            self.dict[var]["__overrides"][override[0]][override[1]] = val
-        except KeyError, e:
-            if e.args[0] == var:
-                self.dict[var] = {"__overrides": {'':{}, '>':{}, '<':{}}}
-            else:
-                assert e.args[0] == "__overrides"
-                self.dict[var]["__overrides"] = {'':{}, '>':{}, '<':{}}
-            self.dict[var]["__overrides"][override[0]][override[1]] = val
+            overrides = flags["__overrides"]
+        except KeyError:
+            overrides = flags["__overrides"] = {'':{}, '>':{}, '<':{}}
+        overrides[override[0]][override[1]] = val
         self.trim_expand_cache(var)
         return
 
@@ -139,6 +374,8 @@ class DictMeta(MetaData):
         assert isinstance(expand, int)
         try:
             val = self.dict[var][""]
+            if not isinstance(val, self.PLAIN_TYPES):
+                val = self.writable_object(var)
         except KeyError:
             try:
                 val = self.dict[var]["defaultval"]
@@ -159,7 +396,7 @@ class DictMeta(MetaData):
         override_dep = None
         if "__overrides" in self.dict[var]:
             current_overrides, override_dep = self._get_overrides()
-            override_dep.add("OVERRIDES")
+            override_dep = override_dep.union(["OVERRIDES"])
             var_overrides = self.dict[var]["__overrides"]['']
             append_overrides = self.dict[var]["__overrides"]['>']
             prepend_overrides = self.dict[var]["__overrides"]['<']
@@ -169,22 +406,15 @@ class DictMeta(MetaData):
             var_override_used = None
             overrides_used = set()
             for override in current_overrides:
-                if oval is None:
-                    try:
-                        oval = var_overrides[override]
-                        var_override_used = override
-                    except KeyError:
-                        pass
-                try:
+                if oval is None and override in var_overrides:
+                    oval = var_overrides[override]
+                    var_override_used = override
+                if override in append_overrides:
                     append += append_overrides[override] or ""
                     overrides_used.add(override)
-                except KeyError:
-                    pass
-                try:
+                if override in prepend_overrides:
                     prepend = (prepend_overrides[override] or "") + prepend
                     overrides_used.add(override)
-                except KeyError:
-                    pass
             if oval is not None:
                 val = oval
                 overrides_used.add(var_override_used)
@@ -215,20 +445,29 @@ class DictMeta(MetaData):
 
         if override_dep:
             deps = deps.union(override_dep)
-        self.expand_cache[var] = (val, deps)
-        return (val, deps)
+        cached = self.expand_cache[var] = (val, deps)
+        self.add_expand_rdeps(var, deps)
+        return cached
 
 
     def get_overrides(self):
         return _get_overrides(self)[0]
 
     def _get_overrides(self):
-        overrides = self._get("OVERRIDES", 2)
+        # The filtered OVERRIDES list is cached for as long as the
+        # expand_cache entry of OVERRIDES is unchanged.
+        try:
+            overrides = self.expand_cache["OVERRIDES"]
+        except KeyError:
+            overrides = self._get("OVERRIDES", 2)
+        if self.overrides_cache and self.overrides_cache[0] is overrides:
+            return self.overrides_cache[1]
         filtered = []
         for override in overrides[0].split(":"):
             if not "${" in override:
                 filtered.append(override)
-        return (filtered, overrides[1])
+        self.overrides_cache = (overrides, (filtered, overrides[1]))
+        return self.overrides_cache[1]
 
 
     def get_flag(self, var, flag, expand=False):
@@ -251,9 +490,12 @@ class DictMeta(MetaData):
 
     def del_var(self, var):
         #print "del_var %s"%(var)
-        for flag in self.dict["__flag_index"]:
-            self.dict["__flag_index"][flag].discard(var)
+        for flag in self.dict["__flag_index"].keys():
+            if var in self.dict["__flag_index"][flag]:
+                self.writable_flag_index(flag).discard(var)
+        self.del_name_index(var)
         del self.dict[var]
+        self.owned.discard(var)
         try:
             del self.expand_cache[var]
         except KeyError:
@@ -271,9 +513,9 @@ class DictMeta(MetaData):
 
     def get_vars(self, flag="", values=False):
         #print "get_vars flag=%s values=%s"%(flag, values)
-        if flag and not flag in self.dict["__flag_index"]:
-            print "get_vars flag=%s not indexed"%(flag)
-            print "__flag_index=%s"%(self.dict["__flag_index"])
+        if flag and not flag.startswith("__") and \
+                not flag in self.dict["__flag_index"]:
+            self.add_flag_index(flag)
         if values:
             vars = {}
             if flag in self.dict["__flag_index"]:
@@ -306,6 +548,21 @@ class DictMeta(MetaData):
         return vars
 
 
+    def add_flag_index(self, flag):
+        """Start indexing flag, so that get_vars(flag) does not have to
+        look through all variables.  The index is kept up to date by
+        set_flag() and del_var(), as for the INDEXED_FLAGS."""
+        vars = set()
+        for var in self.dict:
+            try:
+                if self.dict[var][flag]:
+                    vars.add(var)
+            except KeyError:
+                continue
+        self.writable_flag_index(flag).update(vars)
+        return
+
+
     def get_flags(self, var, prune_var_value=True):
         try:
             flags = self.dict[var].copy()
@@ -333,21 +590,21 @@ class DictMeta(MetaData):
             after = []
         if before is None:
             before = []
-        try:
-            hooks = self.dict["__hooks"]
-        except KeyError:
-            hooks = self.dict["__hooks"] = {}
+        hooks = self.writable("__hooks")
         try:
             functions = hooks[name]
         except KeyError:
-            functions = hooks[name] = {}
+            # ordered, so that hooks with the same sequence run in the
+            # order they are added
+            functions = hooks[name] = collections.OrderedDict()
         try:
             if sequence is None or sequence == functions[function][0]:
                 functions[function] = (functions[function][0],
                                        functions[function][1].union(after))
             elif functions[function][0] is None:
-                functions[function] = (sequence,
-                                       functions[function][1].union(after))
+                # only referenced by before until now, so it is added now
+                (_, function_after) = functions.pop(function)
+                functions[function] = (sequence, function_after.union(after))
             else:
                 raise Exception("Invalid addhook statement (add more debug info here telling what sequence mismatch is and how to resolve it)")
         except KeyError:
@@ -366,7 +623,25 @@ class DictMeta(MetaData):
             functions = self.dict["__hooks"][name]
         except KeyError:
             return []
-        functions = sorted(functions.iteritems(), key=operator.itemgetter(1))
+        # the same hooks, added in the same order, are typically found
+        # in all recipes, so only order them once
+        key = tuple([(function, sequence, tuple(sorted(after)))
+                     for (function, (sequence, after))
+                     in functions.iteritems()])
+        try:
+            return list(hooks_cache[key])
+        except KeyError:
+            pass
+        hooks = self._get_hooks(functions)
+        hooks_cache[key] = hooks
+        return list(hooks)
+
+
+    def _get_hooks(self, functions):
+        # sort by sequence only, the sort is stable, so hooks with the
+        # same sequence keep the order they were added in
+        functions = sorted(functions.iteritems(),
+                           key=lambda function: function[1][0])
         num_functions = len(functions)
         i = 0
         while i < num_functions:
@@ -402,7 +677,8 @@ class DictMeta(MetaData):
             return self.set_preferred_recipe(recipe, layer, version)
 
     def set_preferred_recipe(self, recipe, layer, version):
-        preferred_recipes = self.get('__preferred_recipes') or {}
+        preferred_recipes = copy.deepcopy(
+            self.get('__preferred_recipes') or {})
         try:
             preferences = preferred_recipes[recipe]
         except KeyError:
@@ -411,7 +687,8 @@ class DictMeta(MetaData):
         self.set('__preferred_recipes', preferred_recipes)
 
     def set_preferred_packages(self, packages, recipe, layer, version):
-        preferred_packages = self.get('__preferred_packages') or {}
+        preferred_packages = copy.deepcopy(
+            self.get('__preferred_packages') or {})
         for package in packages:
             try:
                 preferences = preferred_packages[package]
@@ -434,8 +711,7 @@ class DictMeta(MetaData):
                 mtime = os.path.getmtime(fn)
             else:
                 mtime = None
-        mtimes = self.get_input_mtimes()
-        mtimes.append((fn, path, mtime))
+        mtimes = self.get_input_mtimes() + [(fn, path, mtime)]
         self.set("__mtimes", mtimes)
         return
 
@@ -446,4 +722,61 @@ class DictMeta(MetaData):
 
     def finalize(self):
         #warnings.warn("FIXME: implement DictMeta.finalize()")
+        self.compact()
+        return
+
+
+    def compact(self):
+        """Intern variable names, flag names and string values, and
+        share flag dictionaries with other DictMeta objects having a
+        variable with the same flags.
+
+        Most variables come from the same conf and class files for all
+        recipes, but as these are parsed again for each recipe (and
+        unpickled separately from the metadata cache), each recipe
+        would otherwise hold its own copy of them.  Shared flag
+        dictionaries are not owned, so they are copied on write.  The
+        values and dependencies of the expand_cache are shared in the
+        same way.
+        """
+        compacted = {}
+        for (var, flags) in self.dict.iteritems():
+            if type(var) is str:
+                var = intern(var)
+            items = []
+            shareable = True
+            for (flag, val) in flags.iteritems():
+                if type(flag) is str:
+                    flag = intern(flag)
+                if type(val) is str:
+                    val = intern(val)
+                elif not isinstance(val, (types.NoneType, bool, int, long,
+                                          unicode)):
+                    shareable = False
+                items.append((flag, type(val), val))
+            if shareable:
+                key = frozenset(items)
+                try:
+                    flags = shared_flags[key]
+                except KeyError:
+                    flags = shared_flags[key] = dict(
+                        [(flag, val) for (flag, _, val) in items])
+                self.owned.discard(var)
+            elif var in self.owned:
+                flags = dict([(flag, val) for (flag, _, val) in items])
+            compacted[var] = flags
+        self.dict = compacted
+        compacted = {}
+        for (var, (val, deps)) in self.expand_cache.iteritems():
+            if type(var) is str:
+                var = intern(var)
+            if type(val) is str:
+                val = intern(val)
+            if deps is not None:
+                deps = frozenset([intern(dep) if type(dep) is str else dep
+                                  for dep in deps])
+                deps = shared_deps.setdefault(deps, deps)
+            compacted[var] = (val, deps)
+        self.expand_cache = compacted
+        self.overrides_cache = None
         return
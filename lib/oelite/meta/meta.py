@@ -10,6 +10,7 @@ from collections import MutableMapping
 from oelite.meta import *
 from oelite.pyexec import *
 import oelite.function
+import oelite.util
 
 
 class ExpansionError(Exception):
@@ -57,7 +58,37 @@ class ExpansionStack:
         return prefix + ("\n%s"%(prefix)).join(self.stack)
 
 
-pythonfunc_code_cache = {}
+# (filename, lineno, source) -> code object
+pythonfunc_code_cache = oelite.util.CodeCache(10000)
+
+
+VAR_RE = re.compile(r"\${[^@{}]+}")
+PYTHON_RE = re.compile(r"\${@.+?}")
+
+# raw string -> expansion template
+expansion_templates = oelite.util.CodeCache(10000)
+
+def expansion_template(string):
+    """Return the expansion template of string.
+
+    The template is a tuple of (chunks, tail), where chunks is a tuple of
+    (literal, var) pairs for each variable reference in string, and tail
+    is the literal string following the last variable reference.
+    Templates are cached, as the same raw strings are expanded over and
+    over again in all recipes.
+    """
+    template = expansion_templates.get(string)
+    if template is not None:
+        return template
+    chunks = []
+    string_ptr = 0
+    for var_match in VAR_RE.finditer(string):
+        chunks.append((string[string_ptr:var_match.start(0)],
+                       var_match.group(0)[2:-1]))
+        string_ptr = var_match.end(0)
+    template = (tuple(chunks), string[string_ptr:])
+    expansion_templates.set(string, template)
+    return template
 
 
 OE_ENV_WHITELIST = [
@@ -183,6 +214,7 @@ class MetaData(MutableMapping):
             base_name = module_name.split(".")[0]
             g[base_name] = __import__(module_name, g, [], [], 0)
         self.pythonfunc_globals = g
+        self.pythonfunc_imports = imports
         return
 
 
@@ -202,12 +234,13 @@ class MetaData(MutableMapping):
         return pythonfuncs
 
 
-    def get_pythonfunc(self, var, name=None, tmpdir=None, set_os_environ=True):
+    def get_pythonfunc(self, var, name=None, tmpdir=None, set_os_environ=True,
+                       function=None):
         #if function in self.pythonfunc_cache:
         #    return self.pythonfunc_cache[function]
         function = oelite.function.PythonFunction(
             self, var, name=name, tmpdir=tmpdir,
-            set_os_environ=set_os_environ)
+            set_os_environ=set_os_environ, function=function)
         #self.pythonfunc_cache[function] = function
         return function
 
@@ -223,8 +256,10 @@ class MetaData(MutableMapping):
             body = "    pass"
         source = "def %s(%s):\n%s\n"%(var, args, body)
         newlines = "\n" * (lineno - 1)
-        if source in pythonfunc_code_cache:
-            return pythonfunc_code_cache[source]
+        key = (filename, lineno, source)
+        code = pythonfunc_code_cache.get(key)
+        if code is not None:
+            return code
         try:
             code = codeop.compile_command(newlines + source, filename)
         except SyntaxError, e:
@@ -234,7 +269,7 @@ class MetaData(MutableMapping):
             raise
         if not code:
             raise Exception("%s is not valid Python code"%(var))
-        pythonfunc_code_cache[source] = code
+        pythonfunc_code_cache.set(key, code)
         return code
 
 
@@ -260,14 +295,12 @@ class MetaData(MutableMapping):
     def _expand(self, string, method, var=None):
         #print "_expand method=%s string=%s"%(method, repr(string))
         assert isinstance(method, int)
-        orig_string = string
-        var_re    = re.compile(r"\${[^@{}]+}")
-        python_re = re.compile(r"\${@.+?}")
+        (chunks, tail) = expansion_template(string)
+        if not chunks and not "${@" in tail:
+            return (tail, set())
         deps = set()
-        expanded_string = ""
-        string_ptr = 0
-        for var_match in var_re.finditer(string):
-            var = var_match.group(0)[2:-1]
+        expanded = []
+        for (literal, var) in chunks:
             (val, recdeps) = self._get(var)
             if val is None:
                 if method == CLEAN_EXPANSION:
@@ -275,14 +308,18 @@ class MetaData(MutableMapping):
                 elif method == FULL_EXPANSION:
                     raise ExpansionError("Cannot expand variable ${%s}"%(var),
                                          self.expand_stack)
-            expanded_string += (string[string_ptr:var_match.start(0)] +
-                                "%s"%(val,))
-            string_ptr = var_match.end(0)
+            expanded.append(literal)
+            expanded.append("%s"%(val,))
             deps.add(var)
             if recdeps:
-                deps = deps.union(recdeps)
-        expanded_string += string[string_ptr:]
-        python_match = python_re.search(expanded_string)
+                deps.update(recdeps)
+        expanded.append(tail)
+        expanded_string = "".join(expanded)
+        # inline python is searched for after variable expansion, as
+        # variable values may be part of the python source
+        python_match = None
+        if "${@" in expanded_string:
+            python_match = PYTHON_RE.search(expanded_string)
         if python_match:
             python_source = python_match.group(0)[3:-1]
             self.expand_stack.push("${@%s}"%(str(python_source)))
@@ -424,23 +461,7 @@ class MetaData(MutableMapping):
                     continue
                 o.write("%s[%s]=%r\n"%(key, flag, val))
 
-        if self.get_flag(key, "python"): # FIXME: use _flags
-            func = "python"
-        elif self.get_flag(key, "bash"): # FIXME: use _flags
-            func = "bash"
-        else:
-            func = None
-
-        expand = self.get_flag(key, "expand") # FIXME: use _flags
-        if expand is not None:
-            expand = int(expand)
-        elif func == "python":
-            expand = False
-        else:
-            expand = FULL_EXPANSION
-        if not expand and func != "python":
-            expand = OVERRIDES_EXPANSION
-        val = self.get(key, expand)
+        (func, expand, val) = self.dump_var_value(key)
 
         if not val:
             return 0
@@ -469,9 +490,28 @@ class MetaData(MutableMapping):
         return
 
 
-    def dump(self, o=sys.__stdout__, pretty=True, nohash=False, only=None,
-             flags=False, ignore_flags=None):
+    def dump_var_value(self, key):
+        """Return (func, expand, val) of variable as dumped by dump_var()."""
+        if self.get_flag(key, "python"): # FIXME: use _flags
+            func = "python"
+        elif self.get_flag(key, "bash"): # FIXME: use _flags
+            func = "bash"
+        else:
+            func = None
 
+        expand = self.get_flag(key, "expand") # FIXME: use _flags
+        if expand is not None:
+            expand = int(expand)
+        elif func == "python":
+            expand = False
+        else:
+            expand = FULL_EXPANSION
+        if not expand and func != "python":
+            expand = OVERRIDES_EXPANSION
+        return (func, expand, self.get(key, expand))
+
+
+    def dump_dynvars(self):
         dynvars = []
         for varname in ("WORKDIR", "TOPDIR", "DATETIME",
                         "MANIFEST_ORIGIN_URL", "MANIFEST_ORIGIN_SRCURI",
@@ -479,9 +519,14 @@ class MetaData(MutableMapping):
             varval = self.get(varname, True)
             if varval:
                 dynvars.append((varname, varval))
+        return dynvars
+
 
-        keys = sorted((key for key in self.keys() if not key.startswith("__")))
-        for key in keys:
+    def dump_keys(self, nohash=False, only=None):
+        keys = []
+        for key in sorted(self.keys()):
+            if key.startswith("__"):
+                continue
             if only and key not in only:
                 continue
             if not nohash:
@@ -496,6 +541,14 @@ class MetaData(MutableMapping):
                         break
                 if nohash_prefixed:
                     continue
+            keys.append(key)
+        return keys
+
+
+    def dump(self, o=sys.__stdout__, pretty=True, nohash=False, only=None,
+             flags=False, ignore_flags=None):
+        dynvars = self.dump_dynvars()
+        for key in self.dump_keys(nohash, only):
             self.dump_var(key, o, pretty, dynvars, flags, ignore_flags)
 
 
@@ -508,8 +561,33 @@ class MetaData(MutableMapping):
             return oelite.function.ShellFunction(self, name)
 
 
-    def signature(self, ignore_flags=("__", "emit$", "omit$", "filename"),
-                  force=False, dump=None):
+    def share_expansion(self, base, var):
+        """Share the cached expansion of var with base, which this is a
+        copy of, if it is known to be the same in both."""
+        return
+
+
+    def signature(self, ignore_flags=("__", "emit$", "omit$", "filename",
+                                      "pool$"),
+                  force=False, dump=None, cache=None, base=None):
+        """Return md5 hex digest of the dump() of all hashed variables.
+
+        The dump of each variable is saved in the cache dictionary, fx.
+        shared by all tasks of a build, and reused for as long as the
+        flags and value of the variable (and the dynvars replaced in it)
+        are unchanged, so that the variables shared by the tasks of a
+        recipe, and between recipes, are only dumped once.
+
+        When this is a copy of base (fx. a task copy of the recipe
+        metadata), variable values expanded by one copy of base are
+        shared with the other copies through base, when unchanged, so
+        that the variables shared by the tasks of a recipe are only
+        expanded once.
+
+        The signature is still the md5 digest of the complete dump, and
+        not a combination of per-variable hashes, so that signatures
+        (and thereby existing stamps) are unchanged.
+        """
         import hashlib
 
         if self._signature and not force:
@@ -523,27 +601,41 @@ class MetaData(MutableMapping):
             def __len__(self):
                 return len(self.blob)
 
-        class StringHasher:
-            def __init__(self, hasher):
-                self.hasher = hasher
-            def write(self, msg):
-                self.hasher.update(str(msg))
-            def __str__(self):
-                return self.hasher.hexdigest()
-
-        hasher = StringHasher(hashlib.md5())
+        if cache is None:
+            cache = {}
+        dynvars = self.dump_dynvars()
+        blob = []
+        for key in self.dump_keys():
+            var_flags = self.get_flags(key, prune_var_value=False)
+            if base is not None:
+                self.share_expansion(base, key)
+            val = self.dump_var_value(key)[2]
+            if base is not None:
+                self.share_expansion(base, key)
+            # only cache string values, as fx. equal dicts may be dumped
+            # differently
+            cacheable = val is None or isinstance(val, basestring)
+            cached = cache.get(key)
+            if (cacheable and cached and type(cached[1]) is type(val)
+                and cached[1] == val and cached[0] == var_flags
+                and cached[2] == dynvars and cached[3] == ignore_flags):
+                blob.append(cached[4])
+                continue
+            dumper = StringOutput()
+            self.dump_var(key, dumper, pretty=False, dynvars=dynvars,
+                          flags=True, ignore_flags=ignore_flags)
+            if cacheable:
+                cache[key] = (var_flags, val, dynvars, ignore_flags,
+                              dumper.blob)
+            blob.append(dumper.blob)
+        blob = "".join(blob)
 
         if dump:
             assert isinstance(dump, basestring)
-            dumper = StringOutput()
-            self.dump(dumper, pretty=False, nohash=False,
-                      flags=True, ignore_flags=ignore_flags)
             dumpdir = os.path.dirname(dump)
             if dumpdir and not os.path.exists(dumpdir):
                 os.makedirs(dumpdir)
-            open(dump, "w").write(dumper.blob)
-        self.dump(hasher, pretty=False, nohash=False,
-                  flags=True, ignore_flags=ignore_flags)
+            open(dump, "w").write(blob)
 
-        self._signature = str(hasher)
+        self._signature = hashlib.md5(blob).hexdigest()
         return self._signature
@@ -3,11 +3,14 @@ import oelite.parse.oeparse
 
 
 oelexer = None
+fastlexer = None
 
 __initialized__ = False
 if not __initialized__:
     import oelex
     oelexer = ply.lex.lex(module=oelex)
+    import fastlex
+    fastlexer = fastlex.FastLexer(oelexer.lextokens)
     __initialized__ = True
 
 
@@ -43,6 +46,14 @@ class ParseError(Exception):
         else:
             self.filename = "<unknown file>",
 
+        # parsers are reused when done parsing an included file, so
+        # the include chain must be recorded now
+        self.included_from = []
+        parent = self.parser.parent
+        while parent:
+            self.included_from.append(parent.filename)
+            parent = parent.parent
+
         if isinstance(self.details, ply.yacc.YaccProduction):
             self.errlineno -= 1
             self.symbol = None
@@ -117,13 +128,10 @@ class ParseError(Exception):
                                   "^"*len(self.symbol or ""))
                 else:
                     print ""
-        if self.parser.parent:
-            parent = self.parser.parent
-            print "Included from %s"%(parent.filename)
-            parent = parent.parent
-            while parent:
-                print "              %s"%(parent.filename)
-                parent = parent.parent
+        if self.included_from:
+            print "Included from %s"%(self.included_from[0])
+            for filename in self.included_from[1:]:
+                print "              %s"%(filename)
         if self.more_details:
             if "print_details" in dir(self.more_details):
                 self.more_details.print_details()
@@ -152,7 +160,7 @@ class FileNotFound(ParseError):
 __all__ = [
     "oelex", "oeparse", "confparse",
     "ParseError", "StatementNotAllowed", "FileNotFound",
-    "oelexer",
+    "oelexer", "fastlexer",
     ]
 
 import oelex
@@ -6,6 +6,9 @@ import ply.yacc
 
 class ConfParser(OEParser):
 
+    # Configuration files are only parsed once
+    use_snapshots = False
+
     def __init__(self, data=None, parent=None, **kwargs):
         super(ConfParser, self).__init__(data, parent, **kwargs)
         return
@@ -19,12 +19,23 @@ if not __initialized__:
 
 class DocParser(oelite.parse.oeparse.OEParser):
 
+    use_snapshots = False
+
     def __init__(self, meta=None, parent=None, **kwargs):
+        self.reset_doc()
+        super(DocParser, self).__init__(meta, parent, lexer=doclexer, **kwargs)
+        return
+
+    def reset_doc(self):
         self.body = ""
         self.vars = {}
         self.useflags = {}
         self.inherits = []
-        super(DocParser, self).__init__(meta, parent, lexer=doclexer, **kwargs)
+        return
+
+    def release(self):
+        self.reset_doc()
+        super(DocParser, self).release()
         return
 
     def p_statement_doc_section(self, p):
@@ -0,0 +1,602 @@
+"""Hand-written scanner for the OE-lite metadata language.
+
+FastLexer produces exactly the same token stream as the PLY lexer
+defined in oelex.py, including line numbers, lexer positions, lexer
+states and errors, but instead of trying the master regular expression
+of the current state and calling a rule function for each token, it
+dispatches on the current state and the next character, only using
+(small) regular expressions for scanning the token value.
+
+The scanner functions below must be kept in sync with the rules in
+oelex.py, which remains the reference definition of the language.
+Note that in each state, PLY tries the rules in the order they are
+defined in oelex.py, and the first matching rule wins.
+"""
+
+import oelite.parse
+import oelex
+
+import ply.lex
+import re
+
+
+VARNAME_RE = re.compile(r'[a-zA-Z_][a-zA-Z0-9_\-\${}\+\.]*')
+OVERRIDE_RE = re.compile(r':[a-zA-Z0-9\-_]+')
+OVERRIDE2_RE = re.compile(r':[\>\<][a-zA-Z0-9\-_]+')
+FLAG_RE = re.compile(r'\[[a-zA-Z_][a-zA-Z0-9_]*\]')
+NEWLINES_RE = re.compile(r'\n+')
+FUNCSTART_RE = re.compile(r'\(\)[ \t]*\{[ \t]*\n')
+NONSPACE_RE = re.compile(r'\S+')
+DEFNAME_RE = re.compile(r'[a-zA-Z_][a-zA-Z0-9_]*')
+DEFARGS_RE = re.compile(r'[^:\(\)]+')
+DEFARGSTOP_RE = re.compile(r'\)[ \t]*:[ \t]*')
+TASK_RE = re.compile(r'[a-zA-Z_]+')
+HOOK_RE = re.compile(r'[a-zA-Z][a-zA-Z0-9_]*')
+PACKAGENAME_RE = re.compile(r'[a-z][a-z0-9\-\+]*')
+RECIPENAME_RE = re.compile(r'[a-z][a-z0-9\-\+_/\.]*')
+VERSIONNAME_RE = re.compile(r'[0-9\.a-z\-]+')
+NUMBER_RE = re.compile(r'\d+')
+DQUOTE_STRING_RE = re.compile(r'(\\"|\\\n|[^"\n])+')
+SQUOTE_STRING_RE = re.compile(r"(\\'|\\\n|[^'\n])+")
+TRIPLEDQUOTE_STRING_RE = re.compile(
+    r'([^"\\\n]|\\[0-7]{1,3}|\\x[0-9a-fA-F]{2}|\\[^0-7x\n])+')
+TRIPLESQUOTE_STRING_RE = re.compile(
+    r"([^'\\\n]|\\[0-7]{1,3}|\\x[0-9a-fA-F]{2}|\\[^0-7x\n])+")
+LINE_CONTINUATION_RE = re.compile(r"(\s+\\\n(\s+)?)|(\\\n\s+)")
+
+LETTERS = "abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ"
+DIGITS = "0123456789"
+LOWERCASE = "abcdefghijklmnopqrstuvwxyz"
+WHITESPACE = " \t\n\r\f\v"
+
+# state pushed when a reserved word is lexed in INITIAL state
+reserved_states = {
+    'INCLUDE'	: 'include',
+    'REQUIRE'	: 'include',
+    'INHERIT'	: 'inherit',
+    'ADDTASK'	: 'addtask',
+    'ADDHOOK'	: 'addhook',
+    'DEF'	: 'def',
+    'PREFER'	: 'prefer',
+    }
+
+
+class FastLexer(ply.lex.Lexer):
+
+    def __init__(self, lextokens):
+        ply.lex.Lexer.__init__(self)
+        # use the token map of the PLY lexer, so that parsers get the
+        # same list of tokens, and thus the same parse table signature
+        self.lextokens = lextokens
+        self.begin("INITIAL")
+        return
+
+    def begin(self, state):
+        if not state in scanners:
+            raise ValueError("Undefined state")
+        self.lexstate = state
+        return
+
+    def token(self):
+        return scanners[self.lexstate](self)
+
+
+def token(lexer, type, value, lexpos, end):
+    tok = ply.lex.LexToken()
+    tok.type = type
+    tok.value = value
+    tok.lineno = lexer.lineno
+    tok.lexpos = lexpos
+    tok.lexer = lexer
+    lexer.lexpos = end
+    return tok
+
+
+def push(lexer, state):
+    lexer.lexstatestack.append(lexer.lexstate)
+    lexer.lexstate = state
+    return
+
+
+def pop(lexer):
+    lexer.lexstate = lexer.lexstatestack.pop()
+    return
+
+
+def eof(lexer, pos):
+    lexer.lexpos = pos + 1
+    return None
+
+
+def error(lexer, pos):
+    tok = ply.lex.LexToken()
+    tok.type = "error"
+    tok.value = lexer.lexdata[pos:]
+    tok.lineno = lexer.lineno
+    tok.lexpos = pos
+    tok.lexer = lexer
+    lexer.lexpos = pos
+    # ParseError-8
+    raise oelite.parse.ParseError(lexer.parser, "Illegal character", tok)
+
+
+def lex_INITIAL(lexer):
+    data = lexer.lexdata
+    pos = lexer.lexpos
+    n = lexer.lexlen
+    while pos < n:
+        c = data[pos]
+        if c == " " or c == "\t":
+            pos += 1
+            continue
+        if c in LETTERS or c == "_":
+            end = VARNAME_RE.match(data, pos).end()
+            value = data[pos:end]
+            type = oelex.reserved.get(value, 'VARNAME')
+            tok = token(lexer, type, value, pos, end)
+            if type != 'VARNAME' and type in reserved_states:
+                push(lexer, reserved_states[type])
+            return tok
+        if c == "\n":
+            end = NEWLINES_RE.match(data, pos).end()
+            tok = token(lexer, 'NEWLINE', data[pos:end], pos, end)
+            lexer.lineno += end - pos
+            return tok
+        if c == "#":
+            # COMMENT, token discarded
+            pos = data.find("\n", pos)
+            if pos < 0:
+                pos = n
+            continue
+        if c == ":":
+            m = OVERRIDE_RE.match(data, pos)
+            if m:
+                end = m.end()
+                return token(lexer, 'OVERRIDE', ('', data[pos+1:end]),
+                             pos, end)
+            m = OVERRIDE2_RE.match(data, pos)
+            if m:
+                end = m.end()
+                return token(lexer, 'OVERRIDE',
+                             (data[pos+1], data[pos+2:end]), pos, end)
+            if data.startswith(":=", pos):
+                return assign_token(lexer, 'EXPASSIGN', pos, 2)
+            error(lexer, pos)
+        if c == "=":
+            if data.startswith("=+", pos):
+                return assign_token(lexer, 'PREPEND', pos, 2)
+            if data.startswith("=.", pos):
+                return assign_token(lexer, 'POSTDOT', pos, 2)
+            return assign_token(lexer, 'ASSIGN', pos, 1)
+        if c == "[":
+            m = FLAG_RE.match(data, pos)
+            if m:
+                end = m.end()
+                return token(lexer, 'FLAG', data[pos+1:end-1], pos, end)
+        elif c == "+":
+            if data.startswith("+=", pos):
+                return assign_token(lexer, 'APPEND', pos, 2)
+        elif c == ".":
+            if data.startswith(".=", pos):
+                return assign_token(lexer, 'PREDOT', pos, 2)
+        elif c == "?":
+            if data.startswith("??=", pos):
+                return assign_token(lexer, 'LAZYASSIGN', pos, 3)
+            if data.startswith("?=", pos):
+                return assign_token(lexer, 'WEAKASSIGN', pos, 2)
+        elif c == "(":
+            m = FUNCSTART_RE.match(data, pos)
+            if m:
+                end = m.end()
+                tok = token(lexer, 'FUNCSTART', data[pos:end], pos, end)
+                push(lexer, 'func')
+                lexer.lineno += 1
+                return tok
+        error(lexer, pos)
+    return eof(lexer, pos)
+
+
+def assign_token(lexer, type, pos, length):
+    end = pos + length
+    tok = token(lexer, type, lexer.lexdata[pos:end], pos, end)
+    push(lexer, 'assign')
+    return tok
+
+
+def lex_def(lexer):
+    data = lexer.lexdata
+    pos = lexer.lexpos
+    n = lexer.lexlen
+    while pos < n:
+        c = data[pos]
+        if c == " " or c == "\t":
+            pos += 1
+            continue
+        if c in LETTERS or c == "_":
+            end = DEFNAME_RE.match(data, pos).end()
+            return token(lexer, 'VARNAME', data[pos:end], pos, end)
+        if c == "(":
+            tok = token(lexer, 'ARGSTART', c, pos, pos + 1)
+            push(lexer, 'defargs')
+            return tok
+        if c == "\n":
+            tok = token(lexer, 'NEWLINE', c, pos, pos + 1)
+            lexer.lineno += 1
+            push(lexer, 'defbody')
+            return tok
+        error(lexer, pos)
+    return eof(lexer, pos)
+
+
+def lex_defargs(lexer):
+    data = lexer.lexdata
+    pos = lexer.lexpos
+    if pos >= lexer.lexlen:
+        return eof(lexer, pos)
+    c = data[pos]
+    if c != ":" and c != "(" and c != ")":
+        end = DEFARGS_RE.match(data, pos).end()
+        return token(lexer, 'STRING', data[pos:end], pos, end)
+    m = DEFARGSTOP_RE.match(data, pos)
+    if m:
+        end = m.end()
+        tok = token(lexer, 'ARGSTOP', data[pos:end], pos, end)
+        pop(lexer)
+        return tok
+    error(lexer, pos)
+
+
+def lex_defbody(lexer):
+    data = lexer.lexdata
+    pos = lexer.lexpos
+    n = lexer.lexlen
+    if pos >= n:
+        return eof(lexer, pos)
+    c = data[pos]
+    if not c in WHITESPACE:
+        tok = token(lexer, 'FUNCSTOP', c, pos, pos)
+        pop(lexer)
+        pop(lexer)
+        return tok
+    end = data.find("\n", pos) + 1
+    if end == 0:
+        end = n
+    tok = token(lexer, 'FUNCLINE', data[pos:end], pos, end)
+    lexer.lineno += 1
+    return tok
+
+
+def lex_func(lexer):
+    data = lexer.lexdata
+    pos = lexer.lexpos
+    if pos >= lexer.lexlen:
+        return eof(lexer, pos)
+    if data[pos] == "}":
+        tok = token(lexer, 'FUNCSTOP', "}", pos, pos + 1)
+        pop(lexer)
+        return tok
+    end = data.find("\n", pos) + 1
+    if end == 0:
+        error(lexer, pos)
+    tok = token(lexer, 'FUNCLINE', data[pos:end], pos, end)
+    lexer.lineno += 1
+    return tok
+
+
+def lex_filename(lexer, type):
+    data = lexer.lexdata
+    pos = lexer.lexpos
+    n = lexer.lexlen
+    while pos < n:
+        c = data[pos]
+        if c == " " or c == "\t":
+            pos += 1
+            continue
+        if c == "\n":
+            tok = token(lexer, 'NEWLINE', c, pos, pos + 1)
+            lexer.lineno += 1
+            pop(lexer)
+            return tok
+        if not c in WHITESPACE:
+            end = NONSPACE_RE.match(data, pos).end()
+            return token(lexer, type, data[pos:end], pos, end)
+        error(lexer, pos)
+    return eof(lexer, pos)
+
+
+def lex_include(lexer):
+    return lex_filename(lexer, 'INCLUDEFILE')
+
+
+def lex_inherit(lexer):
+    return lex_filename(lexer, 'INHERITCLASS')
+
+
+def lex_addtask(lexer):
+    data = lexer.lexdata
+    pos = lexer.lexpos
+    n = lexer.lexlen
+    while pos < n:
+        c = data[pos]
+        if c == " " or c == "\t":
+            pos += 1
+            continue
+        if c in LETTERS or c == "_":
+            end = TASK_RE.match(data, pos).end()
+            value = data[pos:end]
+            return token(lexer, oelex.addtask_reserved.get(value, 'TASK'),
+                         value, pos, end)
+        if c == "\n":
+            tok = token(lexer, 'NEWLINE', c, pos, pos + 1)
+            lexer.lineno += 1
+            pop(lexer)
+            return tok
+        error(lexer, pos)
+    return eof(lexer, pos)
+
+
+def lex_addhook(lexer):
+    data = lexer.lexdata
+    pos = lexer.lexpos
+    n = lexer.lexlen
+    while pos < n:
+        c = data[pos]
+        if c == " " or c == "\t":
+            pos += 1
+            continue
+        if c in LETTERS:
+            end = HOOK_RE.match(data, pos).end()
+            value = data[pos:end]
+            if value in oelex.addhook_hooknames:
+                return token(lexer, 'HOOKNAME', value, pos, end)
+            if value in oelex.addhook_sequencenames:
+                return token(lexer, 'HOOKSEQUENCE',
+                             oelex.addhook_sequencenames.index(value),
+                             pos, end)
+            return token(lexer, oelex.addhook_reserved.get(value, 'HOOK'),
+                         value, pos, end)
+        if c == "\n":
+            tok = token(lexer, 'NEWLINE', c, pos, pos + 1)
+            lexer.lineno += 1
+            pop(lexer)
+            return tok
+        error(lexer, pos)
+    return eof(lexer, pos)
+
+
+def lex_prefer(lexer):
+    data = lexer.lexdata
+    pos = lexer.lexpos
+    n = lexer.lexlen
+    while pos < n:
+        c = data[pos]
+        if c == " " or c == "\t":
+            pos += 1
+            continue
+        for (value, type, state) in prefer_keywords:
+            if data.startswith(value, pos):
+                tok = token(lexer, type, value, pos, pos + len(value))
+                push(lexer, state)
+                return tok
+        if c == "\n":
+            tok = token(lexer, 'NEWLINE', c, pos, pos + 1)
+            lexer.lineno += 1
+            pop(lexer)
+            return tok
+        error(lexer, pos)
+    return eof(lexer, pos)
+
+prefer_keywords = (
+    ('package', 'PACKAGE', 'preferpackage'),
+    ('recipe', 'RECIPE', 'preferrecipe'),
+    ('layer', 'LAYER', 'preferlayer'),
+    ('version', 'VERSION', 'preferversion'),
+    )
+
+
+def lex_preferpackage(lexer):
+    data = lexer.lexdata
+    pos = lexer.lexpos
+    n = lexer.lexlen
+    while pos < n:
+        c = data[pos]
+        if c == " " or c == "\t":
+            pos += 1
+            continue
+        if c in LOWERCASE:
+            end = PACKAGENAME_RE.match(data, pos).end()
+            tok = token(lexer, 'PACKAGENAME', data[pos:end], pos, end)
+            push(lexer, 'packages')
+            return tok
+        error(lexer, pos)
+    return eof(lexer, pos)
+
+
+def lex_packages(lexer):
+    data = lexer.lexdata
+    pos = lexer.lexpos
+    n = lexer.lexlen
+    while pos < n:
+        c = data[pos]
+        if c == ",":
+            pos += 1
+            continue
+        if c in LOWERCASE:
+            end = PACKAGENAME_RE.match(data, pos).end()
+            return token(lexer, 'PACKAGENAME', data[pos:end], pos, end)
+        if c == " " or c == "\t":
+            # WHITESPACE, token discarded
+            lexer.lexpos = pos + 1
+            pop(lexer)
+            pop(lexer)
+            return scanners[lexer.lexstate](lexer)
+        if c == "\n":
+            tok = token(lexer, 'NEWLINE', c, pos, pos + 1)
+            lexer.lineno += 1
+            pop(lexer)
+            pop(lexer)
+            pop(lexer)
+            return tok
+        error(lexer, pos)
+    return eof(lexer, pos)
+
+
+def lex_name(lexer, type, first, regex):
+    data = lexer.lexdata
+    pos = lexer.lexpos
+    n = lexer.lexlen
+    while pos < n:
+        c = data[pos]
+        if c == " " or c == "\t":
+            pos += 1
+            continue
+        if c in first:
+            end = regex.match(data, pos).end()
+            tok = token(lexer, type, data[pos:end], pos, end)
+            pop(lexer)
+            return tok
+        error(lexer, pos)
+    return eof(lexer, pos)
+
+
+def lex_preferrecipe(lexer):
+    return lex_name(lexer, 'RECIPENAME', LOWERCASE, RECIPENAME_RE)
+
+
+def lex_preferlayer(lexer):
+    return lex_name(lexer, 'LAYERNAME', LOWERCASE, RECIPENAME_RE)
+
+
+def lex_preferversion(lexer):
+    return lex_name(lexer, 'VERSIONNAME', LOWERCASE + DIGITS + ".-",
+                    VERSIONNAME_RE)
+
+
+def lex_assign(lexer):
+    data = lexer.lexdata
+    pos = lexer.lexpos
+    n = lexer.lexlen
+    while pos < n:
+        c = data[pos]
+        if c == " " or c == "\t":
+            pos += 1
+            continue
+        if c == '"':
+            if data.startswith('"""', pos):
+                tok = token(lexer, 'QUOTE', '"""', pos, pos + 3)
+                push(lexer, 'tripledquote')
+            else:
+                tok = token(lexer, 'QUOTE', c, pos, pos + 1)
+                push(lexer, 'dquote')
+            return tok
+        if c == "'":
+            if data.startswith("'''", pos):
+                tok = token(lexer, 'QUOTE', "'''", pos, pos + 3)
+                push(lexer, 'triplesquote')
+            else:
+                tok = token(lexer, 'QUOTE', c, pos, pos + 1)
+                push(lexer, 'squote')
+            return tok
+        if c in DIGITS:
+            end = NUMBER_RE.match(data, pos).end()
+            tok = token(lexer, 'STRING', data[pos:end], pos, end)
+            pop(lexer)
+            return tok
+        if data.startswith("True", pos):
+            tok = token(lexer, 'STRING', "1", pos, pos + 4)
+            pop(lexer)
+            return tok
+        if data.startswith("False", pos):
+            tok = token(lexer, 'STRING', "0", pos, pos + 5)
+            pop(lexer)
+            return tok
+        if c == "\n":
+            error(lexer, pos)
+        end = data.find("\n", pos)
+        if end < 0:
+            end = n
+        tok = token(lexer, 'UNQUOTEDSTRING', data[pos:end], pos, end)
+        # ParseError-7
+        raise oelite.parse.ParseError(lexer.parser, "Unquoted string", tok)
+    return eof(lexer, pos)
+
+
+def lex_quote(lexer, quote, regex):
+    data = lexer.lexdata
+    pos = lexer.lexpos
+    if pos >= lexer.lexlen:
+        return eof(lexer, pos)
+    m = regex.match(data, pos)
+    if m:
+        end = m.end()
+        value = data[pos:end]
+        tok = token(lexer, 'STRING', None, pos, end)
+        lexer.lineno += value.count("\n")
+        value = LINE_CONTINUATION_RE.sub(" ", value)
+        tok.value = value.decode("string-escape")
+        return tok
+    c = data[pos]
+    if c == quote:
+        tok = token(lexer, 'QUOTE', c, pos, pos + 1)
+        pop(lexer)
+        pop(lexer)
+        return tok
+    # c == "\n"
+    tok = token(lexer, 'UNTERMINATEDSTRING', c, pos, pos + 1)
+    lexer.lineno += 1
+    # ParseError-5 and ParseError-6
+    raise oelite.parse.ParseError(lexer.parser, "Unterminated string", tok)
+
+
+def lex_dquote(lexer):
+    return lex_quote(lexer, '"', DQUOTE_STRING_RE)
+
+
+def lex_squote(lexer):
+    return lex_quote(lexer, "'", SQUOTE_STRING_RE)
+
+
+def lex_triplequote(lexer, regex):
+    data = lexer.lexdata
+    pos = lexer.lexpos
+    if pos >= lexer.lexlen:
+        return eof(lexer, pos)
+    m = regex.match(data, pos)
+    if m:
+        end = m.end()
+        return token(lexer, 'STRING', data[pos:end].decode("string-escape"),
+                     pos, end)
+    c = data[pos]
+    if c == "\\" and data.startswith("\\\n", pos):
+        tok = token(lexer, 'STRING', "", pos, pos + 2)
+        lexer.lineno += 1
+        return tok
+    if c == "\n":
+        tok = token(lexer, 'STRING', c, pos, pos + 1)
+        lexer.lineno += 1
+        return tok
+    if c == '"':
+        # both triple quoted string states end with """
+        if data.startswith('"""', pos):
+            tok = token(lexer, 'QUOTE', '"""', pos, pos + 3)
+            pop(lexer)
+            pop(lexer)
+            return tok
+        if data.startswith('""', pos):
+            return token(lexer, 'STRING', '""', pos, pos + 2)
+        return token(lexer, 'STRING', c, pos, pos + 1)
+    error(lexer, pos)
+
+
+def lex_tripledquote(lexer):
+    return lex_triplequote(lexer, TRIPLEDQUOTE_STRING_RE)
+
+
+def lex_triplesquote(lexer):
+    return lex_triplequote(lexer, TRIPLESQUOTE_STRING_RE)
+
+
+# lexer state -> scanner function
+scanners = {}
+for (state, statetype) in (('INITIAL', 'inclusive'),) + oelex.states:
+    scanners[state] = globals()["lex_" + state]
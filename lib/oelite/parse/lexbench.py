@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+"""Compare the PLY lexer and the hand-written fast lexer.
+
+Usage: lexbench.py [TOPDIR [ITERATIONS]]
+
+Lexes all recipe, class, include and configuration files found in the
+classes, conf and recipes directories of TOPDIR (default is the current
+directory) with both lexers, checks that the lexers produce identical
+tokens (and lexer states) for all files, and prints the time spent by
+each lexer for lexing all files ITERATIONS (default 10) times.
+"""
+
+import sys
+import os
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, os.pardir))
+
+import oelite.parse
+from oelite.parse.oeparse import OEParser
+
+
+DIRECTORIES = ("classes", "conf", "recipes")
+EXTENSIONS = (".oe", ".oeclass", ".inc", ".conf")
+
+
+def find_files(topdir):
+    files = []
+    for directory in DIRECTORIES:
+        for (dirpath, dirnames, filenames) in os.walk(
+            os.path.join(topdir, directory)):
+            dirnames.sort()
+            for filename in sorted(filenames):
+                if filename.endswith(EXTENSIONS):
+                    files.append(os.path.join(dirpath, filename))
+    return files
+
+
+def read_file(filename):
+    with open(filename) as f:
+        # same input as given to the lexer by OEParser._parse()
+        return f.read() + '\n#EOF'
+
+
+def start(parser, filename, text):
+    parser.filename = filename
+    parser.text = text
+    parser.reset_lexstate()
+    parser.lexer.lineno = 0
+    parser.lexer.input(text)
+    return parser.lexer
+
+
+def lex(parser, filename, text):
+    """Return the list of tokens lexed from text, with the lexer state
+    after each token, and the error raised (if any)."""
+    lexer = start(parser, filename, text)
+    tokens = []
+    error = None
+    try:
+        while True:
+            tok = lexer.token()
+            if tok is None:
+                break
+            tokens.append((tok.type, tok.value, tok.lineno, tok.lexpos,
+                           lexer.lineno, lexer.lexpos, lexer.lexstate))
+    except Exception, e:
+        error = "%s: %s"%(e.__class__.__name__, e)
+    tokens.append((lexer.lineno, lexer.lexpos, lexer.lexstate))
+    return (tokens, error)
+
+
+def benchmark(parser, files, iterations):
+    start_time = time.time()
+    for i in xrange(iterations):
+        for (filename, text) in files:
+            lexer = start(parser, filename, text)
+            token = lexer.token
+            while token():
+                pass
+    return time.time() - start_time
+
+
+def main(topdir=".", iterations=10):
+    iterations = int(iterations)
+    os.chdir(topdir)
+    files = [(filename, read_file(filename)) for filename in find_files(".")]
+    plyparser = OEParser(lexer=oelite.parse.oelexer)
+    fastparser = OEParser(lexer=oelite.parse.fastlexer)
+
+    ntokens = 0
+    mismatches = 0
+    for (filename, text) in files:
+        (ply_tokens, ply_error) = lex(plyparser, filename, text)
+        (fast_tokens, fast_error) = lex(fastparser, filename, text)
+        ntokens += len(ply_tokens) - 1
+        if ply_tokens == fast_tokens and ply_error == fast_error:
+            continue
+        mismatches += 1
+        print "MISMATCH %s"%(filename)
+        for i in xrange(min(len(ply_tokens), len(fast_tokens))):
+            if ply_tokens[i] != fast_tokens[i]:
+                print "  ply:  %r"%(ply_tokens[i],)
+                print "  fast: %r"%(fast_tokens[i],)
+                break
+        if ply_error != fast_error:
+            print "  ply:  %s"%(ply_error)
+            print "  fast: %s"%(fast_error)
+    print "%d files, %d tokens, %d mismatches"%(
+        len(files), ntokens, mismatches)
+    if mismatches:
+        return 1
+
+    for (name, parser) in (("ply", plyparser), ("fast", fastparser)):
+        seconds = benchmark(parser, files, iterations)
+        print "%-5s %.3f s (%d iterations, %.1f us/token)"%(
+            name + ":", seconds, iterations,
+            seconds * 1e6 / (ntokens * iterations))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(*sys.argv[1:]))
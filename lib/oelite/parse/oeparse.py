@@ -6,13 +6,64 @@ import oelite.meta
 import oelite.path
 import oelite.util
 
+
+# (parser class, filename) -> (mtime, text, reductions)
+snapshots = {}
+
+# parser class -> list of idle parsers for parsing included files
+idle_parsers = {}
+
+
 class OEParser(object):
 
+    """Parser of OE-lite recipe, class and include files.
+
+    Class and include files are parsed once, into a snapshot of the
+    grammar rule reductions done when parsing them.  The reductions of
+    rules modifying or depending on the metadata are replayed (by
+    calling the same p_ functions) when parsing the file again, fx. for
+    the next recipe inheriting the same class, so that the file is not
+    lexed and parsed again.  As the reductions only depend on the text
+    of the file, a snapshot is used until the file mtime changes.
+    """
+
+    # Parsers collecting other state than the metadata (fx. DocParser)
+    # must parse each file for real.
+    use_snapshots = True
+
+    # Lex with the hand-written lexer (see fastlex.py) instead of the
+    # PLY lexer (see oelex.py), when no lexer is given.
+    fast_lexer = True
+
+    # Grammar rules not modifying or depending on the metadata.  The
+    # values of these are computed when parsing the file into a
+    # snapshot, and they are only replayed when needed for computing
+    # values depending on the metadata.
+    PURE_RULES = frozenset([
+        "p_syntax", "p_statement", "p_variable", "p_flag", "p_string",
+        "p_empty_string", "p_quoted_string", "p_string_value1",
+        "p_string_value2", "p_inherit_classes", "p_inherit_classes2",
+        "p_addtask_task", "p_addtask_dependencies1",
+        "p_addtask_dependencies2", "p_addtask_dependency",
+        "p_addtask_after", "p_addtask_before", "p_tasks", "p_tasks2",
+        "p_addhook_dependencies1", "p_addhook_dependencies2",
+        "p_addhook_dependency", "p_addhook_after", "p_addhook_before",
+        "p_hooks", "p_hooks2", "p_recipe", "p_maybe_recipe1",
+        "p_maybe_recipe2", "p_layer", "p_maybe_layer1", "p_maybe_layer2",
+        "p_version", "p_maybe_version1", "p_maybe_version2",
+        "p_packages", "p_package1", "p_packages2", "p_func_body",
+        "p_func_body2", "p_python_func_start", "p_def_args1",
+        "p_def_args2",
+        ])
+
     def __init__(self, meta=None, parent=None, lexer=None):
         import oelite
         if lexer is None:
             import oelite.parse
-            lexer = oelite.parse.oelexer
+            if self.fast_lexer:
+                lexer = oelite.parse.fastlexer
+            else:
+                lexer = oelite.parse.oelexer
         self.lexer = lexer.clone()
         self.lexer.parser = self
         if type(lexer.lextokens) == set:
@@ -589,7 +640,7 @@ class OEParser(object):
             __inherits = self.meta["__inherits"]
             if filename in __inherits:
                 return
-            self.meta["__inherits"].append(filename)
+            self.meta["__inherits"] = __inherits + [filename]
         self.include(filename, p, require=True)
 
 
@@ -600,8 +651,44 @@ class OEParser(object):
             #print "ignoring include of in-expandable filename:", filename
             return None
         #print "including", filename
-        parser = self.__class__(self.meta, parent=self)
-        return parser.parse(filename, require, parser, p)
+        parser = self.include_parser()
+        try:
+            return parser.parse(filename, require, parser, p)
+        finally:
+            parser.release()
+
+
+    def include_parser(self):
+        """Return a parser for parsing a file included from this parser.
+
+        Constructing a parser is expensive, as ply.yacc.yacc() has to
+        reflect on all the grammar rules and load the parse tables, and
+        included files are parsed thousands of times per bake.  Parsers
+        are therefore kept for reuse when done parsing an included file
+        (see release()), so that only as many parsers as the maximum
+        include depth are constructed.
+        """
+        idle = idle_parsers.get(self.__class__)
+        if not idle:
+            return self.__class__(self.meta, parent=self)
+        parser = idle.pop()
+        parser.reset_lexstate()
+        parser.set_metadata(self.meta)
+        parser.parent = self
+        return parser
+
+
+    def release(self):
+        """Return an include parser to the pool of idle parsers."""
+        # forget the parsed file, so that a reused parser is in the
+        # same state as a new one
+        for attr in ("filename", "text"):
+            if attr in self.__dict__:
+                del self.__dict__[attr]
+        self.parent = None
+        self.meta = None
+        idle_parsers.setdefault(self.__class__, []).append(self)
+        return
 
 
     def parse(self, filename, require=True, parser=None, p=None, debug=False):
@@ -652,13 +739,30 @@ class OEParser(object):
 
         # FIXME: write lock file to safeguard against race condition
         mtime = os.path.getmtime(self.filename)
-        f = open(self.filename)
-        self.text = f.read()
-        f.close()
+        snapshot = None
+        use_snapshot = (self.use_snapshots and not debug and
+                        not self.filename.endswith(".oe"))
+        if use_snapshot:
+            snapshot_key = (self.__class__, self.filename)
+            snapshot = snapshots.get(snapshot_key)
+            if snapshot is not None and snapshot[0] != mtime:
+                snapshot = None
+        if snapshot is not None:
+            self.text = snapshot[1]
+        else:
+            f = open(self.filename)
+            self.text = f.read()
+            f.close()
         self.meta.set_input_mtime(searchfn, oepath, mtime)
 
         if not parser:
             parser = self
+        if snapshot is not None:
+            return parser.replay(snapshot[2])
+        if use_snapshot:
+            reductions = parser.record(self.text)
+            snapshots[snapshot_key] = (mtime, self.text, reductions)
+            return self.meta
         return parser._parse(self.text, debug=debug)
 
 
@@ -670,6 +774,109 @@ class OEParser(object):
         return self.meta
 
 
+    def record(self, s):
+        """Parse s, and return the reductions to replay for parsing it
+        again."""
+        reductions = []
+        symbols = {}
+        lexer = self.lexer
+        def recorder(function, name):
+            def record_reduction(p):
+                args = []
+                for symbol in p.slice[1:]:
+                    if symbol in symbols:
+                        args.append((True, symbols[symbol]))
+                    else:
+                        args.append((False, symbol.value))
+                reduction = (name, args, lexer.lineno, lexer.lexpos)
+                function(p)
+                symbols[p.slice[0]] = len(reductions)
+                reductions.append(reduction + (p.slice[0].value,))
+            return record_reduction
+        productions = [(production, production.callable)
+                       for production in self.yacc.productions
+                       if production.callable is not None]
+        for (production, function) in productions:
+            production.callable = recorder(function, production.func)
+        try:
+            self._parse(s)
+        finally:
+            for (production, function) in productions:
+                production.callable = function
+        return compile_reductions(reductions, self.PURE_RULES)
+
+
+    def replay(self, reductions):
+        p = ply.yacc.YaccProduction(None)
+        p.lexer = lexer = self.lexer
+        p.parser = self.yacc
+        values = []
+        for (name, args, lineno, lexpos) in reductions:
+            p.slice = [ReplaySymbol()]
+            for (ref, value) in args:
+                if ref:
+                    value = values[value]
+                p.slice.append(ReplaySymbol(value))
+            lexer.lineno = lineno
+            lexer.lexpos = lexpos
+            getattr(self, name)(p)
+            values.append(p.slice[0].value)
+        return self.meta
+
+
     def yacctest(self, s):
         self.meta = oelite.meta.DictMeta()
         return self._parse(s)
+
+
+class ReplaySymbol(object):
+
+    __slots__ = ("value",)
+
+    def __init__(self, value=None):
+        self.value = value
+        return
+
+
+def compile_reductions(reductions, pure_rules):
+    """Return the reductions needed for replaying a parse, from a list
+    of (rule, args, lineno, lexpos, value) reductions, where args is a
+    list of (ref, value) tuples, and value is the index of the
+    reduction giving the argument when ref is True.
+
+    The values of reductions of pure rules with only constant arguments
+    are used as constant arguments, and other pure reductions are only
+    kept when their value is needed by a reduction that is kept.  In
+    the returned (rule, args, lineno, lexpos) reductions, argument
+    references are indexes in the returned list."""
+    constants = {}
+    for (i, (rule, args, lineno, lexpos, value)) in enumerate(reductions):
+        if rule in pure_rules and not [ref for (ref, arg) in args
+                                       if ref and not arg in constants]:
+            constants[i] = value
+    needed = set()
+    for i in reversed(xrange(len(reductions))):
+        if i in constants:
+            continue
+        (rule, args, lineno, lexpos, value) = reductions[i]
+        if rule in pure_rules and not i in needed:
+            continue
+        needed.add(i)
+        for (ref, arg) in args:
+            if ref and not arg in constants:
+                needed.add(arg)
+    index = {}
+    replay = []
+    for i in sorted(needed):
+        (rule, args, lineno, lexpos, value) = reductions[i]
+        replay_args = []
+        for (ref, arg) in args:
+            if not ref:
+                replay_args.append((False, arg))
+            elif arg in constants:
+                replay_args.append((False, constants[arg]))
+            else:
+                replay_args.append((True, index[arg]))
+        index[i] = len(replay)
+        replay.append((rule, tuple(replay_args), lineno, lexpos))
+    return replay
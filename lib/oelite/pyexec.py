@@ -1,28 +1,63 @@
 import oelite
 import oelite.util
-from oelite.function import PythonFunction
+import oelite.function
+from oelite.function import PythonFunction, function_key
+from oelite.function import function_template, make_function
 from oelite.meta import *
+from oelite.util import CodeCache
 import os
+import time
 
 
-def inlineeval(source, meta, var=None):
-    g = meta.get_pythonfunc_globals()
-    if var:
+# inline python source -> code object
+inline_code_cache = CodeCache(10000)
+
+# (OE_IMPORTS, function keys) -> imported function templates
+inline_imports_cache = CodeCache(1000)
+
+# hook tmpdirs known to exist
+hook_tmpdirs = set()
+
+# (hook name, function) -> [number of runs, cumulative run time]
+hook_times = {}
+
+
+def inline_imports(meta, var):
+    imports = (meta.get_flag(var, "import", oelite.meta.FULL_EXPANSION)
+               or "").split()
+    if not imports:
+        return {}
+    key = (meta.pythonfunc_imports,
+           tuple([function_key(meta, func, []) for func in imports]))
+    templates = inline_imports_cache.get(key)
+    if templates is None:
         recursion_path = []
-        funcimports = {}
-        for func in (meta.get_flag(var, "import",
-                                   oelite.meta.FULL_EXPANSION)
-                     or "").split():
-            if func in funcimports:
+        templates = []
+        for func in imports:
+            if func in [name for (name, template) in templates]:
                 continue
             if func in recursion_path:
-                raise Exception("circular import %s -> %s"%(recursion_path, func))
-            python_function = PythonFunction(meta, func,
-                                             recursion_path=recursion_path)
-            funcimports[func] = python_function.function
-        g.update(funcimports)
+                raise Exception("circular import %s -> %s"%(
+                        recursion_path, func))
+            templates.append((func, function_template(
+                        meta, func, recursion_path)))
+        inline_imports_cache.set(key, templates)
+    funcimports = {}
+    for (func, template) in templates:
+        funcimports[func] = make_function(meta, template)
+    return funcimports
+
+
+def inlineeval(source, meta, var=None):
+    g = meta.get_pythonfunc_globals()
+    if var:
+        g.update(inline_imports(meta, var))
     try:
-        return eval(source, g, {"d": meta})
+        code = inline_code_cache.get(source)
+        if code is None:
+            code = compile(source, "<string>", "eval")
+            inline_code_cache.set(source, code)
+        return eval(code, g, {"d": meta})
     except Exception:
         print "Exception while evaluating inline python code"
         #print "Exception while evaluating inline python code: %s"%(repr(source))
@@ -33,18 +68,90 @@ def exechooks(meta, name, hooks=None):
     if hooks is None:
         hooks = meta.get_hooks(name)
     tmpdir = os.path.join(meta.get("HOOKTMPDIR"), name)
-    oelite.util.makedirs(tmpdir)
+    if not tmpdir in hook_tmpdirs:
+        oelite.util.makedirs(tmpdir)
+        hook_tmpdirs.add(tmpdir)
     for function in hooks:
+        start = time.time()
         pn = meta.get("PN")
         if pn:
-            name = "%s.%s.%s"%(pn, meta.get("RECIPE_TYPE"), function)
+            hook_name = "%s.%s.%s"%(pn, meta.get("RECIPE_TYPE"), function)
         else:
-            name = function
-        hook = meta.get_pythonfunc(function, name, tmpdir=tmpdir,
+            hook_name = function
+        hook = meta.get_pythonfunc(function, hook_name, tmpdir=tmpdir,
                                    set_os_environ=False)
-        retval = hook.run(tmpdir)
+        try:
+            retval = hook.run(tmpdir)
+        finally:
+            try:
+                hook_time = hook_times[(name, function)]
+            except KeyError:
+                hook_time = hook_times[(name, function)] = [0, 0.0]
+            hook_time[0] += 1
+            hook_time[1] += time.time() - start
         if isinstance(retval, basestring):
-            raise oelite.HookFailed(name, function, retval)
+            raise oelite.HookFailed(hook_name, function, retval)
         elif not retval:
-            raise oelite.HookFailed(name, function, retval)
+            raise oelite.HookFailed(hook_name, function, retval)
     return
+
+
+def code_caches():
+    return (inline_code_cache, inline_imports_cache,
+            oelite.function.python_function_cache)
+
+
+def reset_stats():
+    """Reset hook timing and python code cache statistics."""
+    hook_times.clear()
+    for cache in code_caches():
+        cache.hits = cache.misses = 0
+    return
+
+
+def get_stats():
+    """Return hook timing and python code cache statistics, fx. for
+    passing them from a worker process to add_stats() in the main
+    process."""
+    return (dict([(key, tuple(value))
+                  for (key, value) in hook_times.iteritems()]),
+            [(cache.hits, cache.misses) for cache in code_caches()])
+
+
+def add_stats(stats):
+    """Add statistics returned by get_stats() to the statistics of
+    this process."""
+    (times, cache_stats) = stats
+    for (key, (count, seconds)) in times.iteritems():
+        try:
+            hook_time = hook_times[key]
+        except KeyError:
+            hook_time = hook_times[key] = [0, 0.0]
+        hook_time[0] += count
+        hook_time[1] += seconds
+    for (cache, (hits, misses)) in zip(code_caches(), cache_stats):
+        cache.hits += hits
+        cache.misses += misses
+    return
+
+
+def hook_timing_report(functions=10):
+    """Return lines reporting the cumulative run time of each hook, and
+    of the slowest hook functions."""
+    hook_names = {}
+    for ((name, function), (count, seconds)) in hook_times.iteritems():
+        try:
+            hook_names[name][0] += count
+            hook_names[name][1] += seconds
+        except KeyError:
+            hook_names[name] = [count, seconds]
+    lines = []
+    for (name, (count, seconds)) in sorted(
+        hook_names.iteritems(), key=lambda x: x[1][1], reverse=True):
+        lines.append("%s hooks: %d runs, %.3f s"%(name, count, seconds))
+    for ((name, function), (count, seconds)) in sorted(
+        hook_times.iteritems(), key=lambda x: x[1][1],
+        reverse=True)[:functions]:
+        lines.append("  %s %s: %d runs, %.3f s"%(
+                name, function, count, seconds))
+    return lines
@@ -7,6 +7,7 @@ import sys
 import os
 import cPickle
 import warnings
+import re
 
 
 def unpickle(file, filename, cookbook):
@@ -17,6 +18,8 @@ def unpickle(file, filename, cookbook):
 
 class OEliteRecipe:
 
+    TASKFUNC_RE = re.compile(r"^do_([a-z]+).*?")
+
     def pickle(self, file):
         cPickle.dump(self.type, file, 2)
         self.meta.pickle(file)
@@ -40,6 +43,8 @@ class OEliteRecipe:
         self._hash = None
         self.recipe_deps = set([])
         self.tasks = set([])
+        self._emit = None
+        self._task_omitted_vars = {}
         return
 
 
@@ -65,6 +70,66 @@ class OEliteRecipe:
     def get_packages(self):
         return self.cookbook.get_packages(recipe=self)
 
+
+    def get_emit(self):
+        """Return (emit, omit) of the recipe meta-data, where emit maps
+        the variables restricted to some tasks to the set of tasks they
+        are emitted to, and omit maps task names to the variables omitted
+        from them."""
+        if self._emit is not None:
+            return self._emit
+        meta = self.meta
+        emit_prefixes = (meta.get("META_EMIT_PREFIX") or "").split()
+        def colon_split(s):
+            import string
+            return string.split(s, ":", 1)
+        emit_prefixes = map(colon_split, emit_prefixes)
+        emit_vars = {}
+        omit_vars = {}
+        for var in meta.keys():
+            emit_flag = meta.get_flag(var, "emit")
+            emit = set((emit_flag or "").split())
+            taskfunc_match = self.TASKFUNC_RE.match(var)
+            if taskfunc_match:
+                emit.add(taskfunc_match.group(0))
+            for emit_task, emit_prefix in emit_prefixes:
+                if not var.startswith(emit_prefix):
+                    continue
+                if emit_task == "":
+                    if emit_flag is None:
+                        emit_flag = ""
+                    continue
+                if not emit_task.startswith("do_"):
+                    emit_task = "do_" + emit_task
+                emit.add(emit_task)
+            if emit or emit_flag == "":
+                emit_vars[var] = emit
+            omit = meta.get_flag(var, "omit")
+            if omit is not None:
+                for task in omit.split():
+                    try:
+                        omit_vars[task].add(var)
+                    except KeyError:
+                        omit_vars[task] = set([var])
+        self._emit = (emit_vars, omit_vars)
+        return self._emit
+
+
+    def get_task_omitted_vars(self, task):
+        """Return set of variables not to be included in the meta-data
+        of task, ie. the variables emitted only to other tasks, and the
+        variables omitted from task."""
+        try:
+            return self._task_omitted_vars[task]
+        except KeyError:
+            pass
+        (emit_vars, omit_vars) = self.get_emit()
+        omitted = set([var for (var, emit) in emit_vars.iteritems()
+                       if not task in emit])
+        omitted.update(omit_vars.get(task, ()))
+        self._task_omitted_vars[task] = omitted
+        return omitted
+
     def get_depends(self, deptypes=[]):
         depends = []
         if deptypes:
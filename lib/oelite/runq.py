@@ -1,74 +1,126 @@
 from oebakery import die, err, warn, info, debug
 from oelite import *
-from oelite.dbutil import *
 import oelite.recipe
 
 import sys
 import os
 import copy
 import operator
+import heapq
+
+
+SCHEDULES = ("critical-path", "depth-first", "breadth-first")
+
+# runq task status values
+PENDING = 1
+RUNNING = 2
+DONE = 3
+FAILED = -1
+
+
+class RunqTask(object):
+
+    """Runqueue state of a task.
+
+    depends holds the ids of all dependencies of the task, and rdepends
+    the ids of the dependencies having the task as (not yet cleared)
+    parent_task, ie. the forward and reverse adjacency of the task in
+    the dependency graph.  index is the position of the task in the
+    runqueue, and unmet the number of dependencies on tasks to build
+    which are not done yet.
+    """
+
+    __slots__ = ("id", "index", "prime", "build", "relax", "status",
+                 "metahash", "mtime", "tmphash", "buildhash", "depends",
+                 "rdepends", "unmet")
+
+    def __init__(self, id):
+        self.id = id
+        self.index = None
+        self.unmet = None
+        self.prime = None
+        self.build = None
+        self.relax = None
+        self.status = None
+        self.metahash = None
+        self.mtime = None
+        self.tmphash = None
+        self.buildhash = None
+        self.depends = []
+        self.rdepends = set()
+        return
+
+
+class RunqDepend(object):
+
+    """Dependency of a runqueue task on a parent task, optionally through
+    a package.  parent_task is set to None when the dependency no longer
+    needs to be waited for (fx. when the parent task is done)."""
+
+    __slots__ = ("task", "prime", "parent_task", "deptype", "package",
+                 "filename", "prebake")
+
+    def __init__(self, task, parent_task, deptype="", package=-1):
+        self.task = task
+        self.prime = None
+        self.parent_task = parent_task
+        self.deptype = deptype
+        self.package = package
+        self.filename = None
+        self.prebake = None
+        return
+
 
 class OEliteRunQueue:
 
 
     def __init__(self, config, cookbook, rebuild=None, relax=None,
-                 depth_first=True):
+                 depth_first=True, schedule=None):
         self.cookbook = cookbook
         self.config = config
         # 1: --rebuild, 2: --rebuildall, 3: --reallyrebuildall
         self.rebuild = rebuild
         self.relax = relax
-        self.depth_first = depth_first
+        if schedule is None:
+            if depth_first:
+                schedule = "depth-first"
+            else:
+                schedule = "breadth-first"
+        if not schedule in SCHEDULES:
+            raise ValueError("invalid schedule: %s"%(schedule))
+        self.schedule = schedule
+        self.depth_first = schedule != "breadth-first"
+        self.task_priority = {}
         self._assume_provided = (self.config.get("ASSUME_PROVIDED")
                                 or "").split()
         self.runable = []
         self.metahashable = []
-        self.cookbook.db.execute("ATTACH ':memory:' AS runq")
-        self.dbc = self.cookbook.db.cursor()
-        self.init_db()
+        self.init_graph()
         return
 
 
-    def init_db(self):
-        self.dbc.execute(
-            "CREATE TABLE IF NOT EXISTS runq.provider ( "
-            "type		TEXT, "
-            "item		TEXT, "
-            "version		TEXT, "
-            "package		INTEGER )")
-
-        self.dbc.execute(
-            "CREATE TABLE IF NOT EXISTS runq.task ( "
-            "task		INTEGER, "
-            "prime		INTEGER, "
-            "build		INTEGER, "
-            "relax		INTEGER, "
-            "status		INTEGER, "
-            "metahash		TEXT, "
-            "mtime		REAL, "
-            "tmphash		TEXT, "
-            "buildhash		TEXT, "
-            "UNIQUE (task) ON CONFLICT IGNORE )")
-
-        self.dbc.execute(
-            "CREATE TABLE IF NOT EXISTS runq.depend ( "
-            "id			INTEGER PRIMARY KEY, "
-            "task		INTEGER, " # references task.id
-            "prime		INTEGER, " # boolean
-            "parent_task	INTEGER, " # references task.id
-            "deptype		TEXT DEFAULT '', "
-            "package		INTEGER DEFAULT -1, " # package
-            "filename		TEXT, "
-            "prebake		INTEGER, "
-            "UNIQUE (task, parent_task, deptype, package) "
-            "ON CONFLICT IGNORE )")
-
-        self.dbc.execute(
-            "CREATE TABLE IF NOT EXISTS runq.recdepend ( "
-            "deptype            TEXT, "
-            "package		INTEGER, "
-            "parent_package	INTEGER )")
-
+    def init_graph(self):
+        # task id -> RunqTask, and list (and set of ids) of RunqTask in
+        # the order added
+        self.tasks = {}
+        self.task_list = []
+        self.task_ids = set()
+        # task id -> OEliteTask
+        self.task_objects = {}
+        # depend id -> RunqDepend (None when deleted)
+        self.depends = []
+        # package id -> list of depend ids
+        self.package_depends = {}
+        # (task, parent_task, deptype, package) of all depends with
+        # parent_task set, for ignoring duplicate depends
+        self.depend_keys = set()
+        # (type, item, version) -> package id
+        self.providers = {}
+        # (deptype, package id) -> list of package ids
+        self.recdepends = {}
+        # heap of (index, id) of tasks ready to run, and not yet
+        # returned by get_readytasks(), initialized on first use
+        self.ready = None
         return
 
 
@@ -414,26 +466,12 @@ class OEliteRunQueue:
         return (recipe, package)
 
     def _set_provider(self, item, package):
-        if item.version is None:
-            self.dbc.execute(
-                "INSERT INTO runq.provider (type, item, package) VALUES (?, ?, ?)",
-                (item.type, item.name, package.id))
-        else:
-            self.dbc.execute(
-                "INSERT INTO runq.provider (type, item, version, package) VALUES (?, ?, ?, ?)",
-                (item.type, item.name, item.version, package.id))
+        self.providers[(item.type, item.name, item.version)] = package.id
         return
 
 
     def _get_provider(self, item):
-        if item.version is None:
-            package_id = flatten_single_value(self.dbc.execute(
-                    "SELECT package FROM runq.provider WHERE type=? AND item=? AND version IS NULL",
-                    (item.type, item.name)))
-        else:
-            package_id = flatten_single_value(self.dbc.execute(
-                    "SELECT package FROM runq.provider WHERE type=? AND item=? AND version=?",
-                (item.type, item.name, item.version)))
+        package_id = self.providers.get((item.type, item.name, item.version))
         if not package_id:
             return None
         return self.cookbook.get_package(id=package_id)
@@ -530,22 +568,95 @@ class OEliteRunQueue:
         return
 
 
-    def get_runabletask(self):
+    def get_runabletask(self, accept=None):
+        """Return the next runable task in schedule order, or None if
+        no task is runable.  With accept, return the first runable task
+        for which accept(task) is true, leaving the tasks skipped over
+        runable in their current order."""
         newrunable = self.get_readytasks()
         if newrunable:
-            if self.depth_first:
+            if self.schedule == "critical-path":
+                for task_id in newrunable:
+                    heapq.heappush(self.runable, (
+                            -self.task_priority.get(task_id, 0), task_id))
+            elif self.depth_first:
                 self.runable += newrunable
             else:
                 self.runable = newrunable + self.runable
             for task_id in newrunable:
-                task = self.cookbook.get_task(id=task_id)
-                self.set_task_pending(task)
-        if not self.runable:
-            return None
-        task_id = self.runable.pop()
+                self.tasks[task_id].status = PENDING
+        if self.schedule == "critical-path":
+            skipped = []
+            task_id = None
+            while self.runable:
+                item = heapq.heappop(self.runable)
+                if accept is None or accept(self.get_task(item[1])):
+                    task_id = item[1]
+                    break
+                skipped.append(item)
+            for item in skipped:
+                heapq.heappush(self.runable, item)
+        else:
+            task_id = None
+            for i in xrange(len(self.runable) - 1, -1, -1):
+                if accept is None or accept(self.get_task(self.runable[i])):
+                    task_id = self.runable.pop(i)
+                    break
         if not task_id:
             return None
-        return self.cookbook.get_task(id=task_id)
+        return self.get_task(task_id)
+
+
+    def put_runabletask(self, task):
+        """Make a task returned by get_runabletask() runable again, as
+        the next task to return (in schedule order)."""
+        if self.schedule == "critical-path":
+            heapq.heappush(self.runable, (
+                    -self.task_priority.get(task.id, 0), task.id))
+        else:
+            self.runable.append(task.id)
+        return
+
+
+    def set_task_priorities(self, estimate):
+        """Set priority of each task to build to the estimated duration
+        of the longest chain of tasks to build starting with it.
+
+        Arguments:
+        estimate -- function returning estimated duration of a task
+        """
+        children = {}
+        for task in self.task_list:
+            if task.build is None:
+                continue
+            children[task.id] = set()
+            for depend_id in task.rdepends:
+                child = self.tasks[self.depends[depend_id].task]
+                if child.build is not None:
+                    children[task.id].add(child.id)
+        priority = {}
+        for task_id in children:
+            if task_id in priority:
+                continue
+            # iterative post-order traversal, as the task chains can be
+            # far deeper than the Python recursion limit
+            stack = [(task_id, False)]
+            while stack:
+                (task, expanded) = stack.pop()
+                if task in priority:
+                    continue
+                if not expanded:
+                    stack.append((task, True))
+                    for child in children[task]:
+                        if not child in priority:
+                            stack.append((child, False))
+                    continue
+                longest = 0
+                for child in children[task]:
+                    longest = max(longest, priority[child])
+                priority[task] = longest + estimate(self.get_task(task))
+        self.task_priority = priority
+        return
 
 
     def get_metahashable_task(self):
@@ -556,83 +667,79 @@ class OEliteRunQueue:
         task_id = self.metahashable.pop()
         if not task_id:
             return None
-        return self.cookbook.get_task(id=task_id)
+        return self.get_task(task_id)
 
 
     def mark_done(self, task, delete=True):
         return self.set_task_done(task, delete)
 
 
+    def get_task(self, task_id):
+        try:
+            return self.task_objects[task_id]
+        except KeyError:
+            task = self.cookbook.get_task(id=task_id)
+            self.task_objects[task_id] = task
+            return task
 
 
-
-
-
-
-
-
-
+    def iter_depends(self, task):
+        """Iterate over the (not deleted) depends of RunqTask task."""
+        for depend_id in task.depends:
+            depend = self.depends[depend_id]
+            if depend is not None:
+                yield depend
 
 
     def get_recipes_with_tasks_to_build(self):
-        # We need to use two different cursors
-        dbc = self.dbc.connection.cursor()
         recipes = []
-        for row in self.dbc.execute(
-            "SELECT DISTINCT task.recipe "
-            "FROM runq.task, task "
-            "WHERE runq.task.build IS NOT NULL "
-            "AND runq.task.task=task.id"):
-            r = dbc.execute(
-                "SELECT recipe.id, recipe.type, recipe.name, recipe.version, "
-                "COUNT(runq.task.build) "
-                "FROM runq.task, task, recipe "
-                "WHERE recipe.id=? "
-                "AND runq.task.task=task.id AND task.recipe=recipe.id ",
-                (row[0],))
-            recipes.append(r.fetchone())
-        return recipes
+        count = {}
+        for task in self.task_list:
+            if task.build is None:
+                continue
+            recipe = self.get_task(task.id).recipe
+            if not recipe.id in count:
+                recipes.append(recipe)
+                count[recipe.id] = 0
+            count[recipe.id] += 1
+        return [(recipe.id, recipe.type, recipe.name, recipe.version,
+                 count[recipe.id]) for recipe in recipes]
 
 
     def get_tasks(self):
         tasks = []
-        for row in self.dbc.execute("SELECT task FROM runq.task"):
-            tasks.append(self.cookbook.get_task(row[0]))
+        for task in self.task_list:
+            tasks.append(self.get_task(task.id))
         return tasks
 
 
     def print_runq_tasks(self):
-        runq_tasks = self.dbc.execute(
-            "SELECT prime,build,status,relax,metahash,tmphash,mtime,task "
-            "FROM runq.task").fetchall()
-        for row in runq_tasks:
-            for col in row:
+        for task in self.task_list:
+            for col in (task.prime, task.build, task.status, task.relax,
+                        task.metahash, task.tmphash, task.mtime, task.id):
                 print "%s "%(col),
-            print "%s:%s"%(self.get_recipe(task=row[7]).get_name(),
-                           self.cookbook.get_task(task=row[7]))
+            print self.get_task(task.id)
         return
 
 
     def get_tasks_to_build_description(self, hashinfo=False):
+        rows = []
+        for task in self.task_list:
+            if task.build is None:
+                continue
+            _task = self.get_task(task.id)
+            recipe = _task.recipe
+            rows.append((-recipe.id, _task.name, recipe, task))
+        rows.sort(key=operator.itemgetter(0, 1))
         tasks = []
-        if hashinfo:
-            hashinfo = ", runq.task.metahash, runq.task.tmphash, runq.task.buildhash"
-        else:
-            hashinfo = ""
-        for row in self.dbc.execute(
-            "SELECT recipe.type, recipe.name, recipe.version, task.name%s "
-            "FROM runq.task, task, recipe "
-            "WHERE runq.task.build IS NOT NULL "
-            "AND runq.task.task=task.id "
-            "AND task.recipe=recipe.id "
-            "ORDER BY recipe.id DESC, task.name"%(hashinfo)):
-            row = list(row)
-            if row[0] == "machine":
-                row[0] = ""
+        for (recipe_id, task_name, recipe, task) in rows:
+            if recipe.type == "machine":
+                prefix = ""
             else:
-                row[0] += ":"
-            row = tuple(row)
+                prefix = recipe.type + ":"
+            row = (prefix, recipe.name, recipe.version, task_name)
             if hashinfo:
+                row += (task.metahash, task.tmphash, task.buildhash)
                 tasks.append("%s%s_%s:%s meta=%s tmp=%s build=%s"%row)
             else:
                 tasks.append("%s%s_%s:%s"%row)
@@ -640,25 +747,46 @@ class OEliteRunQueue:
 
 
     def number_of_runq_tasks(self):
-        return flatten_single_value(self.dbc.execute(
-                "SELECT COUNT(*) FROM runq.task"))
+        return len(self.task_list)
 
 
     def number_of_tasks_to_build(self):
-        return flatten_single_value(self.dbc.execute(
-                "SELECT COUNT(*) FROM runq.task WHERE build IS NOT NULL"))
+        count = 0
+        for task in self.task_list:
+            if task.build is not None:
+                count += 1
+        return count
+
+
+    def has_nostamp_tasks_to_build(self):
+        for task in self.task_list:
+            if task.build is not None and self.get_task(task.id).nostamp:
+                return True
+        return False
 
 
     def add_runq_task(self, task):
         assert isinstance(task, int)
-        self.dbc.execute(
-            "INSERT INTO runq.task (task) VALUES (?)", (task,))
+        if task in self.task_ids:
+            return
+        self.task_ids.add(task)
+        task = self._runq_task(task)
+        task.index = len(self.task_list)
+        self.task_list.append(task)
         return
 
 
+    def _runq_task(self, task_id):
+        # depends may be added before their parent task is added, so
+        # RunqTask is created on first use
+        try:
+            return self.tasks[task_id]
+        except KeyError:
+            task = self.tasks[task_id] = RunqTask(task_id)
+            return task
+
+
     def add_runq_tasks(self, tasks):
-        def task_id_tuple(v):
-            return (v.id,)
         for task in tasks:
             if task.name != 'do_package':
                 continue
@@ -670,9 +798,9 @@ class OEliteRunQueue:
                         task.recipe.meta.set_flag(
                             '%s_%s'%(deptype, package.name),
                             '__provides', provides)
-        tasks = map(task_id_tuple, tasks)
-        self.dbc.executemany(
-            "INSERT INTO runq.task (task) VALUES (?)", (tasks))
+        for task in tasks:
+            self.task_objects[task.id] = task
+            self.add_runq_task(task.id)
         return
 
 
@@ -690,98 +818,101 @@ class OEliteRunQueue:
         if package:
             assert deptype in ("DEPENDS", "RDEPENDS", "FDEPENDS")
             assert isinstance(package, oelite.package.OElitePackage)
-            self.dbc.execute(
-                "INSERT INTO runq.depend "
-                "(task, parent_task, deptype, package) "
-                "VALUES (?, ?, ?, ?)",
-                (task.id, parent_task.id, deptype, package.id))
+            self._add_depend(task.id, parent_task.id, deptype, package.id)
         else:
-            self.dbc.execute(
-                "INSERT INTO runq.depend (task, parent_task) "
-                "VALUES (?, ?)", (task.id, parent_task.id))
+            self._add_depend(task.id, parent_task.id)
         return
 
 
     def add_runq_task_depends(self, task, depends):
-        def task_tuple(depend):
-            return (task.id, depend.id)
-        values = map(task_tuple, depends)
-        self.dbc.executemany(
-            "INSERT INTO runq.depend (task, parent_task) VALUES (?, ?)", values)
+        for depend in depends:
+            self._add_depend(task.id, depend.id)
+        return
+
+
+    def _add_depend(self, task, parent_task, deptype="", package=-1):
+        key = (task, parent_task, deptype, package)
+        if key in self.depend_keys:
+            return
+        self.depend_keys.add(key)
+        depend_id = len(self.depends)
+        self.depends.append(RunqDepend(task, parent_task, deptype, package))
+        self._runq_task(task).depends.append(depend_id)
+        self._runq_task(parent_task).rdepends.add(depend_id)
+        if package >= 0:
+            try:
+                self.package_depends[package].append(depend_id)
+            except KeyError:
+                self.package_depends[package] = [depend_id]
+        return
+
+
+    def _clear_parent_task(self, depend_id):
+        depend = self.depends[depend_id]
+        if depend.parent_task is None:
+            return
+        self.tasks[depend.parent_task].rdepends.discard(depend_id)
+        self.depend_keys.discard((depend.task, depend.parent_task,
+                                  depend.deptype, depend.package))
+        depend.parent_task = None
+        return
+
+
+    def _delete_depend(self, depend_id):
+        self._clear_parent_task(depend_id)
+        self.depends[depend_id] = None
         return
 
 
     def set_package_filename(self, package, filename, prebake=False):
         assert isinstance(package, int)
-        if prebake:
-            self.dbc.execute(
-                "UPDATE runq.depend SET filename=?, prebake=1 "
-                "WHERE package=?",
-                (filename, package))
-        else:
-            self.dbc.execute(
-                "UPDATE runq.depend SET filename=? "
-                "WHERE package=?",
-                (filename, package))
+        for depend_id in self.package_depends.get(package, ()):
+            depend = self.depends[depend_id]
+            if depend is None:
+                continue
+            depend.filename = filename
+            if prebake:
+                depend.prebake = 1
         return
 
 
     def prune_prebaked_runq_depends(self):
-
-        tasks = flatten_single_column_rows(self.dbc.execute(
-            "SELECT"
-            "  task "
-            "FROM"
-            "  runq.task "
-            "WHERE"
-            "  EXISTS " # something depends on it
-            "    (SELECT *"
-            "     FROM runq.depend"
-            "     WHERE parent_task=runq.task.task"
-            "     LIMIT 1)"
-            "  AND NOT EXISTS " # and no task-based dependencies on it
-            "    (SELECT * FROM runq.depend "
-            "     WHERE runq.depend.parent_task=runq.task.task"
-            "     AND (runq.depend.package < 0)"
-            "     LIMIT 1)"
-            "  AND NOT EXISTS " # and no non-prebaked dependencies on it
-            "    (SELECT *"
-            "     FROM runq.depend"
-            "     WHERE runq.depend.parent_task=runq.task.task"
-            "     AND (runq.depend.package >= 0)"
-            "     AND runq.depend.prebake IS NULL"
-            "     LIMIT 1)"
-            ))
-
+        # clear parent_task of all depends on tasks, which only has
+        # prebaked package dependencies on it
+        tasks = []
+        for task in self.task_list:
+            if not task.rdepends:
+                continue
+            for depend_id in task.rdepends:
+                depend = self.depends[depend_id]
+                if depend.package < 0 or depend.prebake is None:
+                    break
+            else:
+                tasks.append(task)
         for task in tasks:
-            self.dbc.execute(
-                "UPDATE runq.depend SET parent_task=NULL WHERE parent_task=?",
-                (task,))
-
+            for depend_id in list(task.rdepends):
+                self._clear_parent_task(depend_id)
         return
 
 
     def get_package_filename(self, package):
-        #assert isinstance(package, int)
         assert isinstance(package, oelite.package.OElitePackage)
-        return flatten_single_value(self.dbc.execute(
-                "SELECT filename "
-                "FROM runq.depend "
-                "WHERE package=? "
-                "LIMIT 1", (package.id,)))
+        for depend_id in self.package_depends.get(package.id, ()):
+            depend = self.depends[depend_id]
+            if depend is not None:
+                return depend.filename
+        return None
 
 
     def set_recdepends(self, package, deptype, recdepends):
         if not recdepends:
             return
         assert isinstance(package, oelite.package.OElitePackage)
-        def task_tuple(depend):
-            return (deptype, package.id, depend.id)
-        recdepends = map(task_tuple, recdepends)
-        self.dbc.executemany(
-            "INSERT INTO runq.recdepend "
-            "(deptype, package, parent_package) "
-            "VALUES (?, ?, ?)", recdepends)
+        key = (deptype, package.id)
+        if not key in self.recdepends:
+            self.recdepends[key] = []
+        for depend in recdepends:
+            self.recdepends[key].append(depend.id)
         return
 
 
@@ -789,82 +920,81 @@ class OEliteRunQueue:
         assert isinstance(package, oelite.package.OElitePackage)
         assert isinstance(deptypes, list) and len(deptypes) > 0
         recdepends = []
-        for package_id in self.dbc.execute(
-                "SELECT parent_package "
-                "FROM runq.recdepend "
-                "WHERE deptype IN (%s) "%(",".join("?" for i in deptypes)) +
-                "AND package=?", (deptypes + [package.id])):
-            recdepends.append(self.cookbook.get_package(id=package_id))
+        for deptype in deptypes:
+            for package_id in self.recdepends.get((deptype, package.id), ()):
+                recdepends.append(self.cookbook.get_package(id=package_id))
         return recdepends
 
 
+    def init_readytasks(self):
+        """Count the unmet dependencies of all tasks to build, and find
+        the tasks which are ready to run.  From here on, the runqueue is
+        updated incrementally by set_task_done(), so no tasks may be
+        added to the set of tasks to build after this."""
+        self.ready = []
+        for task in self.task_list:
+            if task.build != 1:
+                continue
+            task.unmet = 0
+            for depend in self.iter_depends(task):
+                if depend.parent_task is None:
+                    continue
+                if self.tasks[depend.parent_task].build is not None:
+                    task.unmet += 1
+            if task.unmet == 0 and task.status is None:
+                self.ready.append((task.index, task.id))
+        heapq.heapify(self.ready)
+        return
+
+
     def get_readytasks(self):
-        return flatten_single_column_rows(self.dbc.execute(
-                "SELECT"
-                "  task "
-                "FROM"
-                "  runq.task "
-                "WHERE"
-                "  build=1 AND status IS NULL "
-                "  AND ("
-                "    NOT EXISTS"
-                "    (SELECT * FROM runq.depend, runq.task AS parent_task"
-                "     WHERE runq.depend.task=runq.task.task"
-                "     AND runq.depend.parent_task IS NOT NULL"
-                "     LIMIT 1)"
-                "    OR NOT EXISTS"
-                "    (SELECT * FROM runq.depend, runq.task AS parent_task"
-                "     WHERE runq.depend.task=runq.task.task"
-                "     AND runq.depend.parent_task=parent_task.task"
-                "     AND parent_task.build IS NOT NULL"
-                "     LIMIT 1))"))
+        """Return ids of tasks which have become ready to run since last
+        call, in runqueue order."""
+        if self.ready is None:
+            self.init_readytasks()
+        readytasks = []
+        while self.ready:
+            readytasks.append(heapq.heappop(self.ready)[1])
+        return readytasks
 
 
     def print_metahashable_tasks(self):
-        for r in self.dbc.execute(
-            "SELECT task FROM runq.task WHERE metahash is NULL"):
-            print self.cookbook.get_task(id=r[0])
-            for r in self.cookbook.db.execute(
-                "SELECT parent_task, package "
-                "FROM runq.depend "
-                "WHERE task=%s"%(r[0])):
-                s = str(self.cookbook.get_task(id=r[0]))
-                if r[1] != -1:
-                    s += " package=%s"%(self.cookbook.get_package(id=r[1]))
+        for task in self.task_list:
+            if task.metahash is not None:
+                continue
+            print self.get_task(task.id)
+            for depend in self.iter_depends(task):
+                if depend.parent_task is None:
+                    continue
+                s = str(self.get_task(depend.parent_task))
+                if depend.package != -1:
+                    s += " package=%s"%(
+                        self.cookbook.get_package(id=depend.package))
                 print " " +s
 
+
     def get_metahashable_tasks(self):
-        return flatten_single_column_rows(self.dbc.execute(
-                "SELECT task FROM runq.task "
-                "WHERE metahash IS NULL AND NOT EXISTS "
-                "(SELECT runq.depend.task"
-                " FROM runq.depend, runq.task AS runq_task_depend"
-                " WHERE runq.depend.task = runq.task.task"
-                " AND runq.depend.parent_task = runq_task_depend.task"
-                " AND runq_task_depend.metahash IS NULL"
-                " LIMIT 1"
-                ")"))
+        metahashable = []
+        for task in self.task_list:
+            if task.metahash is not None:
+                continue
+            for depend in self.iter_depends(task):
+                if depend.parent_task is None:
+                    continue
+                if self.tasks[depend.parent_task].metahash is None:
+                    break
+            else:
+                metahashable.append(task.id)
+        return metahashable
+
 
     def get_unhashed_tasks(self):
         tasks = []
-        for row in self.dbc.execute(
-            "SELECT task FROM runq.task "
-            "WHERE metahash IS NULL"):
-            tasks.append(self.cookbook.get_task(id=row[0]))
+        for task in self.task_list:
+            if task.metahash is None:
+                tasks.append(self.get_task(task.id))
         return tasks
 
-    def get_package_metahash(self, package):
-        assert isinstance(package, int)
-        return flatten_single_value(self.dbc.execute(
-                "SELECT"
-                "  runq.task.metahash "
-                "FROM"
-                "  runq.task, runq.depend "
-                "WHERE"
-                "  runq.depend.parent_task=runq.task.task"
-                "  AND runq.depend.package=? "
-                "LIMIT 1", (package,)))
-
 
     def get_package_metahash(self, package):
         return self._get_package_hash(package, "metahash")
@@ -874,130 +1004,131 @@ class OEliteRunQueue:
 
     def _get_package_hash(self, package, hash):
         assert isinstance(package, int)
-        return flatten_single_value(self.dbc.execute(
-                "SELECT"
-                "  runq.task.%s "
-                "FROM"
-                "  runq.depend, runq.task, task "
-                "WHERE"
-                "  runq.depend.parent_task=runq.task.task"
-                "  AND runq.depend.package=?"
-                "  AND runq.task.task=task.id AND task.name='do_package' "
-                "LIMIT 1"%(hash),
-                (package,)))
+        for depend_id in self.package_depends.get(package, ()):
+            depend = self.depends[depend_id]
+            if depend is None or depend.parent_task is None:
+                continue
+            if self.get_task(depend.parent_task).name != "do_package":
+                continue
+            return getattr(self.tasks[depend.parent_task], hash)
+        return None
 
 
     def get_depend_packages(self, task=None, deptype=None):
-        query = "SELECT DISTINCT package"
-        query += " FROM runq.depend AS depend, task"
-        query += " WHERE package >= 0"
         if task:
             assert isinstance(task, oelite.task.OEliteTask)
-            query += " AND task=%d"%(task.id)
+            depends = self.iter_depends(self.tasks[task.id])
         else:
-            query += " AND depend.parent_task=task.id"
-            query += " AND task.name='do_package'"
-        if deptype:
-            query += " AND deptype='%s'"%(deptype)
-        return flatten_single_column_rows(self.dbc.execute(query))
+            depends = []
+            for _task in self.task_list:
+                if self.get_task(_task.id).name != "do_package":
+                    continue
+                for depend_id in sorted(_task.rdepends):
+                    depends.append(self.depends[depend_id])
+        packages = []
+        seen = set()
+        for depend in depends:
+            if depend.package < 0 or depend.package in seen:
+                continue
+            if deptype and depend.deptype != deptype:
+                continue
+            seen.add(depend.package)
+            packages.append(depend.package)
+        return packages
 
 
     def get_packages_to_build(self):
-        packages = flatten_single_column_rows(self.dbc.execute(
-                "SELECT DISTINCT package "
-                "FROM runq.depend "
-                "WHERE package >= 0 AND prebake IS NULL"))
-        return set(packages)
+        packages = set()
+        for (package, depend_ids) in self.package_depends.items():
+            for depend_id in depend_ids:
+                depend = self.depends[depend_id]
+                if depend is not None and depend.prebake is None:
+                    packages.add(package)
+                    break
+        return packages
+
+
+    def get_package_filenames(self):
+        filenames = set()
+        for depend in self.depends:
+            if depend is not None and depend.filename:
+                filenames.add(depend.filename)
+        return filenames
 
 
     def set_buildhash_for_build_tasks(self):
-        rowcount = self.dbc.execute(
-            "UPDATE runq.task SET buildhash=metahash WHERE build=1"
-            ).rowcount
-        if rowcount == -1:
-            die("unable to determine rowcount in "
-                "set_buildhash_for_build_tasks")
+        rowcount = 0
+        for task in self.task_list:
+            if task.build == 1:
+                task.buildhash = task.metahash
+                rowcount += 1
         return rowcount
 
 
     def set_buildhash_for_nobuild_tasks(self):
-        rowcount = self.dbc.execute(
-            "UPDATE runq.task SET buildhash=tmphash WHERE build IS NULL"
-            ).rowcount
-        if rowcount == -1:
-            die("unable to determine rowcount in "
-                "set_buildhash_for_nobuild_tasks")
+        rowcount = 0
+        for task in self.task_list:
+            if task.build is None:
+                task.buildhash = task.tmphash
+                rowcount += 1
         return rowcount
 
 
     def mark_primary_runq_depends(self):
-        rowcount = self.dbc.execute(
-            "UPDATE runq.depend SET prime=1 WHERE EXISTS "
-            "(SELECT * FROM runq.task"
-            " WHERE runq.task.prime=1 AND runq.task.task=runq.depend.task"
-            ")").rowcount
-        if rowcount == -1:
-            die("mark_primary_runq_depends did not work out")
+        rowcount = 0
+        for task in self.task_list:
+            if task.prime != 1:
+                continue
+            for depend in self.iter_depends(task):
+                depend.prime = 1
+                rowcount += 1
         return rowcount
 
 
     def prune_runq_depends_nobuild(self):
         rowcount = 0
-        while True:
-            self.dbc.execute(
-                "UPDATE runq.depend SET parent_task=NULL "
-                "WHERE parent_task IS NOT NULL AND NOT EXISTS "
-                "(SELECT * FROM runq.task"
-                " WHERE runq.task.build=1"
-                " AND runq.task.task=runq.depend.parent_task"
-                " LIMIT 1"
-                ")")
-            if rowcount == -1:
-                die("prune_runq_depends_nobuild did not work out")
-            if not self.dbc.rowcount:
-                break
-            rowcount += self.dbc.rowcount
+        for task in self.task_list:
+            if task.build == 1:
+                continue
+            for depend_id in list(task.rdepends):
+                self._clear_parent_task(depend_id)
+                rowcount += 1
         if rowcount:
             debug("pruned %d dependencies that did not have to be rebuilt"%rowcount)
         return rowcount
 
 
     def prune_runq_depends_with_nobody_depending_on_it(self):
-        #c = self.dbc.cursor()
+        # delete depends of tasks with no tasks depending on them,
+        # following the depends upwards to tasks which then end up
+        # with no tasks depending on them
         rowcount = 0
-        while True:
-            self.dbc.execute(
-                "DELETE FROM runq.depend "
-                "WHERE prime IS NULL AND NOT EXISTS "
-                "(SELECT * FROM runq.depend AS next_depend"
-                " WHERE next_depend.parent_task=runq.depend.task"
-                " LIMIT 1"
-                ")")
-            if rowcount == -1:
-                die("prune_runq_depends_with_no_depending_tasks did not work out")
-            if not self.dbc.rowcount:
-                break
-            rowcount += self.dbc.rowcount
+        unneeded = [task for task in self.task_list if not task.rdepends]
+        while unneeded:
+            task = unneeded.pop()
+            for depend_id in task.depends:
+                depend = self.depends[depend_id]
+                if depend is None or depend.prime is not None:
+                    continue
+                parent_task = depend.parent_task
+                self._delete_depend(depend_id)
+                rowcount += 1
+                if parent_task is None:
+                    continue
+                parent_task = self.tasks[parent_task]
+                if not parent_task.rdepends:
+                    unneeded.append(parent_task)
         if rowcount:
             debug("pruned %d dependencies which where not needed anyway"%rowcount)
         return rowcount
 
 
     def prune_runq_tasks(self):
-        rowcount = self.dbc.execute(
-            "UPDATE"
-            "  runq.task "
-            "SET"
-            "  build=NULL "
-            "WHERE"
-            "  prime IS NULL AND NOT EXISTS"
-            "  (SELECT *"
-            "   FROM runq.depend"
-            "   WHERE runq.depend.parent_task=runq.task.task"
-            "   LIMIT 1"
-            ")").rowcount
-        if rowcount == -1:
-            die("prune_runq_tasks did not work out")
+        rowcount = 0
+        for task in self.task_list:
+            if task.prime is None and not task.rdepends:
+                task.build = None
+                rowcount += 1
         if rowcount:
             debug("pruned %d tasks that does not need to be build"%rowcount)
         return rowcount
@@ -1005,91 +1136,77 @@ class OEliteRunQueue:
 
     def set_task_stamp(self, task, mtime, tmphash):
         assert isinstance(task, oelite.task.OEliteTask)
-        self.dbc.execute(
-            "UPDATE runq.task SET mtime=?, tmphash=? WHERE task=?",
-            (mtime, tmphash, task.id))
+        self.tasks[task.id].mtime = mtime
+        self.tasks[task.id].tmphash = tmphash
         return
 
 
     def set_task_build(self, task):
         assert isinstance(task, oelite.task.OEliteTask)
-        self.dbc.execute(
-            "UPDATE runq.task SET build=1 WHERE task=?", (task.id,))
+        self.tasks[task.id].build = 1
         return
 
 
     def set_task_relax(self, task):
         assert isinstance(task, oelite.task.OEliteTask)
-        self.dbc.execute(
-            "UPDATE runq.task SET relax=1 WHERE task=?", (task.id,))
+        self.tasks[task.id].relax = 1
         return
 
 
     def set_task_primary(self, task):
         assert isinstance(task, oelite.task.OEliteTask)
-        self.dbc.execute(
-            "UPDATE runq.task SET prime=1 WHERE task=?", (task.id,))
+        self.tasks[task.id].prime = 1
         return
 
 
     def is_task_primary(self, task):
         assert isinstance(task, oelite.task.OEliteTask)
-        primary = self.dbc.execute(
-            "SELECT prime FROM runq.task WHERE task=?", (task.id,)).fetchone()
-        return primary[0] == 1
+        return self.tasks[task.id].prime == 1
 
 
     def is_recipe_primary(self, recipe):
-        primary = self.dbc.execute(
-            "SELECT runq.task.prime "
-            "FROM runq.task, task "
-            "WHERE task.recipe=? AND runq.task.prime IS NOT NULL "
-            "AND runq.task.task=task.id", (recipe,)).fetchone()
-        return primary and primary[0] == 1
+        for task in self.task_list:
+            if (task.prime is not None and
+                self.get_task(task.id).recipe.id == recipe):
+                return task.prime == 1
+        return None
 
 
     def set_task_build_on_nostamp_tasks(self):
-        rowcount = self.dbc.execute(
-            "UPDATE runq.task SET build=1 "
-            "WHERE build IS NULL AND EXISTS "
-            "(SELECT * FROM task"
-            " WHERE id=runq.task.task AND nostamp=1)").rowcount
-        if rowcount == -1:
-            die("set_task_build_on_nostamp_tasks did not work out")
+        rowcount = 0
+        for task in self.task_list:
+            if task.build is None and self.get_task(task.id).nostamp:
+                task.build = 1
+                rowcount += 1
         debug("set build flag on %d nostamp tasks"%(rowcount))
         return
 
 
     def set_task_build_on_retired_tasks(self):
         rowcount = 0
-        while True:
-            self.dbc.execute(
-                "UPDATE runq.task SET build=1 "
-                "WHERE build IS NULL AND EXISTS "
-                "(SELECT * FROM runq.depend, runq.task AS parent_task"
-                " WHERE runq.depend.task=runq.task.task"
-                " AND runq.depend.parent_task=parent_task.task"
-                " AND parent_task.mtime > runq.task.mtime)")
-            if rowcount == -1:
-                die("set_task_build_on_retired_tasks did not work out")
-            if not self.dbc.rowcount:
-                break
-            rowcount += self.dbc.rowcount
+        for task in self.task_list:
+            if task.build is not None or task.mtime is None:
+                continue
+            for depend in self.iter_depends(task):
+                if depend.parent_task is None:
+                    continue
+                mtime = self.tasks[depend.parent_task].mtime
+                if mtime is not None and mtime > task.mtime:
+                    task.build = 1
+                    rowcount += 1
+                    break
         debug("set build flag on %d retired tasks"%(rowcount))
         return
 
 
     def set_task_build_on_hashdiff(self):
         rowcount = 0
-        while True:
-            self.dbc.execute(
-                "UPDATE runq.task SET build=1 "
-                "WHERE build IS NULL AND relax IS NULL AND tmphash != metahash")
-            if rowcount == -1:
-                die("set_task_build_on_hashdiff did not work out")
-            if not self.dbc.rowcount:
-                break
-            rowcount += self.dbc.rowcount
+        for task in self.task_list:
+            if (task.build is None and task.relax is None and
+                task.tmphash is not None and task.metahash is not None and
+                task.tmphash != task.metahash):
+                task.build = 1
+                rowcount += 1
         debug("set build flag on %d tasks with tmphash != metahash"%(rowcount))
         return
 
@@ -1097,84 +1214,72 @@ class OEliteRunQueue:
     def propagate_runq_task_build(self):
         """always build all tasks depending on other tasks to build"""
         rowcount = 0
-        while True:
-            self.dbc.execute(
-                "UPDATE"
-                "  runq.task "
-                "SET"
-                "  build=1 "
-                "WHERE"
-                "  build IS NULL"
-                "  AND EXISTS"
-                "    (SELECT *"
-                "     FROM runq.depend, runq.task AS parent_task"
-                "     WHERE runq.depend.task=runq.task.task"
-                "     AND runq.depend.parent_task=parent_task.task"
-                "     AND parent_task.build=1"
-                "     LIMIT 1)")
-            if rowcount == -1:
-                die("propagate_runq_task_build did not work out")
-            if not self.dbc.rowcount:
-                break
-            rowcount += self.dbc.rowcount
+        queue = [task for task in self.task_list if task.build == 1]
+        while queue:
+            task = queue.pop()
+            for depend_id in task.rdepends:
+                child = self.tasks[self.depends[depend_id].task]
+                if child.build is None:
+                    child.build = 1
+                    rowcount += 1
+                    queue.append(child)
         debug("set build flag on %d tasks due to propagation"%(rowcount))
         return
 
 
     def _set_task_status(self, task, status):
         assert isinstance(task, oelite.task.OEliteTask)
-        self.dbc.execute(
-            "UPDATE runq.task SET status=? WHERE task=?", (status, task.id))
+        self.tasks[task.id].status = status
         return
 
 
     def set_task_pending(self, task):
-        return self._set_task_status(task, 1)
+        return self._set_task_status(task, PENDING)
 
 
     def set_task_running(self, task):
-        return self._set_task_status(task, 2)
+        return self._set_task_status(task, RUNNING)
 
 
     def set_task_done(self, task, delete):
         assert isinstance(task, oelite.task.OEliteTask)
-        self._set_task_status(task, 3)
-        #if delete:
-        #    self.dbc.execute(
-        #        "DELETE FROM runq.depend WHERE parent_task=?", (task.id,))
-        self.dbc.execute(
-            "UPDATE runq.depend SET parent_task=NULL "
-            "WHERE parent_task=?", (task.id,))
+        self._set_task_status(task, DONE)
+        task = self.tasks[task.id]
+        for depend_id in list(task.rdepends):
+            if self.ready is not None and task.build is not None:
+                child = self.tasks[self.depends[depend_id].task]
+                if child.unmet:
+                    child.unmet -= 1
+                    if child.unmet == 0 and child.status is None:
+                        heapq.heappush(self.ready, (child.index, child.id))
+            self._clear_parent_task(depend_id)
         return
 
 
     def set_task_failed(self, task):
-        return self._set_task_status(task, -1)
+        return self._set_task_status(task, FAILED)
 
 
     def prune_done_tasks(self):
-        self.dbc.execute(
-            "DELETE FROM runq.depend WHERE EXISTS "
-            "( SELECT * FROM runq.task "
-            "WHERE runq.task.task = runq.depend.parent_task AND status=3 )")
+        for task in self.task_list:
+            if task.status != DONE:
+                continue
+            for depend_id in list(task.rdepends):
+                self._delete_depend(depend_id)
         return
 
 
     def set_task_metahash(self, task, metahash):
         assert isinstance(task, oelite.task.OEliteTask)
-        self.dbc.execute(
-            "UPDATE runq.task SET metahash=? WHERE task=?",
-            (metahash, task.id))
+        self.tasks[task.id].metahash = metahash
         return
 
 
     def get_task_metahash(self, task):
         assert isinstance(task, oelite.task.OEliteTask)
-        return flatten_single_value(self.dbc.execute(
-            "SELECT metahash FROM runq.task WHERE task=?", (task.id,)))
+        return self.tasks[task.id].metahash
 
 
     def get_task_buildhash(self, task):
         assert isinstance(task, oelite.task.OEliteTask)
-        return flatten_single_value(self.dbc.execute(
-                "SELECT buildhash FROM runq.task WHERE task=?", (task.id,)))
+        return self.tasks[task.id].buildhash
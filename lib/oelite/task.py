@@ -20,8 +20,6 @@ def task_name(name):
 
 class OEliteTask:
 
-    TASKFUNC_RE = re.compile(r"^do_([a-z]+).*?")
-
     def __init__(self, id, recipe, name, nostamp, cookbook):
         self.id = id
         self.recipe = cookbook.get_recipe(id=recipe)
@@ -63,6 +61,11 @@ class OEliteTask:
             (self.id,)))
 
 
+    def get_pool(self):
+        return self.recipe.meta.get_flag(self.name, "pool",
+                                         oelite.meta.FULL_EXPANSION)
+
+
     def stampfile_path(self):
         try:
             return self._stampfile
@@ -154,36 +157,8 @@ class OEliteTask:
         meta = self.recipe.meta.copy()
         # Filter meta-data, enforcing restrictions on which tasks to
         # emit vars to and not including other task functions.
-        emit_prefixes = (meta.get("META_EMIT_PREFIX") or "").split()
-        def colon_split(s):
-            import string
-            return string.split(s, ":", 1)
-        emit_prefixes = map(colon_split, emit_prefixes)
-        for var in meta.keys():
-            emit_flag = meta.get_flag(var, "emit")
-            emit = (emit_flag or "").split()
-            taskfunc_match = self.TASKFUNC_RE.match(var)
-            if taskfunc_match:
-                if taskfunc_match.group(0) not in emit:
-                    emit.append(taskfunc_match.group(0))
-            for emit_task, emit_prefix in emit_prefixes:
-                if not var.startswith(emit_prefix):
-                    continue
-                if emit_task == "":
-                    if emit_flag is None:
-                        emit_flag = ""
-                    continue
-                if not emit_task.startswith("do_"):
-                    emit_task = "do_" + emit_task
-                if not emit_task in emit:
-                    emit.append(emit_task)
-            if (emit or emit_flag == "") and not self.name in emit:
-                del meta[var]
-                continue
-            omit = meta.get_flag(var, "omit")
-            if omit is not None and self.name in omit.split():
-                del meta[var]
-                continue
+        for var in self.recipe.get_task_omitted_vars(self.name):
+            del meta[var]
 
         self._meta = meta
         return meta
@@ -198,8 +173,8 @@ class OEliteTask:
 
         # Setup stdin, stdout and stderr redirection
         stdin = open("/dev/null", "r")
-        self.logfn = "%s/%s.%s.log"%(function.tmpdir, self.name, str(os.getpid()))
-        self.logsymlink = "%s/%s.log"%(function.tmpdir, self.name)
+        (self.logfn, self.logsymlink) = self.logfile_path(
+            tmpdir=function.tmpdir)
         oelite.util.makedirs(os.path.dirname(self.logfn))
         try:
             if self.debug:
@@ -256,6 +231,16 @@ class OEliteTask:
                 os.remove(self.logfn) # prune empty logfiles
 
 
+    # return (logfile, symlink) for task run in process with pid
+    def logfile_path(self, pid=None, tmpdir=None):
+        if pid is None:
+            pid = os.getpid()
+        if tmpdir is None:
+            tmpdir = self.meta().get("T")
+        return ("%s/%s.%s.log"%(tmpdir, self.name, str(pid)),
+                "%s/%s.log"%(tmpdir, self.name))
+
+
     def do_cleandirs(self, name=None):
         if not name:
             name = self.name
@@ -2,6 +2,12 @@ import tarfile
 import os
 import sys
 import subprocess
+import select
+import signal
+import struct
+import cPickle
+import resource
+import collections
 
 
 def format_textblock(text, indent=2, width=78, first_indent=None):
@@ -162,3 +168,188 @@ def touch(path, makedirs=False, truncate=False):
         globals()['makedirs'](os.path.dirname(path))
     with open(path, mode):
         os.utime(path, None)
+
+
+def sizeof(obj, seen=None):
+    """Return approximate size in bytes of obj and all objects contained
+    in it, not counting the objects with id in seen (which is updated
+    with the counted objects).  As objects are identified by id, all
+    objects counted with the same seen set must be kept alive."""
+    if seen is None:
+        seen = set()
+    size = 0
+    stack = [obj]
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen:
+            continue
+        seen.add(id(obj))
+        size += sys.getsizeof(obj)
+        if isinstance(obj, dict):
+            stack.extend(obj.iterkeys())
+            stack.extend(obj.itervalues())
+        elif isinstance(obj, (list, tuple, set, frozenset)):
+            stack.extend(obj)
+    return size
+
+
+def maxrss():
+    """Return peak memory usage of this process in kB."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def fork_map(function, items, processes, progress=None):
+    """
+    Call function for each item in items, using up to processes forked
+    worker processes.
+
+    Each worker inherits the full state of the calling process, and
+    results are returned to it pickled, so function and results must
+    not rely on any state changes being passed back.  Items are handed
+    out to the workers one at a time, in order, whenever a worker is
+    done with its previous item, so that a few slow items do not hold
+    up the items that would otherwise have been given to the same
+    worker.
+
+    Returns a list of (success, result) tuples in the same order as
+    items.  When function raises an exception, success is False and
+    result is the exception message.  If a worker process dies, the
+    result of the item it was working on (and of any items not handed
+    out when all workers have died) is (False, None).
+
+    Arguments:
+        `function`  -- function to call with each item as argument.
+        `items`     -- list of items.
+        `processes` -- maximum number of worker processes.
+        `progress`  -- function called with the number of finished
+                       items each time an item is finished.
+    """
+    items = list(items)
+    results = [(False, None)] * len(items)
+    processes = min(processes, len(items))
+    header = struct.Struct("!I")
+    # result pipe read fd -> [pid, buffer, item pipe write fd]
+    workers = {}
+    next_item = [0]
+    def send_item(rfd):
+        # hand out the next item, or tell the worker to exit
+        wfd = workers[rfd][2]
+        if wfd is None:
+            return
+        if next_item[0] < len(items):
+            try:
+                os.write(wfd, header.pack(next_item[0]))
+                next_item[0] += 1
+                return
+            except OSError:
+                pass
+        os.close(wfd)
+        workers[rfd][2] = None
+    try:
+        for worker in xrange(processes):
+            (rfd, wfd) = os.pipe()
+            (item_rfd, item_wfd) = os.pipe()
+            sys.stdout.flush()
+            sys.stderr.flush()
+            pid = os.fork()
+            if pid == 0:
+                # Never return from here, and never run any of the
+                # cleanup handlers inherited from the calling process.
+                exitcode = 1
+                try:
+                    os.close(rfd)
+                    os.close(item_wfd)
+                    for other in workers.itervalues():
+                        if other[2] is not None:
+                            os.close(other[2])
+                    while True:
+                        data = ""
+                        while len(data) < header.size:
+                            read = os.read(item_rfd, header.size - len(data))
+                            if not read:
+                                break
+                            data += read
+                        if len(data) < header.size:
+                            break
+                        index = header.unpack(data)[0]
+                        try:
+                            result = (True, function(items[index]))
+                        except Exception, e:
+                            result = (False, str(e))
+                        data = cPickle.dumps((index, result), 2)
+                        data = header.pack(len(data)) + data
+                        while data:
+                            data = data[os.write(wfd, data):]
+                    exitcode = 0
+                finally:
+                    os._exit(exitcode)
+            os.close(wfd)
+            os.close(item_rfd)
+            workers[rfd] = [pid, "", item_wfd]
+            send_item(rfd)
+        done = 0
+        while workers:
+            for rfd in select.select(workers.keys(), [], [])[0]:
+                data = os.read(rfd, 65536)
+                if not data:
+                    os.close(rfd)
+                    (pid, buf, wfd) = workers.pop(rfd)
+                    if wfd is not None:
+                        os.close(wfd)
+                    os.waitpid(pid, 0)
+                    continue
+                buf = workers[rfd][1] + data
+                while (len(buf) >= header.size and
+                       len(buf) >= header.size + header.unpack(
+                        buf[:header.size])[0]):
+                    end = header.size + header.unpack(buf[:header.size])[0]
+                    (index, result) = cPickle.loads(buf[header.size:end])
+                    results[index] = result
+                    buf = buf[end:]
+                    done += 1
+                    send_item(rfd)
+                    if progress:
+                        progress(done)
+                workers[rfd][1] = buf
+    finally:
+        for rfd in workers:
+            os.close(rfd)
+            if workers[rfd][2] is not None:
+                os.close(workers[rfd][2])
+            try:
+                os.kill(workers[rfd][0], signal.SIGTERM)
+                os.waitpid(workers[rfd][0], 0)
+            except OSError:
+                pass
+    return results
+
+
+class CodeCache(object):
+
+    """Cache of limited size, dropping the oldest entries when full, and
+    counting cache hits and misses."""
+
+    def __init__(self, size):
+        self.size = size
+        self.cache = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        return
+
+    def get(self, key):
+        try:
+            value = self.cache[key]
+        except KeyError:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return value
+
+    def set(self, key, value):
+        if len(self.cache) >= self.size:
+            self.cache.popitem(last=False)
+        self.cache[key] = value
+        return
+
+    def __str__(self):
+        return "%d hits, %d misses"%(self.hits, self.misses)
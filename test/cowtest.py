@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+"""Check that modifying task metadata does not change the recipe metadata.
+
+Usage: cowtest.py
+
+Task metadata are copy-on-write copies of the recipe metadata.  When
+running tasks inline in the main process (oe bake -j1), the tasks
+modify their metadata, including objects like the fetchers in __fetch,
+in place.  This builds the cookbook of all recipes of this layer, and
+for each task of each recipe, modifies all variables and all objects
+found in the task metadata, and checks that the metadata of all
+recipes are unchanged afterwards.
+"""
+
+import sys
+import types
+
+import testbaker
+
+
+PLAIN_TYPES = (basestring, types.NoneType, bool, int, long, float)
+
+
+def snapshot(val, seen=None):
+    """Return a comparable deep snapshot of val."""
+    if seen is None:
+        seen = set()
+    if isinstance(val, PLAIN_TYPES):
+        return val
+    if id(val) in seen:
+        return ("<recursion>", type(val).__name__)
+    seen.add(id(val))
+    try:
+        if isinstance(val, dict):
+            return ("dict", sorted([(snapshot(k, seen), snapshot(v, seen))
+                                    for (k, v) in val.items()]))
+        if isinstance(val, (list, tuple)):
+            return (type(val).__name__, [snapshot(v, seen) for v in val])
+        if isinstance(val, (set, frozenset)):
+            return ("set", sorted([snapshot(v, seen) for v in val]))
+        if hasattr(val, "__dict__"):
+            return (type(val).__name__, snapshot(val.__dict__, seen))
+        return repr(val)
+    finally:
+        seen.discard(id(val))
+
+
+def meta_snapshot(meta):
+    return dict([(var, snapshot(flags)) for (var, flags)
+                 in meta.dict.items()])
+
+
+def modify(val, seen):
+    """Modify val, and all objects found in it, in place."""
+    if isinstance(val, PLAIN_TYPES) or id(val) in seen:
+        return
+    seen.add(id(val))
+    if isinstance(val, list):
+        for item in val:
+            modify(item, seen)
+        val.append("cowtest")
+    elif isinstance(val, dict):
+        for item in val.values():
+            modify(item, seen)
+        val["cowtest"] = "cowtest"
+    elif isinstance(val, set):
+        val.add("cowtest")
+    elif hasattr(val, "__dict__"):
+        for item in val.__dict__.values():
+            modify(item, seen)
+        if hasattr(val, "__setitem__"):
+            val["cowtest"] = "cowtest"
+        val.cowtest = "cowtest"
+    return
+
+
+def modify_task_meta(meta):
+    seen = set()
+    for var in meta.keys():
+        val = meta.get(var, 0)
+        modify(val, seen)
+        meta.set_flag(var, "cowtest", "cowtest")
+        if var != "OVERRIDES":
+            meta.set_override(var, ("", "cowtest"), "cowtest")
+    for var in meta.get_vars("task"):
+        del meta[var]
+    return
+
+
+def main():
+    with testbaker.TestBaker() as baker:
+        recipes = baker.cookbook.recipes.values()
+        before = dict([(recipe, meta_snapshot(recipe.meta))
+                       for recipe in recipes])
+        tasks = testbaker.all_tasks(baker)
+        for task in tasks:
+            modify_task_meta(task.meta())
+        changed = 0
+        for recipe in recipes:
+            after = meta_snapshot(recipe.meta)
+            if after == before[recipe]:
+                continue
+            changed += 1
+            print "CHANGED %s"%(recipe)
+            for var in sorted(set(before[recipe]) | set(after)):
+                if before[recipe].get(var) != after.get(var):
+                    print "  %s"%(var)
+        print "%d recipes, %d tasks, %d recipes changed"%(
+            len(recipes), len(tasks), changed)
+    if changed:
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+"""Check that task data hashes calculated in parallel are identical to the
+data hashes calculated serially.
+
+Usage: datahashtest.py [PROCESSES]
+
+Builds the cookbook of all recipes of this layer, calculates the data
+hashes of all tasks in PROCESSES (default 4) worker processes, as oe
+bake does, and then again one by one in this process, and compares
+them.  The parallel calculation is done first, so that the worker
+processes do not inherit any task metadata or signatures from the
+serial calculation.
+"""
+
+import sys
+import time
+
+import testbaker
+
+
+def main(processes=4):
+    processes = int(processes)
+    with testbaker.TestBaker() as baker:
+        tasks = [task for task in testbaker.all_tasks(baker)
+                 if not task.nostamp]
+
+        start = time.time()
+        parallel = baker.calculate_datahashes(tasks, processes)
+        parallel_time = time.time() - start
+
+        start = time.time()
+        serial = {}
+        for task in tasks:
+            serial[task] = baker.task_datahash(task)
+        serial_time = time.time() - start
+
+        mismatches = 0
+        for task in tasks:
+            if parallel.get(task) != serial[task]:
+                mismatches += 1
+                print "MISMATCH %s: %s != %s"%(
+                    task, parallel.get(task), serial[task])
+        print "%d tasks, %d mismatches"%(len(tasks), mismatches)
+        print "parallel: %.2f s (%d processes)"%(parallel_time, processes)
+        print "serial:   %.2f s"%(serial_time)
+    if mismatches:
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(*sys.argv[1:]))
@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+"""Compare indexed expansion cache invalidation with the full scan it
+replaced.
+
+Usage: expandcachetest.py REVISION [SEQUENCES]
+
+REVISION is a git revision of this layer invalidating the expansion
+cache of DictMeta by scanning all of it, fx. the parent of the commit
+indexing the expansion cache dependencies.  The old DictMeta
+(lib/oelite/meta/dict.py) is loaded from that revision, and compared
+with the current one on SEQUENCES (default 200) random sequences of
+metadata operations, as done by metacopytest.py.
+
+Then the time used for 3000 set() and 3000 set_flag() of the value of
+new variables, in a metadata with 3000 cached expansions, is measured
+for both.
+"""
+
+import sys
+import time
+
+import testbaker
+import metacopytest
+
+import oelite.meta.dict
+
+
+def invalidate(cls):
+    meta = cls()
+    meta.set("OVERRIDES", "o1")
+    meta.set("VAR0", "zero")
+    for i in range(1, 3000):
+        meta.set("VAR%d"%(i), "v ${VAR%d} ${OVERRIDES}"%(i / 2))
+    for i in range(3000):
+        meta.get("VAR%d"%(i))
+    start = time.time()
+    for i in range(3000):
+        meta.set("NEW%d"%(i), "x")
+        meta.set_flag("NEW%d"%(i), "", "y")
+    return time.time() - start
+
+
+def benchmark(olddict):
+    print "Benchmark, 6000 assignments, 3000 cached expansions:"
+    for (name, cls) in (("old", olddict.DictMeta),
+                        ("new", oelite.meta.dict.DictMeta)):
+        print "  %s: %.2f s"%(name, invalidate(cls))
+    return
+
+
+def main(revision, sequences=200):
+    olddict = testbaker.load_source(revision, "lib/oelite/meta/dict.py",
+                                    "olddict")
+    mismatches = metacopytest.compare(olddict, int(sequences))
+    benchmark(olddict)
+    if mismatches:
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        sys.exit(__doc__)
+    sys.exit(main(*sys.argv[1:]))
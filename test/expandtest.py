@@ -0,0 +1,214 @@
+#!/usr/bin/env python
+"""Compare variable expansion of two revisions of this layer.
+
+Usage: expandtest.py REVISION [NEWREVISION]
+
+REVISION and NEWREVISION (default the working tree of this layer) are
+git revisions of this layer, fx. the parent of a commit changing
+variable expansion and the commit itself.  Each revision is exported to
+a temporary directory, and in a separate process for each, the cookbook
+of all its recipes is built, and every variable of the configuration
+and all recipes is expanded with each of the FULL, PARTIAL, CLEAN and
+OVERRIDES expansion methods.  Then random sequences of assignments,
+overrides, copies and expansions, with and without inline python, are
+done on new metadata.  All expanded values, dependency sets and
+exceptions are compared, except for the time and environment
+dependent variables in IGNORE_VARS.  The temporary TOPDIR, the layer directory and the
+DATETIME of each process are replaced by their names in the values.
+
+Finally the time used for 100000 expansions of a string with 5
+variables, and for 60000 lookups of variables with overrides, is
+measured for both revisions.
+"""
+
+import sys
+import os
+import cPickle
+import random
+import re
+import shutil
+import tempfile
+import time
+
+import testbaker
+
+import oelite.meta
+
+
+IGNORE_VARS = ("DATETIME", "DATE", "TIME", "PWD", "__mtimes")
+
+METHODS = (oelite.meta.FULL_EXPANSION, oelite.meta.PARTIAL_EXPANSION,
+           oelite.meta.CLEAN_EXPANSION, oelite.meta.OVERRIDES_EXPANSION)
+
+VARS = ["V%d"%(i) for i in range(10)]
+
+ADDRESS_RE = re.compile(r" at 0x[0-9a-f]+")
+
+
+def expand_all(name, meta, results, dynvars):
+    """Expand all variables of meta, replacing the values of the
+    (name, value) dynvars in the results by their names, and removing
+    object addresses."""
+    for var in sorted(meta.keys()):
+        if var in IGNORE_VARS:
+            continue
+        for method in METHODS:
+            try:
+                (val, deps) = meta._get(var, method)
+                val = ADDRESS_RE.sub("", repr(val))
+                for (dynvar_name, dynvar_val) in dynvars:
+                    val = val.replace(dynvar_val, "${%s}"%(dynvar_name))
+                result = (val, sorted(deps or []))
+            except Exception, e:
+                result = type(e).__name__
+            results[(name, var, method)] = result
+    return
+
+
+def random_value(rng):
+    return rng.choice([
+            "a",
+            "${%s}"%(rng.choice(VARS)),
+            "b ${%s} c ${%s}"%(rng.choice(VARS), rng.choice(VARS)),
+            "${@'x'+'${%s}'}"%(rng.choice(VARS)),
+            "p ${@d.get('%s') or 'n'} q ${@1+1}"%(rng.choice(VARS)),
+            "${@len('abc')}${%s}"%(rng.choice(VARS)),
+            "",
+            "${UNDEFINED} z"])
+
+
+def expand_random(seed, results):
+    rng = random.Random(seed)
+    metas = [oelite.meta.DictMeta()]
+    metas[0].set("OVERRIDES", "o1:${V1}:o2")
+    for i in range(150):
+        meta = rng.choice(metas)
+        op = rng.randrange(8)
+        var = rng.choice(VARS)
+        try:
+            if op == 0:
+                meta.set(var, random_value(rng))
+            elif op == 1:
+                meta.set_override(var, (rng.choice(["", ">", "<"]),
+                                        rng.choice(["o1", "o2", "a"])),
+                                  random_value(rng))
+            elif op == 2:
+                meta.set("OVERRIDES",
+                         rng.choice(["o1:o2", "o2:${V2}:o1", "a:o1"]))
+            elif op == 3:
+                metas.append(meta.copy())
+            elif op == 4:
+                meta.set_flag(var, "expand",
+                              rng.choice([None, "0", "2", "3"]))
+            elif op == 5:
+                if var in meta.dict:
+                    meta.del_var(var)
+            (val, deps) = meta._get(var, rng.choice(METHODS))
+            results.append((seed, i, repr(val), sorted(deps or [])))
+            results.append((seed, i, repr(meta.expand(
+                            random_value(rng),
+                            rng.choice([oelite.meta.PARTIAL_EXPANSION,
+                                        oelite.meta.CLEAN_EXPANSION])))))
+        except Exception, e:
+            results.append((seed, i, type(e).__name__))
+    for meta in metas:
+        results.append(sorted([(var, repr(val), sorted(deps))
+                               for (var, (val, deps))
+                               in meta.expand_cache.items()]))
+    return
+
+
+def benchmark():
+    meta = oelite.meta.DictMeta()
+    meta.set("OVERRIDES", "o1:o2:o3:o4:o5:o6:o7:o8")
+    for i in range(20):
+        meta.set("V%d"%(i), "val%d"%(i))
+        meta.set_override("O%d"%(i), (">", "o5"), " x")
+        meta.set("O%d"%(i), "base")
+    string = "${V1}/foo/${V2} --opt=${V3} ${V4} literal text here ${V5}"
+    start = time.time()
+    for i in range(100000):
+        meta.expand(string)
+    expand_time = time.time() - start
+    start = time.time()
+    for i in range(3000):
+        for j in range(20):
+            meta.expand_cache.pop("O%d"%(j), None)
+            meta.get("O%d"%(j))
+    return (expand_time, time.time() - start)
+
+
+def dump(filename):
+    """Expand everything with the layer of this process, saving the
+    results and benchmark times in filename."""
+    results = {}
+    with testbaker.TestBaker() as baker:
+        dynvars = [("TOPDIR", baker.config.get("TOPDIR")),
+                   ("LAYERDIR", testbaker.LAYERDIR),
+                   ("DATETIME", baker.config.get("DATETIME"))]
+        expand_all("conf", baker.config, results, dynvars)
+        recipes = baker.cookbook.recipes.values()
+        for recipe in sorted(recipes, key=str):
+            expand_all(str(recipe), recipe.meta, results, dynvars)
+    sequences = []
+    for seed in range(200):
+        expand_random(seed, sequences)
+    times = benchmark()
+    with open(filename, "wb") as output:
+        cPickle.dump((results, sequences, times), output, 2)
+    return 0
+
+
+def run(revision, filename):
+    """Run dump() with revision of this layer, or with the working
+    tree of this layer if revision is None."""
+    testbaker.run_revision(revision,
+                           [os.path.abspath(__file__), "--dump", filename])
+    with open(filename, "rb") as input:
+        return cPickle.load(input)
+
+
+def main(revision, newrevision=None):
+    if revision == "--dump":
+        return dump(newrevision)
+    tmpdir = tempfile.mkdtemp(prefix="oelite-expandtest-")
+    try:
+        (old, old_sequences, old_times) = run(
+            revision, os.path.join(tmpdir, "old"))
+        (new, new_sequences, new_times) = run(
+            newrevision, os.path.join(tmpdir, "new"))
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+    mismatches = 0
+    for key in sorted(set(old) | set(new)):
+        if old.get(key) == new.get(key):
+            continue
+        mismatches += 1
+        if mismatches <= 10:
+            print "MISMATCH %s[%s] method %d"%(key[0], key[1], key[2])
+            print "  old: %s"%(repr(old.get(key))[:300])
+            print "  new: %s"%(repr(new.get(key))[:300])
+    print "%d variable expansions, %d mismatches"%(
+        len(set(old) | set(new)), mismatches)
+    sequence_mismatches = 0
+    for (a, b) in zip(old_sequences, new_sequences):
+        if a != b:
+            sequence_mismatches += 1
+    sequence_mismatches += abs(len(old_sequences) - len(new_sequences))
+    print "%d random sequence results, %d mismatches"%(
+        len(new_sequences), sequence_mismatches)
+    mismatches += sequence_mismatches
+    print "Benchmark:"
+    for (name, (expand_time, overrides_time)) in (("old", old_times),
+                                                  ("new", new_times)):
+        print "  %s: 100000 expansions %.2f s, 60000 override lookups %.2f s"%(
+            name, expand_time, overrides_time)
+    if mismatches:
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        sys.exit(__doc__)
+    sys.exit(main(*sys.argv[1:]))
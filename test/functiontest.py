@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+"""Check that python functions do not share state between recipes.
+
+Usage: functiontest.py
+
+Builds the cookbook of all recipes of this layer, and builds all python
+functions of all recipes, as done when running tasks and hooks.  The
+code of the functions is cached and shared by all recipes, but each
+function, and each function it imports, must get its own globals, so
+that a global assignment done by a function in one recipe is not seen
+by any other function.  This checks that no two functions share
+globals, by setting a marker in the globals of each function, and
+checking that the globals of all functions built after it are without
+it.
+"""
+
+import sys
+import time
+
+import testbaker
+
+import oelite.meta
+import oelite.function
+
+
+MARKER = "__functiontest__"
+
+
+def check_function(meta, var, function, name):
+    """Check and mark the globals of function, and of the functions it
+    imports, returning the number of functions checked, or None if any
+    of them share globals with a function built before."""
+    g = function.func_globals
+    if MARKER in g:
+        print "SHARED %s: globals of %s"%(name, g[MARKER])
+        return None
+    g[MARKER] = name
+    checked = 1
+    for func in (meta.get_flag(var, "import", oelite.meta.FULL_EXPANSION)
+                 or "").split():
+        imported = check_function(meta, func, g[func], "%s:%s"%(name, func))
+        if imported is None:
+            return None
+        checked += imported
+    return checked
+
+
+def main():
+    with testbaker.TestBaker() as baker:
+        recipes = [baker.cookbook.recipes[recipe_id]
+                   for recipe_id in sorted(baker.cookbook.recipes)]
+        oelite.function.python_function_cache.hits = 0
+        oelite.function.python_function_cache.misses = 0
+        functions = 0
+        shared = 0
+        start = time.time()
+        for recipe in recipes:
+            for var in sorted(recipe.meta.get_vars(flag="python")):
+                function = oelite.function.PythonFunction(recipe.meta, var)
+                checked = check_function(recipe.meta, var, function.function,
+                                         "%s:%s"%(recipe, var))
+                if checked is None:
+                    shared += 1
+                else:
+                    functions += checked
+        print "%d recipes, %d functions, %d with shared globals"%(
+            len(recipes), functions, shared)
+        print "python function cache: %s"%(
+            oelite.function.python_function_cache)
+        print "time: %.2f s"%(time.time() - start)
+    if shared:
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
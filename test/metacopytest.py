@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+"""Compare copy-on-write DictMeta copies with the deep copies they
+replaced.
+
+Usage: metacopytest.py REVISION [SEQUENCES]
+
+REVISION is a git revision of this layer with the deep copying
+DictMeta, fx. the parent of the commit making copies copy-on-write.
+The old DictMeta (lib/oelite/meta/dict.py) is loaded from that
+revision, and both are driven through SEQUENCES (default 200) random
+sequences of set, set_flag, set_override, del_var, copy, get, add_hook,
+set_input_mtime and set_preference operations on a growing list of
+copies, comparing the variables and expansion cache of all copies
+afterwards.  A variable depending on itself in the expansion cache
+(fx. OVERRIDES) makes no difference for invalidation, so such
+dependencies are ignored.  The old DictMeta ordered hooks with equal
+sequence numbers by dictionary order, so hooks are compared sorted.
+
+Then the time and memory used for copying 20 recipes x 3 recipe types
+x 15 tasks from a metadata with 4000 variables are measured for both,
+in a separate process each.
+"""
+
+import sys
+import os
+import gc
+import random
+import resource
+import time
+
+import testbaker
+
+import oelite.meta.dict
+
+
+VARS = ["V%d"%(i) for i in range(12)]
+
+
+def operation(metas, rng):
+    """Do a random operation on a random meta in metas, returning the
+    name of the exception raised, if any."""
+    meta = rng.choice(metas)
+    op = rng.randrange(9)
+    var = rng.choice(VARS)
+    val = rng.choice(["a", "${%s}"%(rng.choice(VARS)),
+                      "b ${%s} c"%(rng.choice(VARS)), ""])
+    try:
+        if op == 0:
+            meta.set(var, val)
+        elif op == 1:
+            meta.set_flag(var, rng.choice(["python", "export", "x", "task"]),
+                          rng.choice([True, None, "1"]))
+        elif op == 2:
+            meta.set_override(var, (rng.choice(["", ">", "<"]),
+                                    rng.choice(["o1", "o2"])), val)
+        elif op == 3:
+            if var in meta.dict:
+                meta.del_var(var)
+        elif op == 4:
+            metas.append(meta.copy())
+        elif op == 5:
+            meta.get(var)
+        elif op == 6:
+            meta.add_hook("h", var, rng.choice([1, 2, None]), after=[])
+        elif op == 7:
+            meta.set_input_mtime("/nonexistent/%s"%(var))
+        elif op == 8:
+            meta.set_preference(recipe=var, layer="l", version=None)
+    except Exception, e:
+        return type(e).__name__
+    return None
+
+
+def state(meta):
+    expand_cache = sorted([(var, (val, set(deps) - set([var])))
+                           for (var, (val, deps))
+                           in meta.expand_cache.items()])
+    return (dict(meta.dict), expand_cache, meta.get_vars("python"),
+            sorted(meta.get_hooks("h")))
+
+
+def run(cls, seed):
+    rng = random.Random(seed)
+    metas = [cls()]
+    metas[0].set("OVERRIDES", "o1:o2")
+    errors = [operation(metas, rng) for i in range(200)]
+    return (errors, [state(meta) for meta in metas])
+
+
+def compare(olddict, sequences):
+    mismatches = 0
+    for seed in range(sequences):
+        old = run(olddict.DictMeta, seed)
+        new = run(oelite.meta.dict.DictMeta, seed)
+        if old == new:
+            continue
+        mismatches += 1
+        print "MISMATCH sequence %d"%(seed)
+        if old[0] != new[0]:
+            print "  old errors: %s"%(old[0])
+            print "  new errors: %s"%(new[0])
+        for (i, (a, b)) in enumerate(zip(old[1], new[1])):
+            if a != b:
+                print "  meta %d old: %s"%(i, repr(a)[:300])
+                print "  meta %d new: %s"%(i, repr(b)[:300])
+                break
+    print "%d sequences, %d mismatches"%(sequences, mismatches)
+    return mismatches
+
+
+def copy_metas(cls):
+    base = cls()
+    for i in range(4000):
+        var = "VAR%d"%(i)
+        base.set(var, "value ${VAR%d} %d"%(i - 1, i))
+        base.set_flag(var, "x", "y")
+        if i % 5 == 0:
+            base.set_flag(var, "export", True)
+        if i % 7 == 0:
+            base.set_override(var, (">", "o1"), " more")
+    gc.collect()
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.time()
+    metas = []
+    for recipe in range(20):
+        recipe_meta = base.copy()
+        for recipe_type in range(3):
+            type_meta = recipe_meta.copy()
+            for i in range(10):
+                type_meta.set("R%d"%(i), "x")
+            for task in range(15):
+                task_meta = type_meta.copy()
+                task_meta.set("T", "y")
+                task_meta.set_flag("do_x", "task", True)
+                metas.append(task_meta)
+    return (time.time() - start,
+            (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - maxrss)
+            / 1024)
+
+
+def benchmark(olddict):
+    print "Benchmark, 20 recipes x 3 types x 15 tasks, 4000 variables:"
+    for (name, cls) in (("old", olddict.DictMeta),
+                        ("new", oelite.meta.dict.DictMeta)):
+        sys.stdout.flush()
+        pid = os.fork()
+        if pid == 0:
+            (seconds, mbytes) = copy_metas(cls)
+            print "  %s: %.2f s, %d MB"%(name, seconds, mbytes)
+            sys.stdout.flush()
+            os._exit(0)
+        os.waitpid(pid, 0)
+    return
+
+
+def main(revision, sequences=200):
+    olddict = testbaker.load_source(revision, "lib/oelite/meta/dict.py",
+                                    "olddict")
+    mismatches = compare(olddict, int(sequences))
+    benchmark(olddict)
+    if mismatches:
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        sys.exit(__doc__)
+    sys.exit(main(*sys.argv[1:]))
@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+"""Measure cold cookbook parsing of two revisions of this layer.
+
+Usage: parsebench.py REVISION [NEWREVISION [RUNS]]
+
+REVISION and NEWREVISION (default the working tree of this layer) are
+git revisions of this layer, fx. the parent of a commit changing the
+parser and the commit itself.  For each revision, the cookbook of all
+recipes of the layer is built RUNS (default 3) times, each time in a
+new process with a new TOPDIR, so without any metadata cache, and
+parsing in the main process only (-j1).  The number of parsers
+constructed (OEParser instances) and the time used for constructing
+them, the number of recipe files parsed, and the total time used for
+building the cookbook are reported for each run.
+"""
+
+import sys
+import os
+import time
+
+import testbaker
+
+import oelite.cookbook
+from oelite.parse import oeparse
+
+
+def measure():
+    """Build the cookbook, printing the parser and timing statistics."""
+    parsers = [0, 0.0]
+    recipefiles = [0]
+    parser_init = oeparse.OEParser.__init__
+    parse_recipefile = oelite.cookbook.CookBook.parse_recipefile
+
+    def counting_parser_init(self, *args, **kwargs):
+        start = time.time()
+        parser_init(self, *args, **kwargs)
+        parsers[0] += 1
+        parsers[1] += time.time() - start
+
+    def counting_parse_recipefile(self, filename):
+        recipefiles[0] += 1
+        return parse_recipefile(self, filename)
+
+    oeparse.OEParser.__init__ = counting_parser_init
+    oelite.cookbook.CookBook.parse_recipefile = counting_parse_recipefile
+    start = time.time()
+    with testbaker.TestBaker(["-j1"]) as baker:
+        total = time.time() - start
+        recipes = len(baker.cookbook.recipes)
+    print ("RESULT %d parsers constructed in %.2f s, %d recipe files "
+           "(%d recipes) in %.2f s total, %d ms per recipe file"%(
+            parsers[0], parsers[1], recipefiles[0], recipes, total,
+            total * 1000 / max(recipefiles[0], 1)))
+    return 0
+
+
+def main(revision, newrevision=None, runs=3):
+    if revision == "--measure":
+        return measure()
+    for (name, rev) in (("old", revision), ("new", newrevision)):
+        print "%s (%s):"%(name, rev or "working tree")
+        for run in range(int(runs)):
+            output = testbaker.run_revision(
+                rev, [os.path.abspath(__file__), "--measure"])
+            for line in output.splitlines():
+                if line.startswith("RESULT "):
+                    print "  %s"%(line[len("RESULT "):])
+    return 0
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        sys.exit(__doc__)
+    sys.exit(main(*sys.argv[1:]))
@@ -0,0 +1,314 @@
+#!/usr/bin/env python
+"""Compare the runqueue with the SQLite based runqueue it replaced.
+
+Usage: runqtest.py REVISION [GRAPHS [RECIPES]]
+
+REVISION is a git revision of this layer with the SQLite based runqueue,
+fx. the parent of the commit replacing it.  The old runqueue
+(lib/oelite/runq.py) is loaded from that revision, and both runqueues
+are driven through the same sequence of operations as done by oe bake
+(adding tasks and dependencies, calculating metadata hashes, pruning
+and running) on GRAPHS (default 200) random task graphs, comparing all
+task and dependency state, and the results of all queries, after each
+step.  The order of get_depend_packages() is unspecified, so it is
+compared sorted.
+
+Then the time spent by both runqueues in each phase is measured on a
+random task graph of RECIPES (default 1000) recipes, with 1 to 4 tasks
+each.
+"""
+
+import sys
+import random
+import time
+import types
+
+import testbaker
+
+from pysqlite2 import dbapi2 as sqlite
+import oelite.package
+import oelite.runq
+import oelite.task
+
+
+TASK_NAMES = ("do_fetch", "do_compile", "do_package", "do_build")
+
+
+class Recipe(object):
+
+    def __init__(self, id, type, name, version):
+        self.id = id
+        self.type = type
+        self.name = name
+        self.version = version
+
+    def get_packages(self):
+        return []
+
+    def get(self, var):
+        return None
+
+    def __str__(self):
+        return "%s:%s_%s"%(self.type, self.name, self.version)
+
+
+class CookBook(object):
+
+    """Random cookbook with recipes, one package per recipe, and tasks,
+    also in the recipe and task tables used by the old runqueue."""
+
+    debug = False
+
+    def __init__(self, rng, recipes, max_parents=None):
+        self.db = sqlite.connect(":memory:")
+        self.db.execute("CREATE TABLE recipe (id INTEGER PRIMARY KEY, "
+                        "type TEXT, name TEXT, version TEXT)")
+        self.db.execute("CREATE TABLE task (id INTEGER PRIMARY KEY, "
+                        "recipe INTEGER, name TEXT, nostamp INTEGER)")
+        self.recipes = {}
+        self.packages = {}
+        self.tasks = {}
+        for id in range(1, recipes + 1):
+            recipe = Recipe(id, rng.choice(["machine", "native", "cross"]),
+                            "r%d"%(id), "1.0")
+            self.recipes[id] = recipe
+            self.db.execute("INSERT INTO recipe VALUES (?,?,?,?)",
+                            (id, recipe.type, recipe.name, recipe.version))
+            package = types.InstanceType(oelite.package.OElitePackage)
+            package.id = id
+            package.name = "p%d"%(id)
+            package.type = "machine"
+            package.recipe = recipe
+            package.version = "1.0"
+            self.packages[id] = package
+        task_id = 0
+        for recipe_id in range(1, recipes + 1):
+            for name in TASK_NAMES[:rng.randint(1, len(TASK_NAMES))]:
+                task_id += 1
+                nostamp = int(rng.random() < 0.1)
+                self.db.execute("INSERT INTO task VALUES (?,?,?,?)",
+                                (task_id, recipe_id, name, nostamp))
+                self.tasks[task_id] = oelite.task.OEliteTask(
+                    task_id, recipe_id, name, nostamp, self)
+        # (task, parent task, deptype, package) dependencies
+        self.edges = []
+        for task in range(2, task_id + 1):
+            if max_parents:
+                parents = rng.sample(range(1, task),
+                                     min(task - 1, max_parents))
+            else:
+                parents = [parent for parent in range(1, task)
+                           if rng.random() < 0.15]
+            for parent in parents:
+                if rng.random() < 0.5:
+                    self.edges.append(
+                        (task, parent, rng.choice(["DEPENDS", "RDEPENDS"]),
+                         self.tasks[parent].recipe.id))
+                else:
+                    self.edges.append((task, parent, None, None))
+
+    def get_recipe(self, id=None, **kwargs):
+        return self.recipes[id]
+
+    def get_task(self, id=None, **kwargs):
+        return self.tasks[id]
+
+    def get_package(self, id=None, **kwargs):
+        return self.packages[id]
+
+
+class Config(object):
+
+    def get(self, *args):
+        return None
+
+
+def dump(runq):
+    """Return all task and dependency state of runq."""
+    if isinstance(runq, oelite.runq.OEliteRunQueue):
+        tasks = [(t.id, t.prime, t.build, t.relax, t.status, t.metahash,
+                  t.mtime, t.tmphash, t.buildhash) for t in runq.task_list]
+        depends = sorted([(d.task, d.prime, d.parent_task, d.deptype,
+                           d.package, d.filename, d.prebake)
+                          for d in runq.depends if d is not None])
+    else:
+        tasks = [tuple(row) for row in runq.dbc.execute(
+                "SELECT task, prime, build, relax, status, metahash, mtime, "
+                "tmphash, buildhash FROM runq.task")]
+        depends = sorted([tuple(row) for row in runq.dbc.execute(
+                    "SELECT task, prime, parent_task, deptype, package, "
+                    "filename, prebake FROM runq.depend")])
+    return (tasks, depends)
+
+
+def run(module, cookbook, seed, timer=None):
+    """Drive runq module through a random sequence of operations on
+    cookbook, returning the list of results and states after each
+    step.  timer(phase) is called at the start of each phase."""
+    if timer is None:
+        timer = lambda phase: None
+    rng = random.Random(seed)
+    tasks = cookbook.tasks
+    out = []
+
+    timer("depend tree")
+    runq = module.OEliteRunQueue(Config(), cookbook,
+                                 schedule=rng.choice(oelite.runq.SCHEDULES))
+    ids = sorted(tasks)
+    rng.shuffle(ids)
+    half = len(ids) // 2
+    runq.add_runq_tasks([tasks[i] for i in ids[:half]])
+    for (task, parent, deptype, package) in (cookbook.edges +
+                                             cookbook.edges[:5]):
+        if package:
+            runq.add_runq_depend(tasks[task], tasks[parent], deptype,
+                                 cookbook.packages[package])
+        else:
+            runq.add_runq_task_depends(tasks[task], [tasks[parent]])
+    runq.add_runq_tasks([tasks[i] for i in ids[half:]])
+    for i in ids:
+        x = rng.random()
+        if x < 0.1:
+            runq.set_task_primary(tasks[i])
+        elif x < 0.2:
+            runq.set_task_build(tasks[i])
+        elif x < 0.3:
+            runq.set_task_relax(tasks[i])
+    out.append(dump(runq))
+    out.append([runq.is_task_primary(tasks[i]) for i in ids])
+
+    timer("metahash")
+    task = runq.get_metahashable_task()
+    while task:
+        runq.set_task_metahash(task, rng.choice(["a", "b"]))
+        if rng.random() < 0.3:
+            runq.set_task_build(task)
+        else:
+            runq.set_task_stamp(task, rng.choice([1.0, 2.0, 3.0]),
+                                rng.choice(["a", "b"]))
+        out.append(("metahash", task.id))
+        task = runq.get_metahashable_task()
+    out.append([t.id for t in runq.get_unhashed_tasks()])
+    runq.set_task_build_on_nostamp_tasks()
+    runq.set_task_build_on_retired_tasks()
+    runq.set_task_build_on_hashdiff()
+    out.append(dump(runq))
+
+    timer("prune")
+    packages = sorted(runq.get_depend_packages())
+    out.append(packages)
+    for package in packages:
+        out.append(runq.get_package_metahash(package))
+        if rng.random() < 0.4:
+            runq.set_package_filename(package, "pre%d"%(package),
+                                      prebake=True)
+    runq.prune_prebaked_runq_depends()
+    out.append(dump(runq))
+    runq.propagate_runq_task_build()
+    out.append(dump(runq))
+    out.append((runq.set_buildhash_for_build_tasks(),
+                runq.set_buildhash_for_nobuild_tasks()))
+    for package in sorted(runq.get_packages_to_build()):
+        out.append(runq.get_package_buildhash(package))
+        runq.set_package_filename(package, "f%d"%(package))
+    out.append(runq.mark_primary_runq_depends())
+    out.append(dump(runq))
+    out.append(runq.prune_runq_depends_nobuild())
+    out.append(dump(runq))
+    out.append(runq.prune_runq_depends_with_nobody_depending_on_it())
+    out.append(dump(runq))
+    out.append(runq.prune_runq_tasks())
+    out.append(dump(runq))
+
+    timer("queries")
+    out.append(runq.number_of_tasks_to_build())
+    out.append(runq.number_of_runq_tasks())
+    out.append(sorted(runq.get_recipes_with_tasks_to_build()))
+    out.append(runq.get_tasks_to_build_description(hashinfo=True))
+    out.append([runq.is_recipe_primary(i) for i in cookbook.recipes])
+    for i in ids:
+        for deptype in ("DEPENDS", "RDEPENDS"):
+            out.append(sorted(runq.get_depend_packages(tasks[i], deptype)))
+    for package in cookbook.packages.values():
+        out.append(runq.get_package_filename(package))
+
+    timer("run")
+    if runq.schedule == "critical-path":
+        runq.set_task_priorities(lambda task: task.id % 5 + 1)
+        out.append(sorted(runq.task_priority.items()))
+    while True:
+        task = runq.get_runabletask()
+        if not task:
+            break
+        out.append(("run", task.id))
+        runq.set_task_running(task)
+        runq.mark_done(task)
+    out.append(dump(runq))
+    timer(None)
+    return out
+
+
+def compare(oldrunq, graphs):
+    mismatches = 0
+    for seed in range(graphs):
+        recipes = random.Random(seed).randint(3, 25)
+        old = run(oldrunq, CookBook(random.Random(seed), recipes),
+                  seed * 7 + 1)
+        new = run(oelite.runq, CookBook(random.Random(seed), recipes),
+                  seed * 7 + 1)
+        if old == new:
+            continue
+        mismatches += 1
+        for step in range(min(len(old), len(new))):
+            if old[step] != new[step]:
+                break
+        print "MISMATCH graph %d step %d"%(seed, step)
+        print "  old: %s"%(repr(old[step])[:300])
+        print "  new: %s"%(repr(new[step])[:300])
+    print "%d graphs, %d mismatches"%(graphs, mismatches)
+    return mismatches
+
+
+class Timer(object):
+
+    def __init__(self):
+        self.times = []
+        self.phase = None
+        self.start = None
+
+    def __call__(self, phase):
+        now = time.time()
+        if self.phase:
+            self.times.append((self.phase, now - self.start))
+        self.phase = phase
+        self.start = now
+
+
+def benchmark(oldrunq, recipes):
+    print "Benchmark, %d recipes:"%(recipes)
+    for (name, module) in (("old", oldrunq), ("new", oelite.runq)):
+        cookbook = CookBook(random.Random(1), recipes, max_parents=4)
+        timer = Timer()
+        run(module, cookbook, 8, timer)
+        print "  %s (%d tasks, %d depends): %s, total %.2f s"%(
+            name, len(cookbook.tasks), len(cookbook.edges),
+            ", ".join(["%s %.2f s"%(phase, seconds)
+                       for (phase, seconds) in timer.times]),
+            sum([seconds for (phase, seconds) in timer.times]))
+    return
+
+
+def main(revision, graphs=200, recipes=1000):
+    oldrunq = testbaker.load_source(revision, "lib/oelite/runq.py",
+                                    "oldrunq")
+    mismatches = compare(oldrunq, int(graphs))
+    benchmark(oldrunq, int(recipes))
+    if mismatches:
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        sys.exit(__doc__)
+    sys.exit(main(*sys.argv[1:]))
@@ -0,0 +1,137 @@
+"""Helper for the test and benchmark scripts in this directory.
+
+The scripts run on the recipes, classes and configuration files of this
+layer, without a manifest and oe bakery configuration, using a
+temporary TOPDIR (and thereby TMPDIR) so that nothing is written to the
+layer directory.  If TESTBAKER_LAYERDIR is set in the environment, the
+code, recipes, classes and configuration files of that layer directory
+are used instead, fx. a copy of an older revision of this layer.
+"""
+
+import sys
+import os
+import imp
+import optparse
+import subprocess
+import tempfile
+import shutil
+
+TESTDIR = os.path.dirname(os.path.abspath(__file__))
+LAYERDIR = (os.environ.get("TESTBAKER_LAYERDIR") or
+            os.path.abspath(os.path.join(TESTDIR, os.pardir)))
+sys.path.insert(0, os.path.join(LAYERDIR, "lib"))
+
+import oelite.meta
+import oelite.path
+import oelite.baker
+
+
+# Configuration normally given in the conf/local.conf of a manifest
+DEFAULT_CONFIG = {
+    "MACHINE": "qemu",
+    "MACHINE_CPU": "i686",
+    "MACHINE_OS": "linux-gnu",
+    "SDK_CPU": "i686",
+    "SDK_OS": "linux-gnu",
+    "DISTRO": "testdist",
+    "SDK": "testsdk",
+    "GCC_VERSION": "4.9.0",
+    }
+
+
+class TestBaker(object):
+
+    """Context manager returning an OEliteBaker for this layer, with
+    the cookbook of all its recipes, in a temporary TOPDIR which is
+    removed on exit.  argv is the oe bake command line arguments (fx.
+    ["-j4"]), and config additional configuration variables."""
+
+    def __init__(self, argv=[], config={}):
+        self.argv = argv
+        self.config = dict(DEFAULT_CONFIG)
+        self.config.update(config)
+        self.topdir = None
+        self.cwd = None
+        return
+
+    def __enter__(self):
+        parser = optparse.OptionParser()
+        oelite.baker.add_bake_parser_options(parser)
+        parser.add_option("-d", "--debug",
+                          action="store_true", default=False)
+        (options, args) = parser.parse_args(list(self.argv))
+        self.topdir = tempfile.mkdtemp(prefix="oelite-test-")
+        self.cwd = os.getcwd()
+        os.chdir(self.topdir)
+        oelite.path.init(self.topdir)
+        config = oelite.meta.DictMeta()
+        config.set("TOPDIR", self.topdir)
+        config.set("OEPATH", LAYERDIR)
+        config.set("OERECIPES", os.path.join(LAYERDIR, "recipes/*/*.oe"))
+        for (var, val) in self.config.items():
+            config.set(var, val)
+        return oelite.baker.OEliteBaker(options, args, config)
+
+    def __exit__(self, type, value, traceback):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.topdir, ignore_errors=True)
+        return False
+
+
+def all_tasks(baker):
+    """Return list of all tasks of all recipes in the cookbook."""
+    tasks = []
+    cookbook = baker.cookbook
+    for recipe_id in sorted(cookbook.recipes):
+        recipe = cookbook.recipes[recipe_id]
+        for name in sorted(recipe.get_task_names()):
+            tasks.append(cookbook.get_task(recipe=recipe, name=name))
+    return tasks
+
+
+def load_source(revision, path, name):
+    """Return module name loaded from path in git revision of this
+    layer, fx. for comparing with the code it was replaced with."""
+    source = subprocess.check_output(
+        ["git", "show", "%s:%s"%(revision, path)], cwd=TESTDIR)
+    (fd, filename) = tempfile.mkstemp(suffix=".py")
+    try:
+        os.write(fd, source)
+        os.close(fd)
+        return imp.load_source(name, filename)
+    finally:
+        os.unlink(filename)
+        if os.path.exists(filename + "c"):
+            os.unlink(filename + "c")
+
+
+def run_revision(revision, argv):
+    """Run python with argv in a new process, using git revision of
+    this layer (exported to a temporary directory) as the layer of
+    TestBaker, or the working tree of this layer if revision is None.
+    Returns the output of the process."""
+    env = dict(os.environ)
+    env.pop("TESTBAKER_LAYERDIR", None)
+    layerdir = None
+    if revision:
+        layerdir = tempfile.mkdtemp(prefix="oelite-test-layer-")
+        archive = subprocess.Popen(["git", "archive", revision],
+                                   cwd=os.path.dirname(TESTDIR),
+                                   stdout=subprocess.PIPE)
+        subprocess.check_call(["tar", "-x", "-C", layerdir],
+                              stdin=archive.stdout)
+        if archive.wait():
+            raise Exception("git archive %s failed"%(revision))
+        env["TESTBAKER_LAYERDIR"] = layerdir
+    try:
+        process = subprocess.Popen([sys.executable] + list(argv), env=env,
+                                   stdout=subprocess.PIPE,
+                                   stderr=subprocess.STDOUT)
+        output = process.communicate()[0]
+        if process.returncode:
+            raise Exception("%s failed with %s:\n%s"%(
+                    " ".join(argv), revision or "working tree", output))
+        return output
+    finally:
+        if layerdir:
+            shutil.rmtree(layerdir, ignore_errors=True)